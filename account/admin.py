@@ -16,6 +16,7 @@ from account.models import Profile
 class ProfileAdmin(admin.ModelAdmin):
     fields = ['photo_tag', 'user', 'date_of_birth']
     list_display = ['photo_tag', 'user', 'date_of_birth']
+    list_select_related = ['user']
     readonly_fields = ['photo_tag']
 
     class Meta:
@@ -38,6 +39,8 @@ class EUserAdmin(UserAdmin):
     ]
     # модифицируем список отображаемых полей, чтобы увидеть аватарку с остальными полями
     list_display = ('photo_tag',) + UserAdmin.list_display + ('bday',)
+    # photo_tag и bday читают профиль - без этого по запросу на каждую строку
+    list_select_related = ['profile']
 
     # а также создаём метод для получения тега аватарки из пользовательского профиля
     def photo_tag(self, obj):
@@ -46,6 +49,9 @@ class EUserAdmin(UserAdmin):
     def bday(self, obj):
         return obj.profile.date_of_birth
 
+    bday.short_description = 'Дата рождения'
+    bday.admin_order_field = 'profile__date_of_birth'
+
 
 admin.site.register(Profile, ProfileAdmin)
 admin.site.unregister(User)
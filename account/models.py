@@ -1,10 +1,12 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils.safestring import mark_safe
 
+from bookcross.thumbnails import ensure_thumbnails, get_srcset, get_thumbnail_url, has_thumbnails
+
 # Create your models here.
 user = get_user_model()
 
@@ -14,9 +16,18 @@ class Profile(models.Model):
     date_of_birth = models.DateField(blank=True, null=True, verbose_name='Дата рождения')
     photo = models.ImageField(upload_to="users/%Y/%m/%d", blank=True, verbose_name='Photo')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.old_photo = self.photo_name()
+
     def __str__(self):
         return f'Profile for user {self.user.username}'
 
+    def photo_name(self):
+        # через __dict__, чтобы не подгружать отложенное фото
+        photo = self.__dict__.get('photo')
+        return getattr(photo, 'name', photo)
+
     class Meta:
         verbose_name = 'Профайл пользователя'
         verbose_name_plural = 'Профайлы пользователей'
@@ -27,13 +38,32 @@ class Profile(models.Model):
             return self.photo.url
         return 'media/users/no_image.png'
 
+    @property
+    def photo_thumb_url(self):
+        return get_thumbnail_url(self.photo.name, 150) or self.photo_url
+
+    @property
+    def photo_srcset(self):
+        return get_srcset(self.photo.name) if has_thumbnails(self.photo.name) else None
+
     def photo_tag(self):
-        return mark_safe(f'<img src="/{self.photo_url}" width="50" height="50" style="object-fit: cover;"/>')
+        return mark_safe(f'<img src="/{self.photo_thumb_url}" width="50" height="50" style="object-fit: cover;"/>')
         # return self.photo_url
 
     photo_tag.short_description = 'Photo'
 
 
+@receiver(post_save, sender=Profile)
+def profile_photo_saved(sender, instance, **kwargs):
+    # профиль пересохраняется при каждом сохранении пользователя (в т.ч. входе) - реагируем только на новое фото
+    name = instance.photo_name()
+    if name == instance.old_photo:
+        return
+    instance.old_photo = name
+    if name:
+        transaction.on_commit(lambda: ensure_thumbnails(name))
+
+
 @receiver(post_save, sender=user)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
@@ -1,3 +1,26 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-# Create your tests here.
+User = get_user_model()
+
+
+class UserAdminQueryTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_profile_loaded_with_users(self):
+        for i in range(3):
+            User.objects.create_user(f'user{i}', password='pass')
+        before = self.count_queries('/admin/auth/user/'), self.count_queries('/admin/account/profile/')
+        for i in range(3, 20):
+            User.objects.create_user(f'user{i}', password='pass')
+        after = self.count_queries('/admin/auth/user/'), self.count_queries('/admin/account/profile/')
+        self.assertEqual(after, before)
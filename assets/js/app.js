@@ -9,14 +9,60 @@ new Vue({
         el: '#list_book',
         data: {
             books: [],
+            next: '/api/v1/list_book/?profile=card',
+            loading: false,
+            events: null,
         },
         created: function () {
-            const vm = this;
-            axios.get('/api/v1/list_book')
-                .then(function (response) {
-                    vm.books = response.data;
-                })
-
+            this.loadMore();
+            window.addEventListener('scroll', this.onScroll);
+            this.listenEvents();
+        },
+        destroyed: function () {
+            window.removeEventListener('scroll', this.onScroll);
+            if (this.events) this.events.close();
+        },
+        methods: {
+            // Следующая страница по курсору из ответа API
+            loadMore: function () {
+                const vm = this;
+                if (!vm.next || vm.loading) return;
+                vm.loading = true;
+                axios.get(vm.next)
+                    .then(function (response) {
+                        vm.books = vm.books.concat(response.data.results);
+                        vm.next = response.data.next;
+                    })
+                    .finally(function () {
+                        vm.loading = false;
+                    })
+            },
+            // srcset уменьшенных обложек (пути в API относительные)
+            coverSrcset: function (book, fmt) {
+                if (!book.get_cover_srcset) return '';
+                return book.get_cover_srcset[fmt].split(', ').map(function (item) {
+                    return '/' + item;
+                }).join(', ');
+            },
+            // Смена статуса книги приходит с сервера (SSE) - обновляем только ее карточку
+            listenEvents: function () {
+                const vm = this;
+                if (!window.EventSource) return;
+                vm.events = new EventSource('/api/v1/events/');
+                vm.events.addEventListener('status', function (message) {
+                    const event = JSON.parse(message.data);
+                    const book = vm.books.find(function (item) {
+                        return item.id === event.book;
+                    });
+                    if (!book) return;
+                    Vue.set(book, 'status', event.status);
+                    Vue.set(book, 'status_display', event.status_display);
+                });
+            },
+            onScroll: function () {
+                const bottom = document.documentElement.scrollHeight - window.innerHeight - window.scrollY;
+                if (bottom < 600) this.loadMore();
+            }
         }
     }
 );
@@ -1,8 +1,14 @@
 from django.contrib import admin
 from django.contrib.admin.decorators import register
+from django.core.exceptions import ValidationError
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 
-from bookcross.forms import BookInstanceForm
+from bookcross.forms import BookImportForm, BookInstanceForm
+from bookcross.importer import import_books
 from bookcross.models import *
+from bookcross.services import change_status
 
 # Register your models here.
 
@@ -21,6 +27,7 @@ class BooksInstanceInline(admin.TabularInline):
 class PlaceAdmin(admin.ModelAdmin):
     list_display = ['title', 'get_full_path', 'end']
     list_filter = ['end', 'owner']
+    ordering = ['full_path']
     list_editable = ['end']
 
 
@@ -30,15 +37,101 @@ class AuthorAdmin(admin.ModelAdmin):
     inlines = [BooksInstanceInline]
 
 
+class RatingListFilter(admin.SimpleListFilter):
+    title = 'Рейтинг'
+    parameter_name = 'min_rating'
+
+    def lookups(self, request, model_admin):
+        return [(str(r), f'{r} и выше') for r in (4, 3, 2, 1)]
+
+    def queryset(self, request, queryset):
+        if self.value() and self.value().isdigit():
+            return queryset.filter(rating_avg__gte=int(self.value()))
+        return queryset
+
+
 @register(BookInstance)
 class BookInstanceAdmin(admin.ModelAdmin):
-    list_display = ['author', 'title', 'status', 'get_time_reserved', 'isbn', 'place']
-    list_filter = ['owner', 'loaner', 'author', 'status']
+    list_display = ['author', 'title', 'status', 'get_time_reserved', 'isbn', 'place', 'rating_avg', 'rating_count']
+    # автор и место выводятся в каждой строке - берем их тем же запросом, что и книги
+    list_select_related = ['author', 'place']
+    list_filter = ['owner', 'loaner', 'author', 'status', RatingListFilter]
     filter_horizontal = ['genre']
     form = BookInstanceForm
+    actions = ['make_available', 'send_to_repair', 'withdraw']
+    change_list_template = 'admin/bookcross/bookinstance/change_list.html'
+
+    def get_urls(self):
+        return [path('import/', self.admin_site.admin_view(self.import_view), name='bookcross_bookinstance_import'),
+                *super().get_urls()]
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            return redirect('admin:bookcross_bookinstance_changelist')
+        form = BookImportForm(request.POST or None, request.FILES or None)
+        result = None
+        if form.is_valid():
+            data = form.cleaned_data
+            result = import_books(data['file'], data['owner'], dry_run=data['dry_run'])
+            if not data['dry_run'] and not result.errors:
+                self.message_user(request, f'Импортировано книг: {result.created}')
+                return redirect('admin:bookcross_bookinstance_changelist')
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, form=form, result=result,
+                       title='Импорт книг')
+        return TemplateResponse(request, 'admin/bookcross/bookinstance/import_books.html', context)
+
+    def change_status_action(self, request, queryset, status):
+        changed = change_status(queryset, status)
+        self.message_user(request, f'Статус "{dict(BookInstance.LOAN_STATUS)[status]}" установлен у {changed} книг')
+
+    def make_available(self, request, queryset):
+        self.change_status_action(request, queryset, 'a')
+
+    make_available.short_description = 'Сделать доступными'
+
+    def send_to_repair(self, request, queryset):
+        self.change_status_action(request, queryset, 'm')
+
+    send_to_repair.short_description = 'Отправить в ремонт'
+
+    def withdraw(self, request, queryset):
+        self.change_status_action(request, queryset, 'x')
+
+    withdraw.short_description = 'Изъять из обращения'
+
+
+class HistoryBookListFilter(admin.SimpleListFilter):
+    """
+    Фильтр по книге: только книги с историей и одним запросом вместе с авторами
+    (стандартный фильтр по ForeignKey выводит все книги и грузит автора каждой отдельно)
+    """
+    title = 'Книга'
+    parameter_name = 'book'
+
+    def lookups(self, request, model_admin):
+        books = BookInstance.objects.filter(crosshistory__isnull=False).distinct().select_related('author')
+        return [(str(book.pk), str(book)) for book in books]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            try:
+                return queryset.filter(book_id=self.value())
+            except ValidationError:
+                return queryset.none()
+        return queryset
 
 
 @register(CrossHistory)
 class CrossHistoryAdmin(admin.ModelAdmin):
     list_display = ['book', 'comment']
-    list_filter = ['book']
+    list_filter = [HistoryBookListFilter]
+    # str(book) выводит автора
+    list_select_related = ['book__author']
+
+
+@register(CrossHistoryMonth)
+class CrossHistoryMonthAdmin(admin.ModelAdmin):
+    list_display = ['book', 'month', 'changes', 'loans', 'reservations', 'loan_days']
+    list_select_related = ['book__author']
+    date_hierarchy = 'month'
+    raw_id_fields = ['book']
@@ -1,5 +1,12 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class BookcrossConfig(AppConfig):
     name = 'bookcross'
+
+    def ready(self):
+        from bookcross import cache, facets, search  # noqa: F401 - подключение сигналов
+        from pbl import db  # noqa: F401 - PRAGMA для новых соединений с SQLite
+        post_migrate.connect(search.create_search_index, sender=self)
+        post_migrate.connect(facets.create_browse_indexes, sender=self)
@@ -0,0 +1,119 @@
+"""
+Замеры страниц сайта через тестовый клиент Django.
+
+run_benchmarks() открывает главную, API списка книг и фасетного поиска, списки в админке и личный кабинет
+от имени временного администратора (удаляется после замеров) и возвращает словарь для json:
+перцентили времени ответа, число SQL запросов и пик выделенной памяти на запрос.
+Результаты разных запусков можно сравнивать.
+"""
+import platform
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from bookcross.models import BookInstance
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+User = get_user_model()
+
+BENCH_ADMIN = 'bench_admin'
+ENDPOINTS = {
+    'home': '/',
+    'api_list_book': '/api/v1/list_book/',
+    'api_browse': '/api/v1/browse/?status=a&profile=card',
+    'admin_books': '/admin/bookcross/bookinstance/',
+    'admin_history': '/admin/bookcross/crosshistory/',
+    'admin_users': '/admin/auth/user/',
+    'account_dashboard': '/account/',
+}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+@contextmanager
+def admin_client():
+    """
+    Клиент под администратором BENCH_ADMIN. Созданный для замеров пользователь после них удаляется,
+    чтобы в базе не оставался лишний суперпользователь
+    """
+    admin, created = User.objects.get_or_create(username=BENCH_ADMIN, defaults={'is_staff': True,
+                                                                                'is_superuser': True})
+    client = Client()
+    client.force_login(admin)
+    try:
+        yield client
+    finally:
+        client.logout()
+        if created:
+            admin.delete()
+
+
+def measure(client, url, repeat):
+    """
+    repeat запросов к url: времена ответа, запросы к БД и пик памяти (отдельным запросом под tracemalloc,
+    чтобы трассировка не искажала время)
+    """
+    timings, queries = [], []
+    status = None
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            status = client.get(url).status_code
+            timings.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured))
+    tracemalloc.start()
+    try:
+        client.get(url)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'url': url,
+        'status': status,
+        'requests': repeat,
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'mean_ms': round(statistics.mean(timings), 2),
+        'max_ms': round(max(timings), 2),
+        'queries': max(queries),
+        'peak_memory_kb': peak // 1024,
+    }
+
+
+def run_benchmarks(repeat=20, warmup=2, endpoints=None):
+    endpoints = endpoints or ENDPOINTS
+    # тестовый клиент ходит на хост testserver
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+        with admin_client() as client:
+            for url in endpoints.values():
+                for _ in range(warmup):
+                    client.get(url)
+            results = {name: measure(client, url, repeat) for name, url in endpoints.items()}
+    return {
+        'date': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'books': BookInstance.objects.count(),
+        'users': User.objects.count(),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'endpoints': results,
+    }
@@ -0,0 +1,133 @@
+"""
+Кэш списка книг и ответов API.
+
+Ключи содержат номер версии каталога. Любое изменение книг, оценок, избранного, авторов, жанров, мест
+и имен пользователей увеличивает версию (после коммита транзакции), после чего старые записи просто
+перестают читаться и истекают сами.
+Бэкенд выбирается настройкой BOOKCROSS_CACHE (алиас из CACHES).
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from bookcross.models import Author, BookInstance, BookRating, Favorite, Genre, Place
+
+VERSION_KEY = 'bookcross:catalog_version'
+STATS_KEYS = {'hits': 'bookcross:stats:hits', 'misses': 'bookcross:stats:misses'}
+
+
+def get_cache_alias():
+    return getattr(settings, 'BOOKCROSS_CACHE', 'default')
+
+
+def get_cache():
+    return caches[get_cache_alias()]
+
+
+def get_timeout():
+    return getattr(settings, 'BOOKCROSS_CACHE_TIMEOUT', 60 * 60)
+
+
+def initial_version():
+    # после очистки или вытеснения ключа версия продолжается с текущего времени, а не с 1:
+    # иначе вернутся старые номера и уцелевшие записи тех версий снова начнут читаться
+    return time.time_ns()
+
+
+def catalog_version():
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, initial_version(), None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache = get_cache()
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # ключа нет (кэш очищен или вытеснен)
+        cache.add(VERSION_KEY, initial_version(), None)
+        return cache.incr(VERSION_KEY)
+
+
+def count(stat):
+    cache = get_cache()
+    try:
+        cache.incr(STATS_KEYS[stat])
+    except ValueError:
+        cache.add(STATS_KEYS[stat], 0, None)
+        cache.incr(STATS_KEYS[stat])
+
+
+def cache_stats():
+    cache = get_cache()
+    stats = {stat: cache.get(key, 0) for stat, key in STATS_KEYS.items()}
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0
+    stats['version'] = catalog_version()
+    return stats
+
+
+def reset_cache_stats():
+    get_cache().delete_many(list(STATS_KEYS.values()))
+
+
+def make_key(prefix, *parts):
+    digest = hashlib.md5('|'.join(str(p) for p in parts).encode()).hexdigest()
+    return f'bookcross:{prefix}:{catalog_version()}:{digest}'
+
+
+def get_or_build(prefix, parts, build):
+    """
+    Значение из кэша по ключу (версия каталога + parts) или build(), сохраненное в кэш
+    """
+    cache = get_cache()
+    key = make_key(prefix, *parts)
+    value = cache.get(key)
+    if value is not None:
+        count('hits')
+        return value
+    count('misses')
+    value = build()
+    cache.set(key, value, get_timeout())
+    return value
+
+
+@receiver(post_save, sender=BookInstance)
+@receiver(post_delete, sender=BookInstance)
+@receiver(post_save, sender=BookRating)
+@receiver(post_delete, sender=BookRating)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_save, sender=Place)
+@receiver(post_delete, sender=Place)
+@receiver(post_delete, sender=get_user_model())
+def catalog_changed(sender, **kwargs):
+    # после коммита: иначе параллельный запрос успеет закэшировать старые данные уже под новой версией
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_changed(sender, update_fields=None, **kwargs):
+    # имя владельца есть в карточках, API и фасетах; вход обновляет только last_login - его пропускаем
+    if update_fields is None or 'username' in update_fields:
+        transaction.on_commit(bump_catalog_version)
+
+
+@receiver(m2m_changed, sender=BookInstance.genre.through)
+def book_genres_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        transaction.on_commit(bump_catalog_version)
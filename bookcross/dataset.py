@@ -0,0 +1,140 @@
+"""
+Синтетические данные для замеров производительности.
+
+generate_dataset(books=10000) создает пользователей с профилями, деревья мест (город / библиотека / полка),
+авторов, жанры, книги во всех статусах, оценки, избранное и историю перемещений.
+Все пишется bulk_create, поэтому счетчики, пути мест, поисковый индекс и версия кэша
+пересчитываются в конце отдельно.
+"""
+import datetime
+import random
+import time
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.utils import timezone
+
+from account.models import Profile
+from bookcross.cache import bump_catalog_version
+from bookcross.models import (MAX_RESERVED_TIME, Author, BookInstance, BookRating, CrossHistory, Favorite, Genre,
+                              Place, rebuild_place_paths, update_book_ratings, update_favorite_counts)
+from bookcross.search import rebuild_search_index
+
+User = get_user_model()
+
+DatasetResult = namedtuple('DatasetResult', ['users', 'places', 'authors', 'genres', 'books', 'ratings',
+                                             'favorites', 'history', 'duration'])
+BATCH_SIZE = 1000
+USERNAME_PREFIX = 'bench_'
+PASSWORD = 'bench'
+# доли статусов примерно как в живом каталоге: большая часть книг доступна
+STATUS_WEIGHTS = {'a': 60, 'o': 15, 'r': 10, 'm': 10, 'x': 5}
+GENRES = ['Роман', 'Повесть', 'Рассказ', 'Детектив', 'Фантастика', 'Фэнтези', 'Поэзия', 'Драма', 'История',
+          'Биография', 'Наука', 'Философия', 'Психология', 'Детская', 'Приключения', 'Ужасы', 'Мемуары',
+          'Публицистика', 'Сказки', 'Учебник']
+WORDS = ['тихий', 'дом', 'ветер', 'северный', 'река', 'последний', 'город', 'сад', 'ночь', 'дорога', 'старый',
+         'мост', 'свет', 'зимний', 'остров', 'песня', 'море', 'время', 'забытый', 'письмо']
+FIRST_NAMES = ['Анна', 'Иван', 'Мария', 'Петр', 'Елена', 'Алексей', 'Ольга', 'Сергей', 'Наталья', 'Михаил']
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов', 'Михайлов', 'Новиков', 'Федоров',
+              'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров']
+
+
+def created_ids(model, objects, field='pk'):
+    """
+    bulk_create и id созданных строк по порядку: на SQLite Django 3.0 не возвращает pk из bulk_create,
+    поэтому они перечитываются как все строки с pk больше прежнего максимума
+    """
+    last = model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+    return list(model.objects.filter(pk__gt=last).order_by('pk').values_list(field, flat=True))
+
+
+def make_title(rng):
+    return ' '.join(rng.sample(WORDS, rng.randint(1, 4))).capitalize()
+
+
+def generate_dataset(books=1000, users=None, authors=None, ratings_per_user=10, favorites_per_user=3,
+                     seed=None):
+    """
+    Добавляет в базу набор данных на books книг. Остальные объемы по умолчанию считаются от books.
+    Повторный запуск добавляет еще один набор (логины пользователей не пересекаются)
+    """
+    started = time.monotonic()
+    rng = random.Random(seed)
+    users = users or max(10, books // 10)
+    authors = authors or max(5, books // 5)
+    now = timezone.now()
+
+    with transaction.atomic():
+        offset = User.objects.filter(username__startswith=USERNAME_PREFIX).count()
+        password = make_password(PASSWORD)  # хэш считается один раз на всех
+        user_ids = created_ids(User, [
+            User(username=f'{USERNAME_PREFIX}{offset + i:06}', password=password,
+                 email=f'{USERNAME_PREFIX}{offset + i}@example.com',
+                 first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES))
+            for i in range(users)])
+        Profile.objects.bulk_create(
+            [Profile(user_id=pk, date_of_birth=datetime.date(rng.randint(1950, 2010), rng.randint(1, 12),
+                                                             rng.randint(1, 28)))
+             for pk in user_ids], batch_size=BATCH_SIZE)
+
+        # город -> библиотека -> полки, книги стоят на полках
+        cities = created_ids(Place, [Place(title=f'Город {i}', owner_id=rng.choice(user_ids))
+                                     for i in range(max(1, books // 5000))])
+        libraries = created_ids(Place, [Place(title=f'Библиотека {i}', parent_place_id=city,
+                                              owner_id=rng.choice(user_ids))
+                                        for city in cities for i in range(rng.randint(2, 5))])
+        shelves = created_ids(Place, [Place(title=f'Полка {i}', parent_place_id=library, end=True,
+                                            owner_id=rng.choice(user_ids))
+                                      for library in libraries for i in range(max(1, books // 50 // len(libraries)))])
+        rebuild_place_paths()
+
+        author_ids = created_ids(Author, [
+            Author(first_name=rng.choice(FIRST_NAMES), last_name=f'{rng.choice(LAST_NAMES)} {i}',
+                   date_of_birth=datetime.date(rng.randint(1800, 1990), 1, 1))
+            for i in range(authors)])
+        existing = set(Genre.objects.filter(name__in=GENRES).values_list('name', flat=True))
+        created_ids(Genre, [Genre(name=name) for name in GENRES if name not in existing])
+        genre_ids = list(Genre.objects.filter(name__in=GENRES).values_list('pk', flat=True))
+
+        book_objects, history = [], []
+        statuses, weights = zip(*STATUS_WEIGHTS.items())
+        for i in range(books):
+            status = rng.choices(statuses, weights)[0]
+            loaner = rng.choice(user_ids) if status in ('o', 'r') else None
+            # часть резервов уже просрочена - есть работа для expire_reservations
+            reserved_time = now - rng.random() * MAX_RESERVED_TIME * 1.5 if status == 'r' else None
+            book = BookInstance(title=f'{make_title(rng)} ({i})', author_id=rng.choice(author_ids),
+                                summary=' '.join(rng.choices(WORDS, k=30)), isbn=f'978{rng.randrange(10 ** 10):010}',
+                                owner_id=rng.choice(user_ids), loaner_id=loaner, status=status,
+                                reserved_time=reserved_time, place_id=rng.choice(shelves))
+            book_objects.append(book)
+            if status != 'a':
+                history.append(CrossHistory.status_change(book.pk, loaner, 'a', status))
+        BookInstance.objects.bulk_create(book_objects, batch_size=BATCH_SIZE)
+        book_ids = [book.pk for book in book_objects]
+        through = BookInstance.genre.through
+        through.objects.bulk_create(
+            [through(bookinstance_id=pk, genre_id=genre) for pk in book_ids
+             for genre in rng.sample(genre_ids, rng.randint(1, 3))], batch_size=BATCH_SIZE)
+        CrossHistory.objects.bulk_create(history, batch_size=BATCH_SIZE)
+
+        ratings, favorites = [], []
+        for user in user_ids:
+            ratings += [BookRating(book_id=pk, user_id=user, rating=rng.choice('12345'))
+                        for pk in rng.sample(book_ids, min(ratings_per_user, books))]
+            favorites += [Favorite(book_id=pk, user_id=user)
+                          for pk in rng.sample(book_ids, min(favorites_per_user, books))]
+        BookRating.objects.bulk_create(ratings, batch_size=BATCH_SIZE)
+        Favorite.objects.bulk_create(favorites, batch_size=BATCH_SIZE)
+
+        # пересчет по всем книгам: список из сотен тысяч id не влезет в IN (...)
+        update_book_ratings()
+        update_favorite_counts()
+    rebuild_search_index()
+    transaction.on_commit(bump_catalog_version)
+    return DatasetResult(users=len(user_ids), places=len(cities) + len(libraries) + len(shelves),
+                         authors=len(author_ids), genres=len(genre_ids), books=books, ratings=len(ratings),
+                         favorites=len(favorites), history=len(history), duration=time.monotonic() - started)
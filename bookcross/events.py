@@ -0,0 +1,158 @@
+"""
+События о смене статуса книг для фронтенда (server-sent events через ASGI).
+
+Изменения статуса (BookInstance.save, services.change_status, expire_reservations) после коммита
+транзакции публикуются в брокер. ASGI приложение sse_app держит соединение /api/v1/events/ и пересылает
+события клиенту. Открытое соединение - это корутина и очередь, без потока, поэтому тысячи ожидающих
+клиентов обслуживает один процесс.
+
+Брокер задается настройкой BOOKCROSS_EVENT_BROKER. InProcessBroker раздает события подписчикам
+своего процесса: писать в базу должен тот же процесс, что держит соединения (uvicorn/daphne).
+Для нескольких процессов его заменяет брокер с тем же интерфейсом поверх Redis/PostgreSQL LISTEN.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('bookcross.events')
+
+EVENTS_PATH = '/api/v1/events/'
+KEEPALIVE = 15  # секунд, комментарий-пинг не дает прокси закрыть простаивающее соединение
+QUEUE_SIZE = 100
+
+_brokers = {}
+
+
+class Subscription:
+    def __init__(self, broker, loop):
+        self.broker = broker
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+        self.overflow = False
+
+    def put(self, event):
+        # вызывается в цикле событий подписчика
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # клиент не успевает читать - закрываем, при переподключении он перечитает список
+            self.overflow = True
+
+    async def get(self, timeout=None):
+        """
+        Следующее событие или None по таймауту
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    """
+    publish можно вызывать из любого потока, подписчики живут в цикле событий ASGI сервера
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def subscribe(self):
+        subscription = Subscription(self, asyncio.get_running_loop())
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def publish(self, event):
+        event = dict(event, id=next(self.ids))
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # цикл событий уже остановлен
+                self.unsubscribe(subscription)
+
+
+def get_broker():
+    path = getattr(settings, 'BOOKCROSS_EVENT_BROKER', 'bookcross.events.InProcessBroker')
+    if path not in _brokers:
+        _brokers[path] = import_string(path)()
+    return _brokers[path]
+
+
+def publish_status_changes(changes):
+    """
+    changes - список (id книги, старый статус, новый статус).
+    Публикация после коммита: откаченные изменения клиенты не увидят
+    """
+    from bookcross.models import BookInstance
+
+    names = dict(BookInstance.LOAN_STATUS)
+    events = [{'type': 'status', 'book': str(book_id), 'old_status': old, 'status': new,
+               'status_display': names.get(new, new)}
+              for book_id, old, new in changes if old != new]
+    if not events:
+        return
+
+    def send():
+        broker = get_broker()
+        for event in events:
+            broker.publish(event)
+
+    transaction.on_commit(send)
+
+
+def format_event(event):
+    return f'id: {event["id"]}\nevent: {event["type"]}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n'.encode()
+
+
+async def sse_app(scope, receive, send):
+    """
+    ASGI приложение: поток событий text/event-stream до отключения клиента
+    """
+    subscription = get_broker().subscribe()
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),  # nginx не буферизует поток
+    ]})
+    await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+
+    disconnected = asyncio.ensure_future(receive())
+    event = None
+    try:
+        while not subscription.overflow:
+            if event is None:
+                event = asyncio.ensure_future(subscription.get(KEEPALIVE))
+            done, _ = await asyncio.wait({event, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                if disconnected.result()['type'] == 'http.disconnect':
+                    return
+                disconnected = asyncio.ensure_future(receive())
+            if event in done:
+                message, event = event.result(), None
+                body = format_event(message) if message is not None else b': ping\n\n'
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        logger.info('events client too slow, closing stream')
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        disconnected.cancel()
+        if event is not None:
+            event.cancel()
+        subscription.close()
@@ -0,0 +1,123 @@
+"""
+Фасетный просмотр книг: фильтры по жанрам, автору, владельцу и статусу и число книг для каждого значения фильтра.
+
+Значения одного фильтра объединяются через ИЛИ (?genre=1&genre=2 - книги любого из жанров),
+разные фильтры - через И. Счетчики фасета считаются со всеми фильтрами, кроме его собственного:
+выбрав жанр, пользователь по-прежнему видит, сколько книг в остальных жанрах.
+На фасет - один запрос с GROUP BY, результат кэшируется по сочетанию фильтров до изменения каталога.
+
+Персонал видит книги во всех статусах, остальные пользователи, как и в list_book, - только доступные:
+ограничение накладывается на выдачу и на все фасеты, в том числе на счетчики статусов.
+"""
+from django.db import connection
+from django.db.models import Count
+from rest_framework.exceptions import ValidationError
+
+from bookcross.cache import get_or_build
+from bookcross.models import BookInstance
+
+FACETS = ('genre', 'author', 'owner', 'status')
+FACET_LIMIT = 50  # значений в фасете, самые частые
+PUBLIC_STATUSES = ('a',)
+# (genre_id, bookinstance_id): фильтр по жанру и счетчик жанров без обращения к таблице книг.
+# У автоматической промежуточной таблицы M2M нет Meta.indexes - индекс создается после migrate
+GENRE_INDEX = 'bookcross_book_genre_genre_book_idx'
+
+
+def create_browse_indexes(**kwargs):
+    through = BookInstance.genre.through._meta
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(through.get_field(name).column) for name in ('genre', 'bookinstance'))
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {qn(GENRE_INDEX)} ON {qn(through.db_table)} ({columns})')
+
+
+def get_statuses(user):
+    """
+    Статусы книг, которые видит пользователь: None - все
+    """
+    return None if user.is_staff else PUBLIC_STATUSES
+
+
+def visible_books(statuses):
+    books = BookInstance.objects.all()
+    return books if statuses is None else books.filter(status__in=statuses)
+
+
+def parse_filters(params, statuses=None):
+    """
+    {фасет: отсортированный кортеж значений} из ?genre=1&genre=2&author=3&owner=4&status=a,
+    statuses - допустимые значения status (None - любые)
+    """
+    statuses = dict(BookInstance.LOAN_STATUS) if statuses is None else statuses
+    filters, errors = {}, {}
+    for name in FACETS:
+        values = [value for value in params.getlist(name) if value]
+        if name == 'status':
+            invalid = [value for value in values if value not in statuses]
+        else:
+            invalid = [value for value in values if not value.isdigit()]
+            values = [int(value) for value in values if value.isdigit()]
+        if invalid:
+            errors[name] = [f'Неверные значения: {", ".join(invalid)}']
+        if values:
+            filters[name] = tuple(sorted(set(values)))
+    if errors:
+        raise ValidationError(errors)
+    return filters
+
+
+def filter_books(queryset, filters, exclude=None):
+    for name, values in filters.items():
+        if name == exclude:
+            continue
+        if name == 'genre':
+            # подзапрос, а не JOIN: книга с двумя выбранными жанрами не попадет в выдачу дважды
+            through = BookInstance.genre.through.objects.filter(genre_id__in=values)
+            queryset = queryset.filter(pk__in=through.values('bookinstance_id'))
+        else:
+            queryset = queryset.filter(**{f'{name}__in': values})
+    return queryset
+
+
+def facet_items(rows, filters, name, label):
+    selected = set(filters.get(name, ()))
+    return [{'value': row[name], 'label': label(row), 'count': row['count'], 'selected': row[name] in selected}
+            for row in rows]
+
+
+def facet_counts(filters, statuses=None):
+    """
+    {фасет: [{'value', 'label', 'count', 'selected'}, ...]} - по запросу GROUP BY на фасет
+    """
+    books = visible_books(statuses).order_by()
+
+    def others(name):
+        return filter_books(books, filters, exclude=name)
+
+    genres = (BookInstance.genre.through.objects.filter(bookinstance_id__in=others('genre').values('pk'))
+              .values('genre', 'genre__name').annotate(count=Count('bookinstance')).order_by('-count', 'genre__name'))
+    authors = (others('author').exclude(author=None)
+               .values('author', 'author__last_name', 'author__first_name').annotate(count=Count('pk'))
+               .order_by('-count', 'author__last_name'))
+    owners = (others('owner').values('owner', 'owner__username').annotate(count=Count('pk'))
+              .order_by('-count', 'owner__username'))
+    statuses = others('status').values('status').annotate(count=Count('pk')).order_by('-count', 'status')
+    names = dict(BookInstance.LOAN_STATUS)
+    return {
+        'genre': facet_items(genres[:FACET_LIMIT], filters, 'genre', lambda row: row['genre__name']),
+        'author': facet_items(authors[:FACET_LIMIT], filters, 'author',
+                              lambda row: f'{row["author__last_name"]}, {row["author__first_name"]}'),
+        'owner': facet_items(owners[:FACET_LIMIT], filters, 'owner', lambda row: row['owner__username']),
+        'status': facet_items(statuses, filters, 'status', lambda row: names.get(row['status'], row['status'])),
+    }
+
+
+def scope_key(statuses):
+    return 'all' if statuses is None else ','.join(statuses)
+
+
+def get_facet_counts(filters, statuses=None):
+    # ключ - видимые статусы и сочетание фильтров, одно на все страницы и наборы полей выдачи
+    key = '&'.join(f'{name}={",".join(map(str, values))}' for name, values in sorted(filters.items()))
+    return get_or_build('browse_facets', [scope_key(statuses), key], lambda: facet_counts(filters, statuses))
@@ -1,6 +1,9 @@
 from django import forms
+from django.contrib.auth import get_user_model
 
-from .models import BookInstance
+from .models import BookInstance, clean_loan_fields
+
+User = get_user_model()
 
 
 class BookInstanceForm(forms.ModelForm):
@@ -9,16 +12,11 @@ class BookInstanceForm(forms.ModelForm):
         fields = '__all__'
 
     def clean(self):
-        cd = self.cleaned_data
-        status = cd.get('status')
-        loaner = cd.get('loaner')
-        reserved_time = cd.get('reserved_time')
-        if status == 'o' and loaner is None:
-            raise forms.ValidationError('Выбран статус В аренде, при этом не указан Заёмщик')
-        if status == 'r' and loaner is None:
-            raise forms.ValidationError('Выбран статус Зарезервирована, при этом не указан Заёмщик')
-        if status in ['m', 'a', 'x'] and loaner is not None:
-            cd['loaner'] = None
-            cd['reserved_time'] = None
-            # raise forms.ValidationError('При данном статусе заемщика быть не должно!')
-        return cd
+        return clean_loan_fields(self.cleaned_data)
+
+
+class BookImportForm(forms.Form):
+    file = forms.FileField(label='Файл', help_text='CSV или JSON Lines: title, author, genres, summary, isbn, status')
+    owner = forms.ModelChoiceField(User.objects.all(), label='Владелец',
+                                   help_text='Владелец книг, у которых в файле он не указан')
+    dry_run = forms.BooleanField(label='Только проверить', required=False)
@@ -0,0 +1,200 @@
+"""
+Срок хранения истории перемещений книг (CrossHistory).
+
+Записи старше срока хранения (целых месяцев) сворачиваются в помесячные итоги по книге - CrossHistoryMonth:
+смены статуса, выдачи, резервы и дни в аренде. Сами записи сначала целиком выгружаются в архив JSON Lines
+со сжатием gzip, а после его закрытия удаляются пачками книг: каждая пачка - итоги и удаление
+в одной короткой транзакции.
+Таблица истории остается маленькой, статистика книги - в итогах, исходные строки - в архиве.
+
+Дни в аренде считаются от выдачи (новый статус 'o') до следующей смены статуса. Аренда, не закончившаяся
+к границе срока, считается до границы, а остаток - при следующем запуске от первого дня после последнего
+месяца итогов книги.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from bookcross.importer import chunks
+from bookcross.models import BookInstance, CrossHistory, CrossHistoryMonth
+
+logger = logging.getLogger('bookcross.history')
+
+RetentionResult = namedtuple('RetentionResult', ['archived', 'months', 'batches', 'path', 'duration'])
+BATCH_SIZE = 200  # книг на транзакцию
+ROLLUP_FIELDS = ('changes', 'loans', 'reservations', 'loan_days')
+ARCHIVE_FIELDS = ('id', 'book_id', 'create_date', 'loaner_id', 'comment', 'old_status', 'new_status')
+_codes = [code for code, _ in BookInstance.LOAN_STATUS]
+# у старых записей статусы только в тексте комментария
+COMMENT_STATUSES = {BookInstance.status_change_comment(old, new): (old, new) for old in _codes for new in _codes}
+
+
+def get_retention_months():
+    return getattr(settings, 'BOOKCROSS_HISTORY_RETENTION_MONTHS', 12)
+
+
+def get_archive_dir():
+    return getattr(settings, 'BOOKCROSS_HISTORY_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive', 'history'))
+
+
+def add_months(day, months):
+    """
+    Первое число месяца, отстоящего от месяца day на months
+    """
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def retention_cutoff(months, today=None):
+    """
+    Граница срока хранения: первое число месяца months месяцев назад, все записи раньше нее сворачиваются
+    """
+    return add_months(today or timezone.localdate(), -months)
+
+
+def row_statuses(row):
+    if row['new_status']:
+        return row['old_status'], row['new_status']
+    return COMMENT_STATUSES.get(row['comment'], (None, None))
+
+
+def add_loan_days(months, start, end):
+    # дни [start, end) по месяцам
+    while start < end:
+        next_month = add_months(start, 1)
+        months[start.replace(day=1)]['loan_days'] += (min(end, next_month) - start).days
+        start = next_month
+
+
+def summarize(rows, cutoff, loan_since=None):
+    """
+    Итоги по месяцам {первое число: {поле: значение}} для записей одной книги, упорядоченных по дате.
+    loan_since - с какого дня считать аренду, если книга была выдана еще до первой записи
+    """
+    months = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    loaned = None
+    for i, row in enumerate(rows):
+        old, new = row_statuses(row)
+        day = row['create_date']
+        month = months[day.replace(day=1)]
+        month['changes'] += 1
+        if old == 'o':
+            start = loaned or (loan_since if i == 0 else None)
+            if start is not None:
+                add_loan_days(months, start, day)
+            loaned = None
+        if new == 'o':
+            month['loans'] += 1
+            loaned = day
+        elif new == 'r':
+            month['reservations'] += 1
+    if loaned is not None:
+        add_loan_days(months, loaned, cutoff)
+    return months
+
+
+def save_rollups(book_months):
+    """
+    Прибавляет итоги {id книги: {месяц: {поле: значение}}} к существующим строкам CrossHistoryMonth
+    """
+    existing = {}
+    for part in chunks(book_months):
+        for rollup in CrossHistoryMonth.objects.filter(book_id__in=part):
+            existing[rollup.book_id, rollup.month] = rollup
+    created, updated = [], []
+    for book_id, months in book_months.items():
+        for month, values in months.items():
+            rollup = existing.get((book_id, month))
+            if rollup is None:
+                created.append(CrossHistoryMonth(book_id=book_id, month=month, **values))
+                continue
+            for name, value in values.items():
+                setattr(rollup, name, getattr(rollup, name) + value)
+            updated.append(rollup)
+    CrossHistoryMonth.objects.bulk_create(created, batch_size=BATCH_SIZE)
+    CrossHistoryMonth.objects.bulk_update(updated, ROLLUP_FIELDS, batch_size=BATCH_SIZE)
+    return len(created) + len(updated)
+
+
+def batch_rows(old, part):
+    # записи без книги (книга удалена до каскада) только архивируются
+    books = Q(book_id__in=[pk for pk in part if pk is not None])
+    if None in part:
+        books |= Q(book=None)
+    return list(old.filter(books).order_by('book_id', 'create_date', 'id').values(*ARCHIVE_FIELDS))
+
+
+def write_archive(path, old, book_ids, batch_size):
+    """
+    Пишет записи old в path и возвращает множество их id. Файл собирается под временным именем
+    и переименовывается только после закрытия gzip и fsync: оборванный запуск не оставит архив без трейлера,
+    а записи удаляются только после этого
+    """
+    archived_ids = set()
+    temp_path = f'{path}.tmp'
+    try:
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as archive:
+            for part in chunks(book_ids, batch_size):
+                for row in batch_rows(old, part):
+                    archive.write(json.dumps(row, default=str, ensure_ascii=False) + '\n')
+                    archived_ids.add(row['id'])
+        with open(temp_path, 'rb') as archive:
+            os.fsync(archive.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return archived_ids
+
+
+def archive_history(cutoff, directory=None, batch_size=BATCH_SIZE):
+    """
+    Сворачивает, архивирует и удаляет записи истории с датой раньше cutoff (приводится к первому числу месяца).
+    Архив - один файл crosshistory-<граница>-<время запуска>.jsonl.gz на запуск
+    """
+    started = time.monotonic()
+    cutoff = cutoff.replace(day=1)
+    old = CrossHistory.objects.filter(create_date__lt=cutoff).order_by()
+    book_ids = list(old.values_list('book_id', flat=True).distinct())
+    if not book_ids:
+        return RetentionResult(0, 0, 0, None, time.monotonic() - started)
+
+    directory = directory or get_archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'crosshistory-{cutoff:%Y-%m}-{timezone.now():%Y%m%d%H%M%S}.jsonl.gz')
+    archived_ids = write_archive(path, old, book_ids, batch_size)
+
+    months = batches = 0
+    for part in chunks(book_ids, batch_size):
+        # удаляются только строки, уже попавшие в закрытый архив
+        rows = [row for row in batch_rows(old, part) if row['id'] in archived_ids]
+        by_book = defaultdict(list)
+        for row in rows:
+            if row['book_id'] is not None:
+                by_book[row['book_id']].append(row)
+        with transaction.atomic():
+            last_months = dict(CrossHistoryMonth.objects.filter(book_id__in=list(by_book)).order_by()
+                               .values('book_id').annotate(last=Max('month')).values_list('book_id', 'last'))
+            book_months = {book_id: summarize(book_rows, cutoff, loan_since=(
+                add_months(last_months[book_id], 1) if book_id in last_months else None))
+                for book_id, book_rows in by_book.items()}
+            months += save_rollups(book_months)
+            for ids in chunks([row['id'] for row in rows]):
+                CrossHistory.objects.filter(pk__in=ids).delete()
+        batches += 1
+    archived = len(archived_ids)
+
+    result = RetentionResult(archived, months, batches, path, time.monotonic() - started)
+    logger.info('history retention: archived=%d months=%d batches=%d path=%s duration=%.3fs', *result,
+                extra={'archived': archived, 'months': months, 'batches': batches, 'duration': result.duration})
+    return result
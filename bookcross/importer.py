@@ -0,0 +1,268 @@
+"""
+Массовый импорт книг из CSV или JSON Lines.
+
+Файл читается построчно, книги пишутся пачками по chunk_size: bulk_create книг и строк M2M жанров
+в одной транзакции на пачку. Авторы и жанры ищутся по имени через словарь в памяти,
+так что каждое новое имя попадает в БД один раз.
+
+Колонки (ключи JSON): title, author ("Фамилия, Имя"), genres (через ";" или список в JSON),
+summary, isbn, status, owner (логин, по умолчанию - владелец из параметров импорта).
+"""
+import csv
+import io
+import json
+import os
+import time
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from bookcross.cache import bump_catalog_version
+from bookcross.models import Author, BookInstance, Genre, validate_status_loaner
+from bookcross.search import index_books
+
+User = get_user_model()
+
+ImportResult = namedtuple('ImportResult', ['rows', 'created', 'skipped', 'errors', 'authors_created',
+                                           'genres_created', 'duration'])
+CHUNK_SIZE = 1000
+MAX_ERRORS = 100
+STATUSES = dict(BookInstance.LOAN_STATUS)
+
+
+def read_rows(stream, fmt):
+    """
+    Генератор (номер строки, словарь) по текстовому потоку stream в формате csv или jsonl
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                yield number, None
+
+
+def chunks(values, size=500):
+    # IN (...) по частям: у SQLite ограничено число параметров запроса
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def text(row, key):
+    value = row.get(key)
+    return '' if value is None else str(value).strip()
+
+
+def detect_format(name):
+    return 'csv' if name.lower().endswith('.csv') else 'jsonl'
+
+
+def split_author(value):
+    last_name, _, first_name = value.partition(',')
+    return last_name.strip()[:100], first_name.strip()[:100]
+
+
+def split_genres(value):
+    if isinstance(value, (list, tuple)):
+        names = [str(name) for name in value]
+    else:
+        names = (value or '').split(';')
+    return list(dict.fromkeys(name.strip()[:200] for name in names if name and name.strip()))
+
+
+def load_progress(path, source):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        progress = json.load(f)
+    return progress['line'] if progress.get('source') == source else 0
+
+
+def save_progress(path, source, line):
+    if not path:
+        return
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'source': source, 'line': line}, f)
+    os.replace(tmp, path)  # файл прогресса не остается наполовину записанным
+
+
+def insert_genres(pairs):
+    """
+    Строки M2M (книга, жанр) одним executemany: модели промежуточной таблицы на сотни тысяч строк
+    обходятся дороже самой вставки
+    """
+    if not pairs:
+        return
+    through = BookInstance.genre.through._meta
+    book_field, genre_field = through.get_field('bookinstance'), through.get_field('genre')
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {qn(through.db_table)} ({qn(book_field.column)}, {qn(genre_field.column)}) VALUES (%s, %s)',
+            [(book_field.get_db_prep_save(book_id, connection), genre_id) for book_id, genre_id in pairs])
+
+
+class BookImporter:
+    """
+    importer = BookImporter(owner)
+    result = importer.run(stream, 'csv', progress='import.progress', source='books.csv')
+    """
+
+    def __init__(self, owner, chunk_size=CHUNK_SIZE, dry_run=False):
+        self.owner = owner
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.authors = {}
+        self.genres = {}
+        self.owners = {owner.username: owner.pk}
+        self.authors_created = self.genres_created = 0
+
+    def parse(self, row):
+        """
+        Проверяет строку файла, возвращает (поля книги, автор, жанры, логин владельца)
+        """
+        if not isinstance(row, dict):
+            raise ValidationError('Строка не разбирается')
+        title = text(row, 'title')
+        if not title:
+            raise ValidationError('Не указано название')
+        status = text(row, 'status') or 'a'
+        if status not in STATUSES:
+            raise ValidationError(f'Неизвестный статус {status}')
+        # при импорте заемщик не указывается
+        validate_status_loaner(status, None)
+        isbn = text(row, 'isbn') or None
+        if isbn and len(isbn) > 13:
+            raise ValidationError(f'ISBN длиннее 13 символов: {isbn}')
+        fields = {'title': title[:200], 'summary': text(row, 'summary')[:1000], 'isbn': isbn, 'status': status}
+        author = split_author(text(row, 'author'))
+        return fields, author if author[0] else None, split_genres(row.get('genres')), text(row, 'owner') or None
+
+    def resolve_authors(self, names):
+        missing = {name for name in names if name not in self.authors}
+        if not missing:
+            return
+        for part in chunks({last_name for last_name, _ in missing}):
+            for pk, last_name, first_name in Author.objects.filter(last_name__in=part).values_list(
+                    'pk', 'last_name', 'first_name'):
+                self.authors.setdefault((last_name, first_name), pk)
+        new = {name for name in missing if name not in self.authors}
+        self.authors_created += len(new)
+        if self.dry_run:
+            self.authors.update((name, None) for name in new)
+        elif new:
+            # pk после bulk_create известен не на всех БД - перечитываем созданных
+            Author.objects.bulk_create([Author(last_name=last, first_name=first) for last, first in new])
+            for part in chunks({last for last, _ in new}):
+                created = Author.objects.filter(last_name__in=part).order_by('-pk')
+                for pk, last_name, first_name in created.values_list('pk', 'last_name', 'first_name'):
+                    if (last_name, first_name) in new:
+                        self.authors.setdefault((last_name, first_name), pk)
+
+    def resolve_genres(self, names):
+        missing = {name for name in names if name not in self.genres}
+        if not missing:
+            return
+        for part in chunks(missing):
+            for pk, name in Genre.objects.filter(name__in=part).values_list('pk', 'name'):
+                self.genres.setdefault(name, pk)
+        new = [name for name in missing if name not in self.genres]
+        self.genres_created += len(new)
+        if self.dry_run:
+            self.genres.update((name, None) for name in new)
+        elif new:
+            Genre.objects.bulk_create([Genre(name=name) for name in new])
+            for part in chunks(new):
+                for pk, name in Genre.objects.filter(name__in=part).order_by('-pk').values_list('pk', 'name'):
+                    self.genres.setdefault(name, pk)
+
+    def resolve_owners(self, usernames):
+        for part in chunks({name for name in usernames if name not in self.owners}):
+            self.owners.update(User.objects.filter(username__in=part).values_list('username', 'pk'))
+
+    def write_chunk(self, chunk, errors):
+        """
+        Сохраняет пачку разобранных строк, возвращает id созданных книг
+        """
+        self.resolve_authors({author for _, _, author, _, _ in chunk if author})
+        self.resolve_genres({genre for _, _, _, genres, _ in chunk for genre in genres})
+        self.resolve_owners({owner for _, _, _, _, owner in chunk if owner})
+        books, through = [], []
+        for line, fields, author, genres, owner in chunk:
+            owner_id = self.owners.get(owner) if owner else self.owner.pk
+            if owner_id is None:
+                errors.append((line, f'Нет пользователя {owner}'))
+                continue
+            book = BookInstance(author_id=self.authors[author] if author else None, owner_id=owner_id, **fields)
+            books.append(book)
+            through += [(book.pk, self.genres[name]) for name in genres]
+        if self.dry_run:
+            return [book.pk for book in books]
+        with transaction.atomic():
+            BookInstance.objects.bulk_create(books, batch_size=self.chunk_size)
+            insert_genres(through)
+        book_ids = [book.pk for book in books]
+        index_books(book_ids, new=True)
+        return book_ids
+
+    def run(self, stream, fmt, progress=None, source=''):
+        """
+        Импортирует книги из stream. С progress номер последней записанной строки сохраняется в файл,
+        и повторный запуск с тем же source продолжает с нее
+        """
+        started = time.monotonic()
+        skip_to = 0 if self.dry_run else load_progress(progress, source)
+        rows = created = 0
+        errors, chunk = [], []
+
+        def flush(line):
+            nonlocal created
+            created += len(self.write_chunk(chunk, errors))
+            chunk.clear()
+            if not self.dry_run:
+                save_progress(progress, source, line)
+
+        line = skip_to
+        for line, row in read_rows(stream, fmt):
+            if line <= skip_to:
+                continue
+            rows += 1
+            try:
+                chunk.append((line, *self.parse(row)))
+            except ValidationError as e:
+                errors.append((line, '; '.join(e.messages)))
+            if len(chunk) >= self.chunk_size:
+                flush(line)
+        flush(line)
+        if created and not self.dry_run:
+            transaction.on_commit(bump_catalog_version)
+        return ImportResult(rows=rows, created=created, skipped=rows - created, errors=errors[:MAX_ERRORS],
+                            authors_created=self.authors_created, genres_created=self.genres_created,
+                            duration=time.monotonic() - started)
+
+
+def import_books(file, owner, fmt=None, **kwargs):
+    """
+    Импорт из пути к файлу или загруженного файла (бинарного потока с атрибутом name)
+    """
+    progress = kwargs.pop('progress', None)
+    name = file if isinstance(file, str) else file.name
+    fmt = fmt or detect_format(name)
+    importer = BookImporter(owner, **kwargs)
+    if isinstance(file, str):
+        with open(file, encoding='utf-8-sig', newline='') as stream:
+            return importer.run(stream, fmt, progress=progress, source=os.path.abspath(file))
+    stream = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        return importer.run(stream, fmt, progress=progress, source=name)
+    finally:
+        stream.detach()
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.history import BATCH_SIZE, archive_history, get_retention_months, retention_cutoff
+
+
+class Command(BaseCommand):
+    help = ('Сворачивает историю перемещений старше срока хранения в итоги по месяцам, '
+            'выгружает ее в архив jsonl.gz и удаляет (запускать по расписанию)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=None,
+                            help='Срок хранения подробной истории, месяцев (по умолчанию из настроек)')
+        parser.add_argument('--dir', default=None, help='Каталог архива (по умолчанию из настроек)')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Книг на транзакцию')
+
+    def handle(self, *args, **options):
+        months = options['months'] if options['months'] is not None else get_retention_months()
+        result = archive_history(retention_cutoff(months), options['dir'], batch_size=options['batch_size'])
+        self.stdout.write(f'Записей в архиве: {result.archived}, итогов по месяцам: {result.months}, '
+                          f'пачек: {result.batches}, время: {result.duration:.3f} с')
+        if result.path:
+            self.stdout.write(self.style.SUCCESS(f'Архив: {result.path}'))
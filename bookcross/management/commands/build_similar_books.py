@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.recommendations import build_similar_books
+
+
+class Command(BaseCommand):
+    help = 'Рассчитывает похожие книги по оценкам и избранному (запускать по расписанию)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=20, help='Сколько соседей хранить для каждой книги')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Пересчитать только книги, измененные после прошлого расчета')
+
+    def handle(self, *args, **options):
+        stats = build_similar_books(top_k=options['top_k'], incremental=options['incremental'])
+        peak = f'{stats.peak_rss / 2 ** 20:.1f} МБ' if stats.peak_rss else 'н/д'
+        self.stdout.write(
+            f'Книг: {stats.books}, пользователей: {stats.users}, взаимодействий: {stats.interactions}\n'
+            f'Пересчитано книг: {stats.refreshed}, сохранено соседей: {stats.neighbours}\n'
+            f'Время: {stats.duration:.2f} с, матрица: {stats.matrix_bytes / 2 ** 20:.1f} МБ, '
+            f'пик памяти процесса: {peak}')
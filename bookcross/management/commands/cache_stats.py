@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.cache import cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Показывает попадания и промахи кэша списка книг'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Обнулить счетчики')
+
+    def handle(self, *args, **options):
+        stats = cache_stats()
+        self.stdout.write(f'Версия каталога: {stats["version"]}\n'
+                          f'Попаданий: {stats["hits"]}, промахов: {stats["misses"]}, '
+                          f'доля попаданий: {stats["hit_ratio"]:.1%}')
+        if options['reset']:
+            reset_cache_stats()
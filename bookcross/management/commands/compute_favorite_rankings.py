@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.models import compute_favorite_rankings
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинг самых популярных в избранном книг за неделю и месяц (запускать по расписанию)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=50, help='Сколько книг хранить для каждого периода')
+
+    def handle(self, *args, **options):
+        count = compute_favorite_rankings(limit=options['limit'])
+        self.stdout.write(self.style.SUCCESS(f'Сохранено мест в рейтинге: {count}'))
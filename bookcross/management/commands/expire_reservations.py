@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from bookcross.services import expire_reservations
+
+
+class Command(BaseCommand):
+    help = 'Снимает просроченные резервы книг (однократно или в цикле с --loop)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Запускать проверку постоянно')
+        parser.add_argument('--interval', type=int, default=60, help='Пауза между проверками, секунд')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        while True:
+            result = expire_reservations(batch_size=options['batch_size'])
+            self.stdout.write(f'Снято резервов: {result.expired}, пачек: {result.batches}, '
+                              f'время: {result.duration:.3f} с')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.dataset import PASSWORD, USERNAME_PREFIX, generate_dataset
+
+
+class Command(BaseCommand):
+    help = 'Заполняет базу синтетическими данными для замеров производительности'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--books', type=int, default=1000, help='Количество книг, остальное считается от него')
+        parser.add_argument('--users', type=int, help='По умолчанию books / 10')
+        parser.add_argument('--authors', type=int, help='По умолчанию books / 5')
+        parser.add_argument('--ratings-per-user', type=int, default=10)
+        parser.add_argument('--favorites-per-user', type=int, default=3)
+        parser.add_argument('--seed', type=int, help='Одинаковый seed - одинаковые данные')
+
+    def handle(self, *args, **options):
+        result = generate_dataset(books=options['books'], users=options['users'], authors=options['authors'],
+                                  ratings_per_user=options['ratings_per_user'],
+                                  favorites_per_user=options['favorites_per_user'], seed=options['seed'])
+        self.stdout.write(
+            f'Пользователей: {result.users}, мест: {result.places}, авторов: {result.authors}, '
+            f'жанров: {result.genres}, книг: {result.books}, оценок: {result.ratings}, '
+            f'избранного: {result.favorites}, записей истории: {result.history}\n'
+            f'Время: {result.duration:.1f} с. Логины {USERNAME_PREFIX}*, пароль {PASSWORD}')
@@ -0,0 +1,41 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from account.models import Profile
+from bookcross.models import BookInstance, mark_cover_thumbnails
+from bookcross.thumbnails import build_targets, has_thumbnails, render_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Создает уменьшенные копии для уже загруженных обложек книг и аватаров (параллельно)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'THUMBNAIL_WORKERS', 2) or 1)
+        parser.add_argument('--force', action='store_true', help='Пересоздать уже существующие копии')
+
+    def handle(self, *args, **options):
+        covers = set(BookInstance.objects.exclude(cover='').values_list('cover', flat=True))
+        names = covers | set(Profile.objects.exclude(photo='').values_list('photo', flat=True))
+        ready = set()
+        if not options['force']:
+            ready = {name for name in names if has_thumbnails(name)}
+            names -= ready
+
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=get_context('spawn')) as executor:
+            futures = {executor.submit(render_thumbnails, default_storage.path(name), build_targets(name)): name
+                       for name in sorted(names)}
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    ready.add(futures[future])
+                    done += 1
+                else:
+                    failed += 1
+                    self.stderr.write(f'{futures[future]}: {future.exception()}')
+        # и книги, у которых копии уже были на диске, но флаг еще не стоит
+        mark_cover_thumbnails(ready & covers)
+        self.stdout.write(self.style.SUCCESS(f'Готово: {done}, ошибок: {failed}'))
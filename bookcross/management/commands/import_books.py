@@ -0,0 +1,30 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from bookcross.importer import CHUNK_SIZE, import_books
+
+
+class Command(BaseCommand):
+    help = 'Импортирует книги из CSV или JSON Lines файла пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='Путь к .csv или .jsonl файлу')
+        parser.add_argument('--owner', required=True, help='Логин владельца книг, если в строке он не указан')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='По умолчанию - по расширению файла')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--progress', help='Файл прогресса: повторный запуск продолжит с места остановки')
+        parser.add_argument('--dry-run', action='store_true', help='Только проверить файл, ничего не записывая')
+
+    def handle(self, *args, **options):
+        try:
+            owner = get_user_model().objects.get(username=options['owner'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f'Нет пользователя {options["owner"]}')
+        result = import_books(options['file'], owner, fmt=options['format'], chunk_size=options['chunk_size'],
+                              progress=options['progress'], dry_run=options['dry_run'])
+        for line, message in result.errors:
+            self.stderr.write(f'Строка {line}: {message}')
+        prefix = 'Проверка (без записи). ' if options['dry_run'] else ''
+        self.stdout.write(f'{prefix}Строк: {result.rows}, книг: {result.created}, пропущено: {result.skipped}, '
+                          f'новых авторов: {result.authors_created}, новых жанров: {result.genres_created}, '
+                          f'время: {result.duration:.2f} с')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bookcross.cache import bump_catalog_version
+from bookcross.models import update_favorite_counts
+
+
+class Command(BaseCommand):
+    help = 'Сверяет счетчики избранного у книг (favorite_count) с таблицей Favorite'
+
+    def handle(self, *args, **options):
+        updated = update_favorite_counts()
+        transaction.on_commit(bump_catalog_version)
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано избранное у {updated} книг'))
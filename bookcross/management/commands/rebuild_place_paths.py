@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.models import rebuild_place_paths
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает материализованные пути (path, full_path, depth) всех мест хранения'
+
+    def handle(self, *args, **options):
+        count = rebuild_place_paths()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитаны пути {count} мест'))
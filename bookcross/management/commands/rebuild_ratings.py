@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from bookcross.cache import bump_catalog_version
+from bookcross.models import update_book_ratings
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сохраненные рейтинги книг (rating_avg, rating_count) по таблице BookRating'
+
+    def handle(self, *args, **options):
+        updated = update_book_ratings()
+        transaction.on_commit(bump_catalog_version)
+        self.stdout.write(self.style.SUCCESS(f'Пересчитаны рейтинги {updated} книг'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from bookcross.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Пересоздает полнотекстовый индекс книг (SQLite FTS5)'
+
+    def handle(self, *args, **options):
+        count = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Проиндексировано {count} книг'))
@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from bookcross.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Замеряет основные страницы и выводит результат в JSON (сравнивать между запусками)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Запросов к каждой странице')
+        parser.add_argument('--warmup', type=int, default=2, help='Запросов для прогрева перед замером')
+        parser.add_argument('--output', help='Записать JSON в файл вместо вывода')
+
+    def handle(self, *args, **options):
+        report = json.dumps(run_benchmarks(repeat=options['repeat'], warmup=options['warmup']),
+                            ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
@@ -2,8 +2,17 @@ import datetime
 import uuid
 
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Avg, Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Concat, Substr
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
 from django.urls import reverse
+from django.utils import timezone
+
+from bookcross.events import publish_status_changes
+from bookcross.thumbnails import ensure_thumbnails, get_srcset
 
 # Create your models here.
 User = get_user_model()
@@ -11,6 +20,29 @@ User = get_user_model()
 MAX_RESERVED_TIME = datetime.timedelta(hours=24)
 
 
+def validate_status_loaner(status, loaner):
+    """
+    Статусы В аренде и Зарезервирована требуют заемщика (общие правила для формы, админки и API)
+    """
+    if status == 'o' and loaner is None:
+        raise ValidationError('Выбран статус В аренде, при этом не указан Заёмщик')
+    if status == 'r' and loaner is None:
+        raise ValidationError('Выбран статус Зарезервирована, при этом не указан Заёмщик')
+
+
+def clean_loan_fields(data):
+    """
+    Правила BookInstanceForm.clean для словаря полей книги: проверка заемщика,
+    при статусах В ремонте / Доступна / Изьята заемщик и время резерва сбрасываются
+    """
+    validate_status_loaner(data.get('status'), data.get('loaner'))
+    if data.get('status') in ['m', 'a', 'x'] and data.get('loaner') is not None:
+        data['loaner'] = None
+        data['reserved_time'] = None
+        # raise forms.ValidationError('При данном статусе заемщика быть не должно!')
+    return data
+
+
 class BookInstance(models.Model):
     """
     Модель описывыет конкретный экземпляр книги
@@ -33,6 +65,16 @@ class BookInstance(models.Model):
                                help_text='Заемщик книги', related_name='loaner_books')
     place = models.ForeignKey('Place', verbose_name='Место хранения', on_delete=models.SET_NULL, null=True, blank=True)
     cover = models.ImageField(verbose_name='Обложка', upload_to="books/%Y/%m/%d", blank=True)
+    rating_avg = models.FloatField(verbose_name='Рейтинг', default=0, db_index=True, editable=False,
+                                   help_text='Средняя оценка, пересчитывается при изменении BookRating')
+    rating_count = models.PositiveIntegerField(verbose_name='Количество оценок', default=0, editable=False)
+    favorite_count = models.PositiveIntegerField(verbose_name='В избранном', default=0, editable=False,
+                                                 help_text='Сколько пользователей добавили книгу в избранное')
+    # меняется и при изменении автора, жанров и оценок книги - по нему строятся ETag / Last-Modified API
+    modified = models.DateTimeField(verbose_name='Изменена', auto_now=True, db_index=True)
+    # уменьшенные копии обложки готовы - ставит mark_cover_thumbnails после ресайза (вместе с modified),
+    # чтобы список, карточки и API не проверяли файлы в storage для каждой книги
+    cover_thumbnails = models.BooleanField(verbose_name='Копии обложки готовы', default=False, editable=False)
 
     LOAN_STATUS = (
         ('r', 'Зарезервирована'),
@@ -49,19 +91,40 @@ class BookInstance(models.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.old_status = self.status
+        # через __dict__, чтобы не подгружать отложенную (only) обложку
+        self.old_cover = self.cover_name()
 
     def __str__(self):
         return f'{self.id} {self.author} {self.title}'
 
+    def cover_name(self):
+        cover = self.__dict__.get('cover')
+        return getattr(cover, 'name', cover)
+
     def get_cover_url(self):
         if self.cover and hasattr(self.cover, 'url'):
             return self.cover.url
         return 'media/users/no_image.png'
 
+    def get_cover_srcset(self):
+        return get_srcset(self.cover.name) if self.cover_thumbnails else None
+
+    def has_thumbnails(self):
+        return self.cover_thumbnails
+
     class Meta:
-        ordering = ('author', 'title')
+        ordering = ('author', 'title', 'id')
         verbose_name = 'Экземпляр книги'
         verbose_name_plural = 'Книги'
+        indexes = [
+            # список доступных книг и постраничная выдача по ключу (author, title, id)
+            models.Index(fields=['status', 'author', 'title', 'id'], name='book_status_keyset_idx'),
+            # поиск просроченных резервов
+            models.Index(fields=['status', 'reserved_time'], name='book_status_reserved_idx'),
+            # фасетный просмотр (bookcross.facets): фильтр и GROUP BY по автору и владельцу
+            models.Index(fields=['author', 'status'], name='book_author_status_idx'),
+            models.Index(fields=['owner', 'status'], name='book_owner_status_idx'),
+        ]
 
     def get_absolute_url(self):
         return reverse('book-detail', args=[str(self.id)])
@@ -78,35 +141,26 @@ class BookInstance(models.Model):
         return 'Книга не зарезервирована'
 
     get_time_reserved.short_description = 'Время до конца резерва'
+    get_time_reserved.admin_order_field = 'reserved_time'
 
     @property
     def get_full_path(self):
-        pth = self.place.title
-        tmp = self.place
-        while tmp.parent_place is not None:
-            tmp = tmp.parent_place
-            pth = ' > '.join([tmp.title, pth])
-        return pth
+        return self.place.get_full_path()
 
     def get_rating(self):
-        rates = BookRating.objects.filter(book=self)
-        if not len(rates):
-            return 0
-        # print(rates)
-        return sum([int(r.rating) for r in rates]) / len(rates)
+        return self.rating_avg
 
-    def favorite_count(self):
-        return Favorite.objects.all().count()
+    @classmethod
+    def status_change_comment(cls, old_status, new_status):
+        lstat = dict(cls.LOAN_STATUS)
+        return f'Статус книги изменен c {lstat[old_status]} на {lstat[new_status]}'
 
     def save(self, *args, **kwargs):
         # print(self.status)
+        if 'cover' in self.__dict__ and self.cover_name() != self.old_cover:
+            self.cover_thumbnails = False
         if self.status != self.old_status:
-            lstat = dict(self.LOAN_STATUS)
-            ch = CrossHistory()
-            ch.book = self
-            ch.loaner = self.loaner
-            ch.comment = f'Статус книги изменен c {lstat[self.old_status]} на {lstat[self.status]}'
-            ch.save()
+            CrossHistory.status_change(self.pk, self.loaner_id, self.old_status, self.status).save()
 
             if self.status == 'o':
                 self.reserved_time = None
@@ -118,7 +172,50 @@ class BookInstance(models.Model):
         #     if self.reserved_time is None:
         #         print('Произошла смена времени резервирования')
 
-        return super().save(*args, **kwargs)
+        result = super().save(*args, **kwargs)
+        if self.status != self.old_status:
+            publish_status_changes([(self.pk, self.old_status, self.status)])
+            self.old_status = self.status
+        return result
+
+
+def mark_cover_thumbnails(names):
+    """
+    Копии обложек names готовы: флаг и modified (новый ключ карточки и ETag) одним UPDATE на пачку
+    """
+    from bookcross.cache import bump_catalog_version
+
+    names = list(names)
+    updated = 0
+    for i in range(0, len(names), 500):
+        updated += BookInstance.objects.filter(cover__in=names[i:i + 500], cover_thumbnails=False).update(
+            cover_thumbnails=True, modified=timezone.now())
+    if updated:
+        transaction.on_commit(bump_catalog_version)
+    return updated
+
+
+@receiver(pre_save, sender=User)
+def owner_renamed(sender, instance, update_fields=None, **kwargs):
+    """
+    Имя владельца и заемщика выводится в карточке и API, а ключ карточки и ETag строятся по modified книги
+    """
+    if instance.pk is None or (update_fields is not None and 'username' not in update_fields):
+        return
+    old = sender.objects.filter(pk=instance.pk).values_list('username', flat=True).first()
+    if old is not None and old != instance.username:
+        BookInstance.objects.filter(models.Q(owner=instance.pk) | models.Q(loaner=instance.pk)).update(
+            modified=timezone.now())
+
+
+@receiver(post_save, sender=BookInstance)
+def book_cover_saved(sender, instance, **kwargs):
+    instance.old_cover = instance.cover_name()
+    if instance.cover_thumbnails or not instance.cover:
+        return
+    name = instance.cover.name
+    # после коммита: UPDATE из потока пула не должен опередить саму книгу
+    transaction.on_commit(lambda: ensure_thumbnails(name, on_ready=mark_cover_thumbnails))
 
 
 class BookRating(models.Model):
@@ -146,6 +243,29 @@ class BookRating(models.Model):
         unique_together = ('book', 'user')
 
 
+def update_book_ratings(book_ids=None):
+    """
+    Пересчитывает rating_avg и rating_count одним UPDATE.
+    Без book_ids пересчитываются все книги.
+    """
+    rates = BookRating.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    books = BookInstance.objects.all()
+    if book_ids is not None:
+        books = books.filter(pk__in=book_ids)
+    return books.update(
+        rating_avg=Coalesce(Subquery(rates.annotate(avg=Avg(Cast('rating', IntegerField()))).values('avg')),
+                            Value(0.0)),
+        rating_count=Coalesce(Subquery(rates.annotate(cnt=Count('pk')).values('cnt')), Value(0)),
+        modified=timezone.now(),
+    )
+
+
+@receiver(post_save, sender=BookRating)
+@receiver(post_delete, sender=BookRating)
+def book_rating_changed(sender, instance, **kwargs):
+    update_book_ratings([instance.book_id])
+
+
 class Favorite(models.Model):
     book = models.ForeignKey('BookInstance', on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -158,6 +278,107 @@ class Favorite(models.Model):
         verbose_name = 'Унига помещенная в избранное'
         verbose_name_plural = 'Избранное'
         ordering = ('book', 'create_date')
+        indexes = [
+            # подсчет избранного за неделю/месяц для рейтинга
+            models.Index(fields=['create_date', 'book'], name='favorite_date_book_idx'),
+        ]
+        constraints = [
+            # цель ON CONFLICT в services.add_favorite и защита счетчика от двойного клика
+            models.UniqueConstraint(fields=['book', 'user'], name='favorite_book_user_uniq'),
+        ]
+
+
+def update_favorite_counts(book_ids=None):
+    """
+    Сверяет favorite_count с таблицей Favorite одним UPDATE. Без book_ids - для всех книг
+    """
+    favorites = Favorite.objects.filter(book=OuterRef('pk')).order_by().values('book')
+    books = BookInstance.objects.all()
+    if book_ids is not None:
+        books = books.filter(pk__in=book_ids)
+    return books.update(
+        favorite_count=Coalesce(Subquery(favorites.annotate(cnt=Count('pk')).values('cnt')), Value(0)),
+        modified=timezone.now(),
+    )
+
+
+@receiver(post_save, sender=Favorite)
+def favorite_added(sender, instance, created, **kwargs):
+    if created:
+        BookInstance.objects.filter(pk=instance.book_id).update(
+            favorite_count=F('favorite_count') + 1, modified=timezone.now())
+
+
+@receiver(post_delete, sender=Favorite)
+def favorite_removed(sender, instance, **kwargs):
+    BookInstance.objects.filter(pk=instance.book_id, favorite_count__gt=0).update(
+        favorite_count=F('favorite_count') - 1, modified=timezone.now())
+
+
+class FavoriteRanking(models.Model):
+    """
+    Самые популярные в избранном книги за период, пересчитывается командой compute_favorite_rankings
+    """
+    PERIODS = (
+        ('week', 'За неделю'),
+        ('month', 'За месяц'),
+    )
+    PERIOD_DAYS = {'week': 7, 'month': 30}
+
+    period = models.CharField('Период', max_length=5, choices=PERIODS)
+    position = models.PositiveSmallIntegerField('Место')
+    book = models.ForeignKey('BookInstance', on_delete=models.CASCADE, verbose_name='Книга')
+    count = models.PositiveIntegerField('Добавлений в избранное')
+    computed_at = models.DateTimeField('Рассчитано')
+
+    def __str__(self):
+        return f'{self.get_period_display()}: {self.position}. {self.book}'
+
+    class Meta:
+        ordering = ('period', 'position')
+        verbose_name = 'Место в рейтинге избранного'
+        verbose_name_plural = 'Рейтинг избранного'
+        unique_together = ('period', 'position')
+
+
+def compute_favorite_rankings(limit=50, today=None):
+    """
+    Пересчитывает FavoriteRanking по Favorite.create_date: одна группировка на период
+    """
+    today = today or timezone.now().date()
+    now = timezone.now()
+    rankings = []
+    for period, days in FavoriteRanking.PERIOD_DAYS.items():
+        top = (Favorite.objects.filter(create_date__gt=today - datetime.timedelta(days=days))
+               .values('book').annotate(count=Count('pk')).order_by('-count', 'book')[:limit])
+        rankings += [FavoriteRanking(period=period, position=position, book_id=row['book'], count=row['count'],
+                                     computed_at=now)
+                     for position, row in enumerate(top, 1)]
+    with transaction.atomic():
+        FavoriteRanking.objects.all().delete()
+        FavoriteRanking.objects.bulk_create(rankings)
+    return len(rankings)
+
+
+class SimilarBook(models.Model):
+    """
+    Похожие книги по оценкам и избранному (top-K соседей), рассчитываются командой build_similar_books
+    """
+    book = models.ForeignKey('BookInstance', on_delete=models.CASCADE, related_name='similar_books')
+    similar = models.ForeignKey('BookInstance', on_delete=models.CASCADE, related_name='+',
+                                verbose_name='Похожая книга')
+    score = models.FloatField('Сходство')
+    rank = models.PositiveSmallIntegerField('Место')
+    computed_at = models.DateTimeField('Рассчитано', db_index=True)
+
+    def __str__(self):
+        return f'{self.book_id} -> {self.similar_id} ({self.score:.3f})'
+
+    class Meta:
+        ordering = ('book', 'rank')
+        verbose_name = 'Похожая книга'
+        verbose_name_plural = 'Похожие книги'
+        unique_together = ('book', 'rank')
 
 
 class Author(models.Model):
@@ -168,6 +389,7 @@ class Author(models.Model):
     last_name = models.CharField('Фамилия', max_length=100)
     date_of_birth = models.DateField('Дата рождения', null=True, blank=True)
     date_of_death = models.DateField('Умер', null=True, blank=True)
+    modified = models.DateTimeField('Изменен', auto_now=True)
 
     def __str__(self):
         return f'{self.last_name}, {self.first_name}'
@@ -184,6 +406,7 @@ class Genre(models.Model):
     Модель описывающая жанры книг (Фантастика, Детектив и тд)
     """
     name = models.CharField(max_length=200, help_text='Все возможные жанры книг')
+    modified = models.DateTimeField('Изменен', auto_now=True)
 
     def __str__(self):
         return self.name
@@ -193,19 +416,92 @@ class Genre(models.Model):
         verbose_name_plural = 'Жанры'
 
 
+def touch_books(books):
+    """
+    Отмечает книги измененными, когда меняются связанные с ними данные
+    """
+    return books.update(modified=timezone.now())
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def book_relation_saved(sender, instance, created, **kwargs):
+    if not created:
+        touch_books(instance.bookinstance_set.all())
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def book_relation_deleting(sender, instance, **kwargs):
+    touch_books(instance.bookinstance_set.all())
+
+
+@receiver(m2m_changed, sender=BookInstance.genre.through)
+def book_genres_touched(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        if action == 'pre_clear':
+            touch_books(instance.bookinstance_set.all())
+        elif action in ('post_add', 'post_remove'):
+            touch_books(BookInstance.objects.filter(pk__in=pk_set))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        touch_books(BookInstance.objects.filter(pk=instance.pk))
+
+
 class CrossHistory(models.Model):
     book = models.ForeignKey('BookInstance', on_delete=models.CASCADE, default=None, null=True, verbose_name='Книга')
     create_date = models.DateField(auto_now_add=True, verbose_name='Дата создания', null=True)
     loaner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, verbose_name='Заемщик')
     comment = models.CharField(max_length=100, verbose_name='Описание', blank=True, null=True)
+    # у старых записей пусто, статусы есть только в comment (bookcross.history разбирает оба варианта)
+    old_status = models.CharField('Прежний статус', max_length=1, choices=BookInstance.LOAN_STATUS, blank=True,
+                                  default='')
+    new_status = models.CharField('Новый статус', max_length=1, choices=BookInstance.LOAN_STATUS, blank=True,
+                                  default='')
 
     def __str__(self):
         return f'{self.book}'
 
+    @classmethod
+    def status_change(cls, book_id, loaner_id, old_status, new_status):
+        """
+        Несохраненная запись о смене статуса книги - для save() и bulk_create
+        """
+        return cls(book_id=book_id, loaner_id=loaner_id, old_status=old_status, new_status=new_status,
+                   comment=BookInstance.status_change_comment(old_status, new_status))
+
     class Meta:
         ordering = ('book', 'create_date')
         verbose_name_plural = 'Истории перемещения книг'
         verbose_name = 'Перемещение книги'
+        indexes = [
+            # выборка записей старше срока хранения (bookcross.history)
+            models.Index(fields=['create_date'], name='history_date_idx'),
+        ]
+
+
+class CrossHistoryMonth(models.Model):
+    """
+    Итоги истории перемещений книги за месяц.
+    Подробная история старше срока хранения сворачивается в эти строки командой archive_history и удаляется
+    """
+    book = models.ForeignKey('BookInstance', on_delete=models.CASCADE, related_name='history_months',
+                             verbose_name='Книга')
+    month = models.DateField('Месяц')  # первое число месяца
+    changes = models.PositiveIntegerField('Смен статуса', default=0)
+    loans = models.PositiveIntegerField('Выдач', default=0)
+    reservations = models.PositiveIntegerField('Резервов', default=0)
+    loan_days = models.PositiveIntegerField('Дней в аренде', default=0)
+
+    def __str__(self):
+        return f'{self.month:%m.%Y}: {self.book}'
+
+    class Meta:
+        ordering = ('book', 'month')
+        verbose_name = 'Итоги истории за месяц'
+        verbose_name_plural = 'Итоги истории по месяцам'
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'month'], name='history_month_book_uniq'),
+        ]
 
 
 class Place(models.Model):
@@ -218,21 +514,91 @@ class Place(models.Model):
                                      blank=True,
                                      related_name="inside_places")
     end = models.BooleanField(verbose_name="Конечное место", default=False, help_text="Конечное место где стоят книги?")
+    # Материализованный путь: id всех предков и самого места, например "1/5/12/".
+    # Все вложенные места имеют path, начинающийся с path родителя.
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
+    full_path = models.CharField(verbose_name='Полный путь', max_length=1000, editable=False, default='')
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # через __dict__, чтобы не подгружать отложенные (only/defer) поля
+        self.old_tree = tuple(self.__dict__.get(f) for f in ('path', 'full_path', 'depth'))
 
     def __str__(self):
         return self.get_full_path()
 
     def get_full_path(self):
-        pth = self.title
-        tmp = self
-        while tmp.parent_place is not None:
-            tmp = tmp.parent_place
-            pth = ' > '.join([tmp.title, pth])
-        return pth
+        return self.full_path or self.title
 
     get_full_path.short_description = 'Находится в...'
+    get_full_path.admin_order_field = 'full_path'
+
+    @staticmethod
+    def subtree_lookup(path, prefix='path'):
+        """
+        Условия выборки места с путем path и всех вложенных в него мест.
+        Диапазон вместо LIKE, чтобы на любой БД работал индекс по path ('/' + 1 == '0')
+        """
+        return {f'{prefix}__gte': path, f'{prefix}__lt': path[:-1] + '0'}
+
+    def get_descendants(self, include_self=True):
+        places = Place.objects.filter(**self.subtree_lookup(self.path))
+        if not include_self:
+            places = places.exclude(pk=self.pk)
+        return places
+
+    def get_books(self):
+        """
+        Все книги, стоящие в этом месте или где угодно внутри него
+        """
+        return BookInstance.objects.filter(**self.subtree_lookup(self.path, 'place__path'))
+
+    def build_tree_fields(self, parent):
+        if parent is None:
+            return f'{self.pk}/', self.title, 0
+        return f'{parent.path}{self.pk}/', ' > '.join([parent.full_path, self.title]), parent.depth + 1
+
+    def clean(self):
+        parent = self.parent_place
+        if self.pk and parent is not None and parent.path.startswith(self.path or f'{self.pk}/'):
+            raise ValidationError({'parent_place': 'Нельзя поместить место внутрь самого себя'})
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        old_path, old_full_path, old_depth = self.old_tree
+        self.path, self.full_path, self.depth = self.build_tree_fields(self.parent_place)
+        if (self.path, self.full_path, self.depth) == self.old_tree:
+            return
+        Place.objects.filter(pk=self.pk).update(path=self.path, full_path=self.full_path, depth=self.depth)
+        if old_path:
+            # перенос или переименование: поддерево переписывается одним UPDATE
+            Place.objects.filter(**self.subtree_lookup(old_path)).exclude(pk=self.pk).update(
+                path=Concat(Value(self.path), Substr('path', len(old_path) + 1), output_field=models.CharField()),
+                full_path=Concat(Value(self.full_path), Substr('full_path', len(old_full_path) + 1),
+                                 output_field=models.CharField()),
+                depth=F('depth') + (self.depth - old_depth),
+            )
+        self.old_tree = (self.path, self.full_path, self.depth)
 
     class Meta:
         # ordering = ('title')
         verbose_name = 'Место (шкаф, полка, и тд)'
         verbose_name_plural = 'Места хранения книг'
+
+
+def rebuild_place_paths():
+    """
+    Заново вычисляет path, full_path и depth для всех мест (например, после загрузки старой базы)
+    """
+    places = {p.pk: p for p in Place.objects.only('id', 'title', 'parent_place_id')}
+    children = {}
+    for place in places.values():
+        children.setdefault(place.parent_place_id, []).append(place)
+    stack = [(place, None) for place in children.get(None, [])]
+    while stack:
+        place, parent = stack.pop()
+        place.path, place.full_path, place.depth = place.build_tree_fields(parent)
+        stack.extend((child, place) for child in children.get(place.pk, []))
+    Place.objects.bulk_update(places.values(), ['path', 'full_path', 'depth'], batch_size=500)
+    return len(places)
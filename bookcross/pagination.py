@@ -0,0 +1,129 @@
+import base64
+import binascii
+import json
+from functools import reduce
+from operator import and_, or_
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничная выдача по ключу (keyset/cursor).
+    Следующая страница выбирается условием WHERE (author, title, id) > (...) по индексу,
+    поэтому глубокие страницы не дороже первой, в отличие от OFFSET.
+    Курсор - непрозрачная base64 строка со значениями ключа последней книги страницы.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 20
+    max_page_size = 100
+    default_ordering = ('author_id', 'title', 'id')
+    invalid_cursor_message = 'Неверный курсор'
+
+    def get_ordering(self, queryset):
+        ordering = list(queryset.query.order_by) or list(self.default_ordering)
+        if 'id' not in ordering and '-id' not in ordering:
+            ordering.append('id')  # уникальный ключ в конце, иначе страницы могут терять книги
+        return ordering
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, ordering, values):
+        data = json.dumps({'o': ordering, 'v': values}, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, queryset, ordering, cursor):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            if data['o'] != ordering or len(data['v']) != len(ordering):
+                raise ValueError
+            meta = queryset.model._meta
+            return [None if value is None else meta.get_field(name.lstrip('-')).to_python(value)
+                    for name, value in zip(ordering, data['v'])]
+        except (TypeError, KeyError, ValueError, binascii.Error, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    @staticmethod
+    def order_expression(name):
+        # NULL всегда считаем наименьшим значением - одинаково на любой БД
+        if name.startswith('-'):
+            return F(name[1:]).desc(nulls_last=True)
+        return F(name).asc(nulls_first=True)
+
+    @staticmethod
+    def after(name, value):
+        """
+        Условие "строго после value" для одного поля ключа
+        """
+        field = name.lstrip('-')
+        if name.startswith('-'):
+            if value is None:
+                return Q(pk__in=[])
+            return Q(**{f'{field}__lt': value}) | Q(**{f'{field}__isnull': True})
+        if value is None:
+            return Q(**{f'{field}__isnull': False})
+        return Q(**{f'{field}__gt': value})
+
+    @staticmethod
+    def equal(name, value):
+        field = name.lstrip('-')
+        if value is None:
+            return Q(**{f'{field}__isnull': True})
+        return Q(**{field: value})
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        ordering = self.get_ordering(queryset)
+        page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*[self.order_expression(name) for name in ordering])
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            values = self.decode_cursor(queryset, ordering, cursor)
+            conditions = []
+            for i, name in enumerate(ordering):
+                prefix = [self.equal(n, v) for n, v in zip(ordering[:i], values[:i])]
+                conditions.append(reduce(and_, prefix, self.after(name, values[i])))
+            queryset = queryset.filter(reduce(or_, conditions))
+
+        page = list(queryset[:page_size + 1])
+        self.next_cursor = None
+        if len(page) > page_size:
+            page = page[:page_size]
+            last = page[-1]
+            # страница - модели или словари values()
+            get = last.get if isinstance(last, dict) else lambda name: getattr(last, name)
+            self.next_cursor = self.encode_cursor(ordering, [get(name.lstrip('-')) for name in ordering])
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,168 @@
+"""
+Похожие книги по поведению пользователей (item-to-item).
+
+Оценки (BookRating) и избранное (Favorite) собираются в разреженную матрицу пользователь x книга,
+сходство книг - косинус между столбцами. Для каждой книги в SimilarBook сохраняются top-K соседей,
+API отдает их готовыми. Нужны numpy и scipy.
+"""
+import time
+from collections import namedtuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from bookcross.importer import chunks
+from bookcross.models import BookInstance, BookRating, Favorite, SimilarBook
+
+BuildStats = namedtuple('BuildStats', ['books', 'users', 'interactions', 'refreshed', 'neighbours',
+                                       'duration', 'matrix_bytes', 'peak_rss'])
+
+FAVORITE_WEIGHT = 1.0
+
+
+def import_numpy():
+    try:
+        import numpy
+        from scipy import sparse
+    except ImportError:
+        raise ImproperlyConfigured('Для расчета похожих книг нужны пакеты numpy и scipy')
+    return numpy, sparse
+
+
+def load_interactions():
+    """
+    Массивы (пользователь, книга, вес) и список id книг по индексу столбца.
+    Оценка дает вес rating / 5, избранное - FAVORITE_WEIGHT, веса одной пары складываются
+    """
+    np, _ = import_numpy()
+    books, users = {}, {}
+    rows, cols, values = [], [], []
+
+    def add(book_id, user_id, value):
+        cols.append(books.setdefault(book_id, len(books)))
+        rows.append(users.setdefault(user_id, len(users)))
+        values.append(value)
+
+    ratings = BookRating.objects.order_by().values_list('book_id', 'user_id', 'rating')
+    for book_id, user_id, rating in ratings.iterator():
+        add(book_id, user_id, int(rating) / 5)
+    for book_id, user_id in Favorite.objects.order_by().values_list('book_id', 'user_id').iterator():
+        add(book_id, user_id, FAVORITE_WEIGHT)
+    book_ids = [None] * len(books)
+    for book_id, index in books.items():
+        book_ids[index] = book_id
+    return (np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32), np.array(values, dtype=np.float32),
+            len(users), book_ids)
+
+
+def compute_neighbours(rows, cols, values, n_users, n_items, top_k=20, items=None, block_size=2000):
+    """
+    Векторизованный расчет top_k соседей по косинусному сходству.
+    items - индексы книг, для которых нужен результат (по умолчанию все).
+    Сходство считается блоками книг, поэтому память не растет как n_items^2.
+    Возвращает генератор (индекс книги, индексы соседей, сходства) по убыванию сходства.
+    """
+    np, sparse = import_numpy()
+    matrix = sparse.csc_matrix((values, (rows, cols)), shape=(n_users, n_items), dtype=np.float32)
+    matrix.sum_duplicates()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    norms[norms == 0] = 1
+    normalized = sparse.csr_matrix(matrix.multiply(1 / norms[np.newaxis, :]))
+    by_item = normalized.T.tocsr()
+    items = np.arange(n_items) if items is None else np.asarray(items)
+
+    for start in range(0, len(items), block_size):
+        block = items[start:start + block_size]
+        similarity = (by_item[block] @ normalized).tocsr()
+        for offset, item in enumerate(block):
+            begin, end = similarity.indptr[offset], similarity.indptr[offset + 1]
+            neighbours, scores = similarity.indices[begin:end], similarity.data[begin:end]
+            keep = neighbours != item
+            neighbours, scores = neighbours[keep], scores[keep]
+            if len(scores) > top_k:
+                best = np.argpartition(-scores, top_k - 1)[:top_k]
+                neighbours, scores = neighbours[best], scores[best]
+            order = np.argsort(-scores, kind='stable')
+            yield item, neighbours[order], scores[order]
+
+
+def matrix_bytes(n_interactions):
+    # значения float32 + индексы int32 в двух представлениях матрицы (по пользователям и по книгам)
+    return n_interactions * (4 + 4) * 2
+
+
+def peak_rss():
+    # пиковое потребление памяти процессом, байт (ru_maxrss в Linux - в килобайтах)
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def build_similar_books(top_k=20, incremental=False, batch_size=1000):
+    """
+    Пересчитывает SimilarBook. При incremental=True пересчитываются только книги,
+    измененные после прошлого расчета (оценки и избранное обновляют BookInstance.modified).
+    Соседи остальных книг обновятся при следующем полном расчете.
+    """
+    started = time.monotonic()
+    computed_at = timezone.now()
+    rows, cols, values, n_users, book_ids = load_interactions()
+    index = {book_id: i for i, book_id in enumerate(book_ids)}
+
+    refresh = stale = None
+    if incremental:
+        since = SimilarBook.objects.aggregate(last=Max('computed_at'))['last']
+        if since is not None:
+            changed = list(BookInstance.objects.filter(modified__gt=since).values_list('pk', flat=True))
+            refresh = [book_id for book_id in changed if book_id in index]
+            # у книги не осталось ни оценок, ни избранного - старые соседи больше не верны
+            stale = [book_id for book_id in changed if book_id not in index]
+
+    items = None if refresh is None else [index[book_id] for book_id in refresh]
+    neighbours_total = refreshed = 0
+    # соседи считаются вне транзакции, а каждая пачка заменяется своей короткой транзакцией:
+    # иначе SQLite держал бы блокировку записи весь расчет, и оценки, избранное и смена статуса
+    # параллельных запросов падали бы с "database is locked"
+    batch, batch_books = [], []
+    for item, neighbours, scores in compute_neighbours(rows, cols, values, n_users, len(book_ids), top_k,
+                                                       items=items):
+        refreshed += 1
+        batch_books.append(book_ids[item])
+        batch += [SimilarBook(book_id=book_ids[item], similar_id=book_ids[n], score=float(score), rank=rank,
+                              computed_at=computed_at)
+                  for rank, (n, score) in enumerate(zip(neighbours, scores), 1)]
+        if len(batch_books) >= batch_size:
+            neighbours_total += save_batch(batch, batch_books)
+            batch, batch_books = [], []
+    neighbours_total += save_batch(batch, batch_books)
+
+    with transaction.atomic():
+        if refresh is None:
+            # полный расчет: остались только строки книг, которых больше нет в матрице
+            SimilarBook.objects.filter(computed_at__lt=computed_at).delete()
+        elif stale:
+            SimilarBook.objects.filter(book_id__in=stale).delete()
+
+    return BuildStats(books=len(book_ids), users=n_users, interactions=len(values), refreshed=refreshed,
+                      neighbours=neighbours_total, duration=time.monotonic() - started,
+                      matrix_bytes=matrix_bytes(len(values)), peak_rss=peak_rss())
+
+
+def save_batch(batch, batch_books):
+    """
+    Заменяет соседей книг batch_books строками batch в одной транзакции
+    """
+    if not batch_books:
+        return 0
+    with transaction.atomic():
+        for part in chunks(batch_books):
+            SimilarBook.objects.filter(book_id__in=part).delete()
+        SimilarBook.objects.bulk_create(batch, batch_size=1000)
+    return len(batch)
@@ -0,0 +1,21 @@
+"""
+JSON рендерер API на orjson: в разы быстрее json.dumps на больших списках книг.
+Без установленного orjson (и для ?indent= от браузера) работает как обычный JSONRenderer.
+"""
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        # lazy строки, Decimal и прочее, чего не знает orjson, переводит кодировщик DRF
+        return orjson.dumps(data, default=self.encoder_class().default, option=orjson.OPT_NON_STR_KEYS)
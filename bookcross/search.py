@@ -0,0 +1,180 @@
+"""
+Полнотекстовый поиск книг по индексу SQLite FTS5.
+
+Индекс - виртуальная таблица bookcross_book_fts (название, описание, ISBN, автор, жанры).
+Она создается после migrate и обновляется сигналами при изменении книг, авторов и жанров.
+На других БД поиск работает через icontains без индекса.
+"""
+import re
+import uuid
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from bookcross.models import Author, BookInstance, Genre
+
+FTS_TABLE = 'bookcross_book_fts'
+CHUNK_SIZE = 500
+# сколько страниц кандидатов читает search_books, пока фильтры queryset отсеивают найденное
+MAX_ROUNDS = 5
+# веса колонок для bm25: book_id, title, summary, isbn, authors, genres
+RANK = f'bm25({FTS_TABLE}, 0, 10.0, 1.0, 5.0, 5.0, 2.0)'
+
+
+def fts_enabled():
+    return connection.vendor == 'sqlite'
+
+
+def fts_rowid(book_id):
+    # rowid FTS5 - целое число, берем старшие 63 бита UUID книги
+    return book_id.int >> 65
+
+
+def create_search_index(**kwargs):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"book_id UNINDEXED, title, summary, isbn, authors, genres, "
+            f"tokenize='unicode61 remove_diacritics 2')"
+        )
+
+
+def remove_books(book_ids):
+    if not fts_enabled() or not book_ids:
+        return
+    rowids = [fts_rowid(pk) for pk in book_ids]
+    with connection.cursor() as cursor:
+        for i in range(0, len(rowids), CHUNK_SIZE):
+            chunk = rowids[i:i + CHUNK_SIZE]
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(chunk))})', chunk)
+
+
+def index_books(book_ids, new=False):
+    """
+    Переиндексирует книги с указанными id (удаленные книги просто выпадают из индекса).
+    new=True - книги только что созданы, старых записей индекса у них нет
+    """
+    if not fts_enabled():
+        return
+    book_ids = list(book_ids)
+    for i in range(0, len(book_ids), CHUNK_SIZE):
+        chunk = book_ids[i:i + CHUNK_SIZE]
+        if not new:
+            remove_books(chunk)
+        genres = {}
+        through = BookInstance.genre.through.objects.filter(bookinstance_id__in=chunk)
+        for book_id, name in through.values_list('bookinstance_id', 'genre__name'):
+            genres.setdefault(book_id, []).append(name)
+        books = BookInstance.objects.filter(pk__in=chunk).order_by().values_list(
+            'pk', 'title', 'summary', 'isbn', 'author__first_name', 'author__last_name')
+        rows = [
+            (fts_rowid(pk), pk.hex, title, summary, isbn or '',
+             ' '.join(filter(None, [first_name, last_name])), ' '.join(genres.get(pk, [])))
+            for pk, title, summary, isbn, first_name, last_name in books
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, book_id, title, summary, isbn, authors, genres) '
+                f'VALUES (%s, %s, %s, %s, %s, %s, %s)', rows)
+
+
+def rebuild_search_index():
+    if not fts_enabled():
+        return 0
+    create_search_index()
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+    book_ids = list(BookInstance.objects.order_by().values_list('pk', flat=True))
+    index_books(book_ids)
+    return len(book_ids)
+
+
+def build_match_query(query):
+    """
+    'толст вой' -> '"толст"* "вой"*': все слова, каждое как префикс
+    """
+    terms = re.findall(r'\w+', query.lower())
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_books(query, queryset, limit=20):
+    """
+    Книги из queryset, подходящие под запрос, в порядке релевантности
+    """
+    match = build_match_query(query)
+    if not match:
+        return []
+    if not fts_enabled():
+        terms = re.findall(r'\w+', query)
+        for term in terms:
+            queryset = queryset.filter(
+                Q(title__icontains=term) | Q(summary__icontains=term) | Q(isbn__icontains=term) |
+                Q(author__first_name__icontains=term) | Q(author__last_name__icontains=term) |
+                Q(genre__name__icontains=term)
+            )
+        return list(queryset.distinct()[:limit])
+
+    # индекс не знает статусов и прочих фильтров queryset (статус меняется и массовыми update() без сигналов),
+    # поэтому кандидатов читаем страницами, пока не наберется limit книг или не кончатся совпадения
+    # (не больше MAX_ROUNDS страниц: при почти полном отсеве дальше искать дорого)
+    batch = limit * 5
+    found = []
+    for offset in range(0, batch * MAX_ROUNDS, batch):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT book_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY {RANK} LIMIT %s OFFSET %s',
+                [match, batch, offset])
+            ranked = [uuid.UUID(row[0]) for row in cursor.fetchall()]
+        books = {book.pk: book for book in queryset.filter(pk__in=ranked)}
+        found.extend(books[pk] for pk in ranked if pk in books)
+        if len(found) >= limit or len(ranked) < batch:
+            break
+    return found[:limit]
+
+
+@receiver(post_save, sender=BookInstance)
+def book_saved(sender, instance, **kwargs):
+    index_books([instance.pk])
+
+
+@receiver(post_delete, sender=BookInstance)
+def book_deleted(sender, instance, **kwargs):
+    remove_books([instance.pk])
+
+
+@receiver(m2m_changed, sender=BookInstance.genre.through)
+def book_genres_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        instance._search_book_ids = list(instance.bookinstance_set.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_books([instance.pk])
+    elif pk_set:
+        index_books(pk_set)
+    else:
+        index_books(instance.__dict__.pop('_search_book_ids', []))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Genre)
+def related_deleting(sender, instance, **kwargs):
+    # после удаления связь с книгами уже потеряна - запоминаем их заранее
+    instance._search_book_ids = list(instance.bookinstance_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Genre)
+def related_saved(sender, instance, created, **kwargs):
+    if not created:
+        index_books(instance.bookinstance_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Genre)
+def related_deleted(sender, instance, **kwargs):
+    index_books(instance.__dict__.pop('_search_book_ids', []))
@@ -1,18 +1,256 @@
-from rest_framework.serializers import ModelSerializer, StringRelatedField
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.db.models.functions import Substr
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.serializers import (CharField, ChoiceField, DateField, DateTimeField, DictField, IntegerField,
+                                        ListField, ModelSerializer, PrimaryKeyRelatedField, ReadOnlyField, Serializer,
+                                        StringRelatedField, UUIDField, ValidationError)
 
 # from rest_framework import serializers
-from bookcross.models import BookInstance
+from bookcross.importer import chunks
+from bookcross.models import BookInstance, BookRating, FavoriteRanking, Genre, SimilarBook, validate_status_loaner
+from bookcross.thumbnails import get_srcset
+
+BULK_MAX_ITEMS = 1000
+NO_COVER_URL = 'media/users/no_image.png'
+SHORT_SUMMARY_LENGTH = 200
+
+# наборы полей книги для ?profile=, без параметра отдается detail
+BOOK_FIELD_PROFILES = {
+    'card': ['id', 'title', 'author', 'short_summary', 'isbn', 'owner', 'get_rating', 'get_cover_url',
+             'get_cover_srcset'],
+    'detail': ['id', 'title', 'author', 'summary', 'isbn', 'genre', 'owner', 'get_rating', 'rating_count',
+               'favorite_count', 'get_cover_url', 'get_cover_srcset'],
+    'admin': ['id', 'title', 'author', 'summary', 'isbn', 'genre', 'owner', 'loaner', 'status', 'reserved_time',
+              'modified', 'get_rating', 'rating_count', 'favorite_count', 'get_cover_url', 'get_cover_srcset'],
+}
+DEFAULT_PROFILE = 'detail'
+# кто и когда взял книгу - только для персонала (профиль admin или явный ?fields=)
+STAFF_FIELDS = ('loaner', 'reserved_time')
+
+# какие столбцы (в терминах values()) нужны каждому полю API, genre грузится отдельным запросом
+BOOK_FIELD_COLUMNS = {
+    'id': ['id'],
+    'title': ['title'],
+    'author': ['author__last_name', 'author__first_name'],
+    'summary': ['summary'],
+    'short_summary': [],
+    'isbn': ['isbn'],
+    'genre': [],
+    'owner': ['owner__username'],
+    'loaner': ['loaner__username'],
+    'status': ['status'],
+    'reserved_time': ['reserved_time'],
+    'modified': ['modified'],
+    'get_rating': ['rating_avg'],
+    'rating_count': ['rating_count'],
+    'favorite_count': ['favorite_count'],
+    'get_cover_url': ['cover'],
+    'get_cover_srcset': ['cover', 'cover_thumbnails'],
+}
+
+
+def get_book_fields(params, staff=False):
+    """
+    Поля книги из ?fields=id,title,... или ?profile=card|detail|admin.
+    Без staff поля STAFF_FIELDS (и профиль admin) - ответ 403
+    """
+    if params.get('fields'):
+        fields = [name.strip() for name in params['fields'].split(',') if name.strip()]
+        unknown = [name for name in fields if name not in BOOK_FIELD_COLUMNS]
+        if unknown:
+            raise ValidationError({'fields': [f'Неизвестные поля: {", ".join(unknown)}']})
+        fields = list(dict.fromkeys(fields))
+    else:
+        profile = params.get('profile', DEFAULT_PROFILE)
+        if profile not in BOOK_FIELD_PROFILES:
+            raise ValidationError({'profile': [f'Допустимые значения: {", ".join(BOOK_FIELD_PROFILES)}']})
+        fields = BOOK_FIELD_PROFILES[profile]
+    hidden = [name for name in fields if name in STAFF_FIELDS]
+    if hidden and not staff:
+        raise PermissionDenied(f'Поля доступны только персоналу: {", ".join(hidden)}')
+    return fields
+
+
+def book_columns(fields, keys=()):
+    """
+    Столбцы для fields и ключей сортировки keys (имена полей модели или attname вроде author_id)
+    """
+    columns = [column for name in fields for column in BOOK_FIELD_COLUMNS[name]]
+    return list(dict.fromkeys([*columns, *(key.lstrip('-') for key in keys)]))
+
+
+def annotate_books(queryset, fields):
+    if 'short_summary' in fields:
+        # начало описания обрезает сама БД - полный текст до 1000 символов не читаем
+        queryset = queryset.annotate(short_summary=Substr('summary', 1, SHORT_SUMMARY_LENGTH))
+    return queryset
+
+
+def narrow_books(queryset, fields, keys=()):
+    """
+    Модели книг только с нужными полям fields столбцами (only) и связями
+    """
+    meta = BookInstance._meta
+    # status читает __init__ модели - без него каждая книга догружалась бы отдельным запросом
+    columns = [meta.get_field(column).name if '__' not in column else column
+               for column in book_columns(fields, ['id', 'status', *keys])]
+    relations = list(dict.fromkeys(column.split('__')[0] for column in columns if '__' in column))
+    queryset = queryset.select_related(*relations).only(*columns, *relations)
+    if 'genre' in fields:
+        # жанры по алфавиту, как в serialize_book_rows
+        queryset = queryset.prefetch_related(Prefetch('genre', queryset=Genre.objects.order_by('name')))
+    return annotate_books(queryset, fields)
+
+
+def book_values(queryset, fields, keys=()):
+    """
+    Строки книг как словари values() - для serialize_book_rows
+    """
+    annotations = [name for name in fields if name == 'short_summary']
+    return annotate_books(queryset, fields).values(*book_columns(fields, ['id', *keys]), *annotations)
+
+
+def book_genres(book_ids):
+    genres = defaultdict(list)
+    through = BookInstance.genre.through.objects.order_by('genre__name')
+    for part in chunks(book_ids):
+        for book_id, name in through.filter(bookinstance_id__in=part).values_list('bookinstance_id', 'genre__name'):
+            genres[book_id].append(name)
+    return genres
+
+
+def datetime_value(value):
+    return None if value is None else DateTimeField().to_representation(value)
+
+
+def serialize_book_rows(rows, fields):
+    """
+    Быстрая замена BookInstanceSerializer(many=True) для строк book_values(): тот же результат,
+    но без объектов моделей и полей сериализатора на каждую строку
+    """
+    genres = book_genres([row['id'] for row in rows]) if 'genre' in fields else {}
+    getters = {
+        'id': lambda row: str(row['id']),
+        'author': lambda row: (None if row['author__last_name'] is None
+                               else f'{row["author__last_name"]}, {row["author__first_name"]}'),
+        'genre': lambda row: genres.get(row['id'], []),
+        'owner': lambda row: row['owner__username'],
+        'loaner': lambda row: row['loaner__username'],
+        'reserved_time': lambda row: datetime_value(row['reserved_time']),
+        'modified': lambda row: datetime_value(row['modified']),
+        'get_rating': lambda row: row['rating_avg'],
+        'get_cover_url': lambda row: default_storage.url(row['cover']) if row['cover'] else NO_COVER_URL,
+        'get_cover_srcset': lambda row: get_srcset(row['cover']) if row['cover_thumbnails'] else None,
+    }
+    columns = [(name, getters.get(name)) for name in fields]
+    return [{name: row[name] if getter is None else getter(row) for name, getter in columns} for row in rows]
 
 
 class BookInstanceSerializer(ModelSerializer):
+    """
+    fields - список полей из BOOK_FIELD_COLUMNS, по умолчанию профиль detail
+    """
     genre = StringRelatedField(many=True)
     owner = StringRelatedField()
     author = StringRelatedField()
+    loaner = StringRelatedField()
+    # есть только у книг из narrow_books с этим полем
+    short_summary = ReadOnlyField()
 
     class Meta:
         model = BookInstance
         # fields = '__all__'
-        fields = ['id','title', 'author', 'summary', 'isbn', 'genre', 'owner', 'get_rating', 'get_cover_url']
+        fields = list(BOOK_FIELD_COLUMNS)
+        # статус меняют только change_status / reserve / lend / return (история, события, проверка заемщика),
+        # счетчики - сервисы оценок и избранного
+        read_only_fields = ['status', 'reserved_time', 'modified', 'rating_count', 'favorite_count']
         # TODO Не отправляется не верная ссылка на обложку
 
-        # TODO Убрать лишние поля (раз мы берем только доступные книги, поля нужны соответсвующие!!!
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        selected = set(fields or BOOK_FIELD_PROFILES[DEFAULT_PROFILE])
+        for name in list(self.fields):
+            if name not in selected:
+                self.fields.pop(name)
+
+
+class BookStatusChangeSerializer(Serializer):
+    """
+    Массовая смена статуса: {"ids": [...], "status": "m", "loaner": null}
+    """
+    ids = ListField(child=UUIDField(), allow_empty=False, max_length=1000)
+    status = ChoiceField(choices=BookInstance.LOAN_STATUS)
+    loaner = PrimaryKeyRelatedField(queryset=get_user_model().objects.all(), allow_null=True, required=False)
+
+    def validate(self, attrs):
+        try:
+            validate_status_loaner(attrs['status'], attrs.get('loaner'))
+        except DjangoValidationError as e:
+            raise ValidationError(e.messages)
+        return attrs
+
+
+class BookRateSerializer(Serializer):
+    rating = ChoiceField(choices=BookRating.RATING)
+
+
+class BookLoanSerializer(Serializer):
+    loaner = PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
+
+
+class BookWriteSerializer(Serializer):
+    """
+    Книга в пакетном создании / изменении. Связи - id: их существование services.bulk_* проверяют
+    одним запросом на всю пачку, а не PrimaryKeyRelatedField на каждую книгу.
+    Обязательные поля те же, что в BookInstanceForm; при изменении (partial) обязателен только id
+    """
+    id = UUIDField(required=False)
+    title = CharField(max_length=200)
+    author = IntegerField()
+    summary = CharField(max_length=1000)
+    isbn = CharField(max_length=13, allow_null=True, allow_blank=True, required=False)
+    genre = ListField(child=IntegerField(), allow_empty=False)
+    due_back = DateField(allow_null=True, required=False)
+    loaner = IntegerField(allow_null=True, required=False)
+    place = IntegerField(allow_null=True, required=False)
+    status = ChoiceField(choices=BookInstance.LOAN_STATUS, required=False)
+
+    def validate(self, attrs):
+        if self.partial and 'id' not in attrs:
+            raise ValidationError({'id': ['Обязательное поле.']})
+        if 'genre' in attrs:
+            attrs['genre'] = list(dict.fromkeys(attrs['genre']))
+        return attrs
+
+
+class BookBulkSerializer(Serializer):
+    """
+    {"books": [{...}, ...]} - сами книги проверяются по одной BookWriteSerializer, чтобы ошибка
+    одной не отменяла остальные
+    """
+    books = ListField(child=DictField(), allow_empty=False, max_length=BULK_MAX_ITEMS)
+
+
+class BookBulkDeleteSerializer(Serializer):
+    ids = ListField(child=UUIDField(), allow_empty=False, max_length=BULK_MAX_ITEMS)
+
+
+class FavoriteRankingSerializer(ModelSerializer):
+    book = BookInstanceSerializer()
+
+    class Meta:
+        model = FavoriteRanking
+        fields = ['position', 'count', 'computed_at', 'book']
+
+
+class SimilarBookSerializer(ModelSerializer):
+    book = BookInstanceSerializer(source='similar')
+
+    class Meta:
+        model = SimilarBook
+        fields = ['rank', 'score', 'book']
@@ -0,0 +1,372 @@
+"""
+Массовые операции над книгами, которые не должны идти через BookInstance.save() по одной записи,
+переходы резерв / выдача / возврат условным UPDATE без чтения статуса перед записью
+и оценки / избранное через INSERT ... ON CONFLICT со сдвигом счетчиков книги через F()
+"""
+import datetime
+import logging
+import time
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import ExpressionWrapper, F, FloatField, Value
+from django.utils import timezone
+
+from bookcross.cache import bump_catalog_version
+from bookcross.events import publish_status_changes
+from bookcross.importer import chunks, insert_genres
+from bookcross.models import (MAX_RESERVED_TIME, Author, BookInstance, BookRating, CrossHistory, Favorite, Genre,
+                              Place, clean_loan_fields, validate_status_loaner)
+from bookcross.search import index_books
+
+logger = logging.getLogger('bookcross.reservations')
+
+SweepResult = namedtuple('SweepResult', ['expired', 'batches', 'duration'])
+CHUNK_SIZE = 500
+# поле пакетного API -> модель, на которую оно ссылается
+BOOK_REFERENCES = {'author': Author, 'loaner': get_user_model(), 'place': Place, 'genre': Genre}
+
+
+def change_status(books, status, loaner=None):
+    """
+    Переводит книги из queryset books в статус status одной транзакцией:
+    UPDATE на каждые CHUNK_SIZE книг и один bulk_create истории.
+    Правила те же, что в BookInstanceForm.clean и BookInstance.save():
+    для В аренде / Зарезервирована нужен заемщик, время резерва ставится только для Зарезервирована.
+    Книги, уже имеющие этот статус, не трогаются. Возвращает число измененных книг.
+    """
+    validate_status_loaner(status, loaner)
+    if status not in ('o', 'r'):
+        loaner = None
+    reserved_time = timezone.now() if status == 'r' else None
+    loaner_id = loaner.pk if loaner is not None else None
+    with transaction.atomic():
+        changed = list(books.select_for_update().exclude(status=status).order_by().values_list('pk', 'status'))
+        for i in range(0, len(changed), CHUNK_SIZE):
+            BookInstance.objects.filter(pk__in=[pk for pk, _ in changed[i:i + CHUNK_SIZE]]).update(
+                status=status, loaner=loaner_id, reserved_time=reserved_time, modified=timezone.now())
+        CrossHistory.objects.bulk_create(
+            [CrossHistory.status_change(pk, loaner_id, old, status) for pk, old in changed], batch_size=CHUNK_SIZE)
+        publish_status_changes([(pk, old, status) for pk, old in changed])
+    if changed:
+        transaction.on_commit(bump_catalog_version)
+    return len(changed)
+
+
+def expire_reservations(now=None, batch_size=500):
+    """
+    Возвращает в доступные книги, зарезервированные дольше MAX_RESERVED_TIME.
+    Каждая пачка - один UPDATE и один bulk_create истории в короткой транзакции.
+    """
+    started = time.monotonic()
+    deadline = (now or timezone.now()) - MAX_RESERVED_TIME
+    expired = batches = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                BookInstance.objects.select_for_update()
+                .filter(status='r', reserved_time__lt=deadline)
+                .order_by().values_list('pk', 'loaner_id')[:batch_size]
+            )
+            if not batch:
+                break
+            BookInstance.objects.filter(pk__in=[pk for pk, _ in batch]).update(
+                status='a', loaner=None, reserved_time=None, modified=timezone.now())
+            CrossHistory.objects.bulk_create(
+                [CrossHistory.status_change(pk, loaner_id, 'r', 'a') for pk, loaner_id in batch])
+            publish_status_changes([(pk, 'r', 'a') for pk, _ in batch])
+        expired += len(batch)
+        batches += 1
+    if expired:
+        transaction.on_commit(bump_catalog_version)
+    result = SweepResult(expired, batches, time.monotonic() - started)
+    logger.info('reservation sweep: expired=%d batches=%d duration=%.3fs', *result,
+                extra={'expired': result.expired, 'batches': result.batches, 'duration': result.duration})
+    return result
+
+
+class StatusConflict(Exception):
+    """
+    Книга уже не в том статусе, из которого возможен переход (ее успел взять другой запрос)
+    """
+
+    def __init__(self, book_id, status):
+        self.book_id = book_id
+        self.status = status
+        super().__init__(f'Книга сейчас в статусе "{dict(BookInstance.LOAN_STATUS).get(status, status)}"')
+
+
+def move_book(book_id, status, sources, loaner=None, owner=None):
+    """
+    Переводит книгу в status одним UPDATE ... WHERE <состояние из sources>.
+    sources - фильтры допустимых исходных состояний, например [{'status': 'a'}], пробуются по порядку.
+    Из двух одновременных запросов UPDATE изменит строку только у первого, второй сразу получает
+    StatusConflict - без SELECT до записи и без долгой транзакции (на SQLite она блокирует всю базу).
+    История пишется в той же короткой транзакции. Возвращает прежний статус
+    """
+    validate_status_loaner(status, loaner)
+    loaner_id = loaner.pk if loaner is not None and status in ('o', 'r') else None
+    reserved_time = timezone.now() if status == 'r' else None
+    books = BookInstance.objects.filter(pk=book_id)
+    if owner is not None:
+        books = books.filter(owner=owner)
+    with transaction.atomic():
+        for source in sources:
+            if books.filter(**source).update(status=status, loaner=loaner_id, reserved_time=reserved_time,
+                                             modified=timezone.now()):
+                old_status = source['status']
+                break
+        else:
+            current = books.values_list('status', flat=True).first()
+            if current is None:
+                raise BookInstance.DoesNotExist(f'Нет книги {book_id}')
+            raise StatusConflict(book_id, current)
+        CrossHistory.status_change(book_id, loaner_id, old_status, status).save()
+        publish_status_changes([(book_id, old_status, status)])
+    transaction.on_commit(bump_catalog_version)
+    return old_status
+
+
+def reserve_book(book_id, user):
+    return move_book(book_id, 'r', [{'status': 'a'}], loaner=user)
+
+
+def lend_book(book_id, loaner, owner=None):
+    """
+    Выдача книги: зарезервированной этим же заемщиком или доступной
+    """
+    return move_book(book_id, 'o', [{'status': 'r', 'loaner': loaner}, {'status': 'a'}], loaner=loaner, owner=owner)
+
+
+def return_book(book_id, owner=None):
+    """
+    Возврат выданной книги или снятие резерва
+    """
+    return move_book(book_id, 'a', [{'status': 'o'}, {'status': 'r'}], owner=owner)
+
+
+def insert_ignore(model, values, conflict):
+    """
+    INSERT ... ON CONFLICT (conflict) DO NOTHING одной командой (SQLite 3.24+, PostgreSQL).
+    Сигналы post_save не отправляются. Возвращает 1, если строка вставлена, 0 - если такая уже была
+    """
+    meta = model._meta
+    fields = [meta.get_field(name) for name in values]
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(field.column) for field in fields)
+    target = ', '.join(qn(meta.get_field(name).column) for name in conflict)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {qn(meta.db_table)} ({columns}) VALUES ({", ".join(["%s"] * len(fields))}) '
+            f'ON CONFLICT ({target}) DO NOTHING',
+            [field.get_db_prep_save(values[field.name], connection) for field in fields])
+        return cursor.rowcount
+
+
+def delete_row(model, **lookup):
+    """
+    DELETE одной командой без выборки объектов и сигналов post_delete, возвращает число удаленных строк
+    """
+    meta = model._meta
+    fields = [meta.get_field(name) for name in lookup]
+    qn = connection.ops.quote_name
+    where = ' AND '.join(f'{qn(field.column)} = %s' for field in fields)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {qn(meta.db_table)} WHERE {where}',
+                       [field.get_db_prep_save(lookup[field.name], connection) for field in fields])
+        return cursor.rowcount
+
+
+def shift_counters(book_id, **expressions):
+    """
+    UPDATE счетчиков книги выражениями F(), нет книги - BookInstance.DoesNotExist (и откат транзакции)
+    """
+    if not BookInstance.objects.filter(pk=book_id).update(modified=timezone.now(), **expressions):
+        raise BookInstance.DoesNotExist(f'Нет книги {book_id}')
+
+
+def add_favorite(book_id, user):
+    """
+    Добавляет книгу в избранное. Повторное добавление (двойной клик, параллельный запрос) ничего не меняет.
+    Возвращает True, если книга добавлена этим вызовом
+    """
+    with transaction.atomic():
+        added = insert_ignore(Favorite, {'book': book_id, 'user': user.pk, 'create_date': datetime.date.today()},
+                              ['book', 'user'])
+        if added:
+            shift_counters(book_id, favorite_count=F('favorite_count') + 1)
+    if added:
+        transaction.on_commit(bump_catalog_version)
+    return bool(added)
+
+
+def remove_favorite(book_id, user):
+    with transaction.atomic():
+        removed = delete_row(Favorite, book=book_id, user=user.pk)
+        if removed:
+            shift_counters(book_id, favorite_count=F('favorite_count') - removed)
+    if removed:
+        transaction.on_commit(bump_catalog_version)
+    return bool(removed)
+
+
+def rate_book(book_id, user, rating):
+    """
+    Оценка книги rating ('1'..'5'): новая строка - INSERT ... ON CONFLICT DO NOTHING,
+    изменение - старая оценка под блокировкой строки (на SQLite блокировку записи уже взял INSERT).
+    rating_avg и rating_count сдвигаются F() выражениями в той же транзакции, без пересчета по всем оценкам.
+    Возвращает прежнюю оценку или None
+    """
+    value = int(rating)
+    with transaction.atomic():
+        if insert_ignore(BookRating, {'book': book_id, 'user': user.pk, 'rating': rating}, ['book', 'user']):
+            shift_counters(book_id, rating_count=F('rating_count') + 1, rating_avg=ExpressionWrapper(
+                (F('rating_avg') * F('rating_count') + Value(float(value))) / (F('rating_count') + 1),
+                output_field=FloatField()))
+            old = None
+        else:
+            rates = BookRating.objects.filter(book_id=book_id, user=user)
+            old = rates.select_for_update().values_list('rating', flat=True).get()
+            if old != rating:
+                rates.update(rating=rating)
+                shift_counters(book_id, rating_avg=ExpressionWrapper(
+                    F('rating_avg') + Value(float(value - int(old))) / F('rating_count'), output_field=FloatField()))
+    if old != rating:
+        transaction.on_commit(bump_catalog_version)
+    return old
+
+
+def existing_ids(model, ids):
+    return {pk for part in chunks(set(ids)) for pk in model.objects.filter(pk__in=part).values_list('pk', flat=True)}
+
+
+def reference_errors(items):
+    """
+    Ссылки на несуществующих авторов, заемщиков, места и жанры - по одному запросу на модель.
+    items - [(номер, поля)], возвращает {номер: ошибки}
+    """
+    errors = {}
+    for name, model in BOOK_REFERENCES.items():
+        values = [(index, value) for index, attrs in items
+                  for value in (attrs.get(name) if name == 'genre' else [attrs.get(name)]) or []
+                  if value is not None]
+        existing = existing_ids(model, [value for _, value in values])
+        for index, value in values:
+            if value not in existing:
+                errors.setdefault(index, {}).setdefault(name, []).append(f'Нет объекта с id {value}')
+    return errors
+
+
+def book_attrs(attrs):
+    # id связей из запроса -> атрибуты модели
+    return {f'{name}_id' if name in BOOK_REFERENCES else name: value
+            for name, value in attrs.items() if name not in ('id', 'genre')}
+
+
+def clean_item(attrs, errors, index):
+    try:
+        clean_loan_fields(attrs)
+    except ValidationError as e:
+        errors[index] = {'non_field_errors': e.messages}
+        return False
+    return True
+
+
+def bulk_create_books(owner, items):
+    """
+    Создает книги владельца owner одной транзакцией: bulk_create книг, одна вставка всех жанров,
+    индекс поиска пачкой. items - [(номер, поля BookWriteSerializer)].
+    Возвращает ({номер: id книги}, {номер: ошибки}) - ошибка одной книги не мешает остальным
+    """
+    errors = reference_errors(items)
+    created, books, genres = {}, [], []
+    for index, attrs in items:
+        if index in errors or not clean_item(attrs, errors, index):
+            continue
+        book = BookInstance(owner=owner, **book_attrs(attrs))
+        if book.status == 'r':
+            book.reserved_time = timezone.now()
+        books.append(book)
+        genres += [(book.pk, genre_id) for genre_id in attrs['genre']]
+        created[index] = book.pk
+    if books:
+        with transaction.atomic():
+            BookInstance.objects.bulk_create(books, batch_size=CHUNK_SIZE)
+            insert_genres(genres)
+            index_books(list(created.values()), new=True)
+        transaction.on_commit(bump_catalog_version)
+    return created, errors
+
+
+def bulk_update_books(user, items):
+    """
+    Частичное изменение книг одной транзакцией: bulk_update, замена жанров у книг, где они переданы,
+    история и события для сменивших статус - как при BookInstance.save().
+    Чужие книги может менять только персонал. Возвращает ({номер: id книги}, {номер: ошибки})
+    """
+    errors = reference_errors(items)
+    updated, history, changes, genres, seen = {}, [], [], {}, set()
+    # заемщика и время резерва могут поменять правила статуса, даже если их не передали
+    fields = {'loaner', 'reserved_time', 'modified'}
+    with transaction.atomic():
+        books = BookInstance.objects.select_for_update()
+        if not user.is_staff:
+            books = books.filter(owner=user)
+        books = {book.pk: book for part in chunks([attrs['id'] for _, attrs in items])
+                 for book in books.filter(pk__in=part)}
+        for index, attrs in items:
+            book = books.get(attrs['id'])
+            if book is None or book.pk in seen:
+                errors.setdefault(index, {}).setdefault('id', []).append('Книга не найдена или повторяется в запросе')
+            if index in errors:
+                continue
+            data = {'status': book.status, 'loaner': book.loaner_id, 'reserved_time': book.reserved_time, **attrs}
+            if not clean_item(data, errors, index):
+                continue
+            for name, value in book_attrs(data).items():
+                setattr(book, name, value)
+            fields.update(name for name in attrs if name not in ('id', 'genre'))
+            if book.status != book.old_status:
+                if book.status == 'r':
+                    book.reserved_time = timezone.now()
+                elif book.status == 'o':
+                    book.reserved_time = None
+                history.append(CrossHistory.status_change(book.pk, book.loaner_id, book.old_status, book.status))
+                changes.append((book.pk, book.old_status, book.status))
+            if 'genre' in attrs:
+                genres[book.pk] = attrs['genre']
+            book.modified = timezone.now()
+            updated[index] = book.pk
+            seen.add(book.pk)
+        if updated:
+            changed = [books[pk] for pk in updated.values()]
+            BookInstance.objects.bulk_update(changed, sorted(fields), batch_size=CHUNK_SIZE)
+            for part in chunks(genres):
+                BookInstance.genre.through.objects.filter(bookinstance_id__in=part).delete()
+            insert_genres([(pk, genre_id) for pk, genre_ids in genres.items() for genre_id in genre_ids])
+            CrossHistory.objects.bulk_create(history, batch_size=CHUNK_SIZE)
+            index_books(list(updated.values()))
+            publish_status_changes(changes)
+            for book in changed:
+                book.old_status = book.status
+    if updated:
+        transaction.on_commit(bump_catalog_version)
+    return updated, errors
+
+
+def bulk_delete_books(user, ids):
+    """
+    Удаляет книги по id одной транзакцией (чужие - только персонал).
+    Возвращает (удаленные id, не найденные id)
+    """
+    with transaction.atomic():
+        books = BookInstance.objects.all() if user.is_staff else BookInstance.objects.filter(owner=user)
+        found = [pk for part in chunks(ids) for pk in books.filter(pk__in=part).values_list('pk', flat=True)]
+        for part in chunks(found):
+            BookInstance.objects.filter(pk__in=part).delete()
+    if found:
+        transaction.on_commit(bump_catalog_version)
+    deleted = set(found)
+    return found, [pk for pk in ids if pk not in deleted]
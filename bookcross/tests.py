@@ -1,3 +1,1875 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import closing
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.models import F
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.template.base import Template
+from django.template.loader import render_to_string
+from django.utils import timezone
+from PIL import Image
+from rest_framework.renderers import JSONRenderer
+
+from account.models import Profile
+from bookcross.benchmark import BENCH_ADMIN, ENDPOINTS, run_benchmarks
+from bookcross.cache import VERSION_KEY, bump_catalog_version, cache_stats, catalog_version, get_cache, make_key
+from bookcross.dataset import generate_dataset
+from bookcross.events import EVENTS_PATH, get_broker
+from bookcross.facets import GENRE_INDEX, filter_books
+from bookcross.history import add_months, archive_history, retention_cutoff
+from bookcross.models import (MAX_RESERVED_TIME, Author, BookInstance, BookRating, CrossHistory, CrossHistoryMonth,
+                              Favorite, Genre, Place, SimilarBook, update_book_ratings)
+from bookcross.importer import import_books
+from bookcross.pagination import KeysetPagination
+from bookcross.recommendations import build_similar_books, compute_neighbours
+from bookcross.renderers import FastJSONRenderer
+from bookcross.search import FTS_TABLE, search_books
+from bookcross.serializers import (BOOK_FIELD_PROFILES, SHORT_SUMMARY_LENGTH, BookInstanceSerializer, book_values,
+                                   narrow_books, serialize_book_rows)
+from bookcross.services import (StatusConflict, add_favorite, change_status, expire_reservations, rate_book,
+                                reserve_book)
+from bookcross.thumbnails import generation_done, thumbnail_name
+from bookcross.views import BookInstanceListView
+from pbl.db import PrimaryReplicaRouter, is_pinned, pin_primary, reset_pin
+from pbl.middleware import template_timer
+from pbl.metrics import render_metrics, reset_metrics
+
+User = get_user_model()
+
+
+class BookcrossTestCase(TestCase):
+    def setUp(self):
+        # версия каталога в кэше переживает откат транзакции теста
+        get_cache().clear()
+
+
+def make_books(count, owner, status='a'):
+    """
+    Создает count книг пачкой: у каждой свой автор и по два жанра
+    """
+    authors = Author.objects.bulk_create(
+        [Author(first_name=f'Имя{i}', last_name=f'Фамилия{i}') for i in range(count)])
+    genres = Genre.objects.bulk_create([Genre(name=f'Жанр{i}') for i in range(5)])
+    books = BookInstance.objects.bulk_create(
+        [BookInstance(title=f'Книга {i:05}', author=author, owner=owner, status=status, summary='Описание')
+         for i, author in enumerate(authors)])
+    through = BookInstance.genre.through
+    through.objects.bulk_create(
+        [through(bookinstance_id=book.pk, genre_id=genres[(i + k) % len(genres)].pk)
+         for i, book in enumerate(books) for k in range(2)])
+    return books
+
+
+class BookRatingTotalsTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.author = Author.objects.create(first_name='Лев', last_name='Толстой')
+        self.book = BookInstance.objects.create(title='Война и мир', author=self.author, owner=self.owner)
+        self.readers = [User.objects.create_user(f'reader{i}', password='pass') for i in range(3)]
+
+    def test_rating_follows_book_rating_changes(self):
+        BookRating.objects.create(book=self.book, user=self.readers[0], rating='5')
+        rate = BookRating.objects.create(book=self.book, user=self.readers[1], rating='2')
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_count, 2)
+        self.assertEqual(self.book.get_rating(), 3.5)
+
+        rate.rating = '4'
+        rate.save()
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.rating_avg, 4.5)
+
+        rate.delete()
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.rating_avg, self.book.rating_count), (5, 1))
+
+    def test_rebuild_ratings_command(self):
+        BookRating.objects.create(book=self.book, user=self.readers[0], rating='3')
+        BookInstance.objects.update(rating_avg=0, rating_count=0)
+        call_command('rebuild_ratings', stdout=StringIO())
+        self.book.refresh_from_db()
+        self.assertEqual((self.book.rating_avg, self.book.rating_count), (3, 1))
+
+    def test_api_filters_and_sorts_by_rating(self):
+        other = BookInstance.objects.create(title='Анна Каренина', author=self.author, owner=self.owner)
+        BookRating.objects.create(book=self.book, user=self.readers[0], rating='2')
+        BookRating.objects.create(book=other, user=self.readers[0], rating='5')
+
+        response = self.client.get('/api/v1/list_book/', {'ordering': '-rating'})
+        self.assertEqual([b['title'] for b in response.json()['results']], ['Анна Каренина', 'Война и мир'])
+
+        response = self.client.get('/api/v1/list_book/', {'min_rating': 4})
+        self.assertEqual([b['title'] for b in response.json()['results']], ['Анна Каренина'])
+
+
+class BookApiQueryCountTest(BookcrossTestCase):
+    """
+    Число запросов к БД не должно зависеть от количества книг
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+
+    def assert_list_queries(self, count):
+        make_books(count, self.owner)
+        # агрегат для ETag, страница книг с автором и владельцем, жанры одним prefetch
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/list_book/', {'page_size': 100})
+        results = response.json()['results']
+        self.assertEqual(len(results), min(count, 100))
+        self.assertEqual(len(results[0]['genre']), 2)
+
+    def test_list_10_books(self):
+        self.assert_list_queries(10)
+
+    def test_list_100_books(self):
+        self.assert_list_queries(100)
+
+    def test_list_1000_books(self):
+        self.assert_list_queries(1000)
+
+    def test_detail(self):
+        book = make_books(1, self.owner)[0]
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/api/v1/list_book/{book.pk}/')
+        self.assertEqual(response.json()['author'], 'Фамилия0, Имя0')
+        self.assertEqual(response.json()['owner'], 'owner')
+
+    def test_html_list(self):
+        self.client.force_login(self.owner)
+        make_books(100, self.owner)
+        # сессия + пользователь + книги
+        with self.assertNumQueries(3):
+            self.client.get('/')
+
+
+class KeysetPaginationTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+
+    def fetch_all(self, params):
+        titles, url, pages = [], '/api/v1/list_book/', 0
+        while url:
+            data = self.client.get(url, params if not pages else None).json()
+            titles += [b['title'] for b in data['results']]
+            url, pages = data['next'], pages + 1
+        return titles, pages
+
+    def test_walks_catalog_in_meta_order(self):
+        books = make_books(25, self.owner)
+        # книги без автора и с одинаковым названием тоже не должны теряться между страницами
+        BookInstance.objects.bulk_create([BookInstance(title='Без автора', owner=self.owner) for _ in range(3)])
+        BookInstance.objects.filter(pk=books[0].pk).update(title='Книга 00001')
+        expected = list(BookInstance.objects.filter(status='a')
+                        .order_by(F('author_id').asc(nulls_first=True), 'title', 'id')
+                        .values_list('title', flat=True))
+
+        titles, pages = self.fetch_all({'page_size': 4})
+        self.assertEqual(titles, expected)
+        self.assertEqual(pages, 7)
+
+    def test_walks_rating_ordering(self):
+        books = make_books(9, self.owner)
+        BookInstance.objects.filter(pk__in=[b.pk for b in books[:4]]).update(rating_avg=4)
+        titles, _ = self.fetch_all({'page_size': 2, 'ordering': '-rating'})
+        self.assertEqual(len(titles), 9)
+        self.assertEqual(set(titles[:4]), {b.title for b in books[:4]})
+
+    def test_page_size_is_capped(self):
+        make_books(120, self.owner)
+        response = self.client.get('/api/v1/list_book/', {'page_size': 1000})
+        self.assertEqual(len(response.json()['results']), KeysetPagination.max_page_size)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/v1/list_book/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+class PlacePathTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.room = Place.objects.create(owner=self.owner, title='Комната')
+        self.case = Place.objects.create(owner=self.owner, title='Шкаф', parent_place=self.room)
+        self.shelf = Place.objects.create(owner=self.owner, title='Полка 1', parent_place=self.case)
+
+    def test_full_path_is_stored(self):
+        shelf = Place.objects.get(pk=self.shelf.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(shelf), 'Комната > Шкаф > Полка 1')
+        self.assertEqual(shelf.path, f'{self.room.pk}/{self.case.pk}/{self.shelf.pk}/')
+        self.assertEqual(shelf.depth, 2)
+
+    def test_rename_and_move_update_subtree(self):
+        self.case.title = 'Стеллаж'
+        self.case.save()
+        self.assertEqual(Place.objects.get(pk=self.shelf.pk).full_path, 'Комната > Стеллаж > Полка 1')
+
+        hall = Place.objects.create(owner=self.owner, title='Коридор')
+        self.case.parent_place = hall
+        self.case.save()
+        shelf = Place.objects.get(pk=self.shelf.pk)
+        self.assertEqual(shelf.full_path, 'Коридор > Стеллаж > Полка 1')
+        self.assertEqual(shelf.path, f'{hall.pk}/{self.case.pk}/{self.shelf.pk}/')
+        self.assertEqual(list(self.room.get_descendants()), [self.room])
+
+    def test_cannot_move_into_own_subtree(self):
+        self.case.parent_place = self.shelf
+        with self.assertRaises(ValidationError):
+            self.case.full_clean()
+
+    def test_rebuild_place_paths(self):
+        Place.objects.update(path='', full_path='', depth=0)
+        call_command('rebuild_place_paths', stdout=StringIO())
+        self.assertEqual(Place.objects.get(pk=self.shelf.pk).full_path, 'Комната > Шкаф > Полка 1')
+
+    def test_books_in_subtree(self):
+        other = Place.objects.create(owner=self.owner, title='Стол')
+        books = make_books(3, self.owner)
+        BookInstance.objects.filter(pk=books[0].pk).update(place=self.shelf)
+        BookInstance.objects.filter(pk=books[1].pk).update(place=self.case)
+        BookInstance.objects.filter(pk=books[2].pk).update(place=other)
+
+        with self.assertNumQueries(1):
+            self.assertEqual({b.pk for b in self.room.get_books()}, {books[0].pk, books[1].pk})
+
+        response = self.client.get('/api/v1/list_book/', {'place': self.case.pk})
+        self.assertEqual({b['id'] for b in response.json()['results']}, {str(books[0].pk), str(books[1].pk)})
+        response = self.client.get('/api/v1/list_book/', {'place': 999})
+        self.assertEqual(response.json()['results'], [])
+
+
+class BookSearchTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.tolstoy = Author.objects.create(first_name='Лев', last_name='Толстой')
+        self.novel = Genre.objects.create(name='Роман')
+        self.war = BookInstance.objects.create(title='Война и мир', author=self.tolstoy, owner=self.owner,
+                                               summary='Эпопея о войне 1812 года', isbn='9785170906')
+        self.war.genre.add(self.novel)
+        self.anna = BookInstance.objects.create(title='Анна Каренина', author=self.tolstoy, owner=self.owner,
+                                                summary='Роман о любви и войне чувств')
+
+    def search(self, q):
+        response = self.client.get('/api/v1/search/', {'q': q})
+        return [b['title'] for b in response.json()['results']]
+
+    def test_ranked_prefix_search(self):
+        self.assertEqual(self.search('войн'), ['Война и мир', 'Анна Каренина'])
+        self.assertEqual(self.search('толст анна'), ['Анна Каренина'])
+        self.assertEqual(self.search('978517'), ['Война и мир'])
+        self.assertEqual(self.search(''), [])
+
+    def test_index_follows_changes(self):
+        self.assertEqual(self.search('роман'), ['Война и мир', 'Анна Каренина'])
+        self.war.genre.remove(self.novel)
+        self.assertEqual(self.search('роман'), ['Анна Каренина'])
+
+        self.tolstoy.last_name = 'Tolstoy'
+        self.tolstoy.save()
+        self.assertEqual(len(self.search('tolst')), 2)
+
+        self.anna.delete()
+        self.assertEqual(self.search('каренина'), [])
+
+    def test_only_available_books(self):
+        BookInstance.objects.filter(pk=self.war.pk).update(status='m')
+        self.assertEqual(self.search('войн'), ['Анна Каренина'])
+
+    def test_limit_filled_past_filtered_candidates(self):
+        # выданные книги ранжируются выше (совпадение в названии), доступная - только в описании
+        for i in range(6):
+            BookInstance.objects.create(title=f'Пушкин {i}', author=self.tolstoy, owner=self.owner,
+                                        summary='Выдана', status='o', loaner=self.owner)
+        BookInstance.objects.create(title='Сказки', author=self.tolstoy, owner=self.owner, summary='Пушкин')
+        books = search_books('пушкин', BookInstance.objects.filter(status='a'), limit=1)
+        self.assertEqual([book.title for book in books], ['Сказки'])
+        self.assertEqual(len(search_books('пушкин', BookInstance.objects.filter(status='o'), limit=20)), 6)
+        # число страниц кандидатов ограничено
+        with mock.patch('bookcross.search.MAX_ROUNDS', 1), self.assertNumQueries(2):
+            self.assertEqual(search_books('пушкин', BookInstance.objects.filter(status='a'), limit=1), [])
+
+    def test_rebuild_search_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        self.assertEqual(self.search('войн'), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(len(self.search('войн')), 2)
+
+
+class ExpireReservationsTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.reader = User.objects.create_user('reader', password='pass')
+        self.books = make_books(5, self.owner, status='r')
+        now = timezone.now()
+        BookInstance.objects.update(loaner=self.reader, reserved_time=now - MAX_RESERVED_TIME * 2)
+        BookInstance.objects.filter(pk=self.books[0].pk).update(reserved_time=now)
+
+    def test_expires_in_batches(self):
+        with self.assertLogs('bookcross.reservations') as logs:
+            result = expire_reservations(batch_size=2)
+        self.assertEqual((result.expired, result.batches), (4, 2))
+        self.assertIn('expired=4', logs.output[0])
+
+        self.assertEqual(BookInstance.objects.filter(status='r').get().pk, self.books[0].pk)
+        released = BookInstance.objects.filter(status='a')
+        self.assertEqual(released.filter(loaner=None, reserved_time=None).count(), 4)
+        history = CrossHistory.objects.all()
+        self.assertEqual(history.count(), 4)
+        self.assertTrue(all(h.loaner == self.reader for h in history))
+
+    def test_sweep_query_count(self):
+        # пачка: выборка, UPDATE, INSERT; затем пустая выборка;
+        # внутри TestCase каждая транзакция еще дает SAVEPOINT и RELEASE
+        with self.assertNumQueries(3 + 1 + 2 * 2):
+            expire_reservations(batch_size=100)
+
+
+class BulkStatusChangeTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.reader = User.objects.create_user('reader', password='pass')
+        self.books = make_books(200, self.owner)
+        self.ids = [str(b.pk) for b in self.books]
+
+    def test_change_status_writes_history_in_batch(self):
+        BookInstance.objects.filter(pk=self.books[0].pk).update(status='m')
+        # SAVEPOINT, выборка, UPDATE, два INSERT истории (199 строк по 6 столбцов больше лимита
+        # в 999 параметров SQLite), RELEASE
+        with self.assertNumQueries(6):
+            changed = change_status(BookInstance.objects.all(), 'm')
+        self.assertEqual(changed, 199)
+        self.assertEqual(CrossHistory.objects.count(), 199)
+        self.assertEqual(CrossHistory.objects.first().comment, 'Статус книги изменен c Доступна на В ремонте')
+
+    def test_reserve_requires_loaner(self):
+        with self.assertRaises(ValidationError):
+            change_status(BookInstance.objects.all(), 'r')
+        change_status(BookInstance.objects.all(), 'r', loaner=self.reader)
+        book = BookInstance.objects.get(pk=self.books[0].pk)
+        self.assertEqual(book.loaner, self.reader)
+        self.assertIsNotNone(book.reserved_time)
+
+        change_status(BookInstance.objects.all(), 'o', loaner=self.reader)
+        self.assertFalse(BookInstance.objects.filter(reserved_time__isnull=False).exists())
+        change_status(BookInstance.objects.all(), 'a', loaner=self.reader)
+        self.assertFalse(BookInstance.objects.filter(loaner__isnull=False).exists())
+
+    def test_api(self):
+        url = '/api/v1/list_book/bulk_status/'
+        self.assertEqual(self.client.post(url, {'ids': self.ids, 'status': 'm'}).status_code, 403)
+
+        self.client.force_login(self.owner)
+        response = self.client.post(url, {'ids': self.ids[:50], 'status': 'o'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, {'ids': self.ids[:50], 'status': 'o', 'loaner': self.reader.pk},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'changed': 50})
+        self.assertEqual(BookInstance.objects.filter(status='o', loaner=self.reader).count(), 50)
+
+    def test_admin_action(self):
+        self.client.force_login(self.owner)
+        response = self.client.post('/admin/bookcross/bookinstance/',
+                                    {'action': 'send_to_repair', '_selected_action': self.ids[:10]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(BookInstance.objects.filter(status='m').count(), 10)
+
+
+class ThumbnailTest(TransactionTestCase):
+    # копии создаются после коммита книги
+    def setUp(self):
+        get_cache().clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        override = override_settings(MEDIA_ROOT=self.media, THUMBNAIL_WORKERS=0, THUMBNAIL_WIDTHS=(150, 300))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.owner = User.objects.create_user('owner', password='pass')
+
+    def upload(self, name='cover.jpg', size=(1200, 1800)):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def test_cover_upload_creates_thumbnails(self):
+        book = BookInstance.objects.create(title='Книга', owner=self.owner, cover=self.upload())
+        created = book.modified
+        book.refresh_from_db()
+        self.assertTrue(book.cover_thumbnails)
+        self.assertGreater(book.modified, created)
+        srcset = book.get_cover_srcset()
+        self.assertEqual(set(srcset), {'webp', 'jpeg'})
+        self.assertIn('_150.webp 150w', srcset['webp'])
+        self.assertIn('_300.jpg 300w', srcset['jpeg'])
+        with Image.open(default_storage.path(thumbnail_name(book.cover.name, 300, 'webp'))) as thumb:
+            self.assertEqual(thumb.size, (300, 450))
+
+        data = self.client.get(f'/api/v1/list_book/{book.pk}/').json()
+        self.assertEqual(data['get_cover_srcset'], srcset)
+        # готовность берется из поля книги, storage при выдаче не проверяется
+        os.remove(default_storage.path(thumbnail_name(book.cover.name, 150, 'jpeg')))
+        self.assertEqual(self.client.get('/api/v1/list_book/').json()['results'][0]['get_cover_srcset'], srcset)
+
+    def test_new_cover_resets_flag(self):
+        book = BookInstance.objects.create(title='Книга', owner=self.owner, cover=self.upload())
+        book = BookInstance.objects.get(pk=book.pk)
+        book.cover = self.upload('other.jpg')
+        with transaction.atomic():
+            book.save()
+            # копии новой обложки создаются после коммита, до этого srcset нет
+            self.assertFalse(book.cover_thumbnails)
+            self.assertIsNone(book.get_cover_srcset())
+        book.refresh_from_db()
+        self.assertIn('other_150.jpg', book.get_cover_srcset()['jpeg'])
+
+    def test_avatar_thumbnails(self):
+        profile = self.owner.profile
+        profile.photo = self.upload('me.jpg', (100, 100))
+        profile.save()
+        self.assertTrue(profile.photo_thumb_url.endswith('me_150.jpg'))
+
+    def test_avatar_only_on_new_photo(self):
+        with mock.patch('account.models.ensure_thumbnails') as ensure:
+            self.owner.save()
+            self.client.login(username='owner', password='pass')
+            self.assertFalse(ensure.called)
+            profile = Profile.objects.get(user=self.owner)
+            profile.photo = self.upload('me.jpg', (100, 100))
+            with transaction.atomic():
+                profile.save()
+                self.assertFalse(ensure.called)
+            ensure.assert_called_once_with(profile.photo.name)
+            profile.save()
+            self.assertEqual(ensure.call_count, 1)
+
+    def test_pool_callback_closes_connections(self):
+        future = Future()
+        future.set_result(1)
+        ready = []
+        with mock.patch('bookcross.thumbnails.connections') as connections_mock:
+            generation_done('a.jpg', ready.extend, threading.get_ident())(future)
+            self.assertFalse(connections_mock.close_all.called)
+            thread = threading.Thread(target=generation_done('b.jpg', ready.extend, threading.get_ident()),
+                                      args=[future])
+            thread.start()
+            thread.join()
+            self.assertEqual(connections_mock.close_all.call_count, 1)
+        self.assertEqual(ready, ['a.jpg', 'b.jpg'])
+
+    def test_backfill_command(self):
+        book = BookInstance.objects.create(title='Книга', owner=self.owner, cover=self.upload())
+        os.remove(default_storage.path(thumbnail_name(book.cover.name, 150, 'jpeg')))
+        BookInstance.objects.filter(pk=book.pk).update(cover_thumbnails=False)
+        book.refresh_from_db()
+        self.assertIsNone(book.get_cover_srcset())
+        out = StringIO()
+        call_command('generate_thumbnails', workers=2, stdout=out)
+        self.assertIn('Готово: 1, ошибок: 0', out.getvalue())
+        book.refresh_from_db()
+        self.assertIsNotNone(book.get_cover_srcset())
+
+
+class CatalogCacheTest(TransactionTestCase):
+    # версия каталога увеличивается после коммита, внутри транзакции TestCase этого не случится
+    def setUp(self):
+        get_cache().clear()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.books = make_books(5, self.owner)
+
+    def test_api_list_is_cached_until_catalog_changes(self):
+        self.client.get('/api/v1/list_book/')
+        # только агрегат для ETag, сами книги из кэша
+        with self.assertNumQueries(1):
+            self.client.get('/api/v1/list_book/')
+        self.assertEqual((cache_stats()['hits'], cache_stats()['misses']), (1, 1))
+
+        author = Author.objects.get(pk=self.books[0].author_id)
+        author.last_name = 'Пушкин'
+        author.save()
+        response = self.client.get('/api/v1/list_book/')
+        self.assertIn('Пушкин, Имя0', [b['author'] for b in response.json()['results']])
+
+    def test_version_bumped_after_commit(self):
+        version = catalog_version()
+        with transaction.atomic():
+            self.books[0].title = 'Новое название'
+            self.books[0].save()
+            # параллельный читатель до коммита не закэширует старые данные под новой версией
+            self.assertEqual(catalog_version(), version)
+        self.assertGreater(catalog_version(), version)
+
+    def test_service_writes_bump_after_commit(self):
+        version = catalog_version()
+        with transaction.atomic():
+            change_status(BookInstance.objects.filter(pk=self.books[0].pk), 'm')
+            add_favorite(self.books[1].pk, self.owner)
+            rate_book(self.books[1].pk, self.owner, '4')
+            self.assertEqual(catalog_version(), version)
+        self.assertGreater(catalog_version(), version)
+
+    def test_place_and_owner_changes_invalidate(self):
+        room = Place.objects.create(owner=self.owner, title='Комната')
+        shelf = Place.objects.create(owner=self.owner, title='Полка', parent_place=room)
+        BookInstance.objects.filter(pk=self.books[0].pk).update(place=shelf)
+        bump_catalog_version()
+        self.assertEqual(len(self.client.get('/api/v1/list_book/', {'place': room.pk}).json()['results']), 1)
+        # перенос места меняет выдачу ?place= родителя
+        shelf.parent_place = None
+        shelf.save()
+        self.assertEqual(self.client.get('/api/v1/list_book/', {'place': room.pk}).json()['results'], [])
+
+        self.owner.username = 'renamed'
+        self.owner.save()
+        self.assertEqual(self.client.get('/api/v1/list_book/').json()['results'][0]['owner'], 'renamed')
+        # вход пользователя каталог не меняет
+        version = catalog_version()
+        self.client.login(username='renamed', password='pass')
+        self.assertEqual(catalog_version(), version)
+
+    def test_version_not_reused_after_eviction(self):
+        key = make_key('api_list', 'url')
+        get_cache().set(key, 'старые данные')
+        get_cache().delete(VERSION_KEY)
+        bump_catalog_version()
+        self.assertNotEqual(make_key('api_list', 'url'), key)
+        get_cache().delete(VERSION_KEY)
+        self.assertNotEqual(make_key('api_list', 'url'), key)
+
+    def test_detail_and_rating_invalidation(self):
+        url = f'/api/v1/list_book/{self.books[0].pk}/'
+        self.assertEqual(self.client.get(url).json()['get_rating'], 0)
+        BookRating.objects.create(book=self.books[0], user=self.owner, rating='4')
+        self.assertEqual(self.client.get(url).json()['get_rating'], 4)
+
+    def test_bulk_status_change_invalidates(self):
+        self.assertEqual(len(self.client.get('/api/v1/list_book/').json()['results']), 5)
+        change_status(BookInstance.objects.filter(pk=self.books[0].pk), 'm')
+        self.assertEqual(len(self.client.get('/api/v1/list_book/').json()['results']), 4)
+
+    def test_html_list_is_cached(self):
+        self.client.force_login(self.owner)
+        self.assertContains(self.client.get('/'), 'Книга 00004')
+        # сессия и пользователь, книги берутся из кэша
+        with self.assertNumQueries(2):
+            self.assertContains(self.client.get('/'), 'Книга 00004')
+        self.books[4].genre.clear()
+        with self.assertNumQueries(3):
+            self.client.get('/')
+
+    def test_cache_stats_command(self):
+        self.client.get('/api/v1/list_book/')
+        out = StringIO()
+        call_command('cache_stats', stdout=out)
+        self.assertIn('Попаданий: 0, промахов: 1', out.getvalue())
+
+
+class ConditionalGetTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.books = make_books(5, self.owner)
+
+    def test_list_etag(self):
+        response = self.client.get('/api/v1/list_book/')
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/list_book/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/v1/list_book/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # другие параметры - другой ETag
+        self.assertNotEqual(self.client.get('/api/v1/list_book/', {'page_size': 2})['ETag'], etag)
+
+    def test_list_etag_changes_with_catalog(self):
+        etag = self.client.get('/api/v1/list_book/')['ETag']
+        genre = Genre.objects.first()
+        genre.name = 'Поэзия'
+        genre.save()
+        response = self.client.get('/api/v1/list_book/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        self.books[0].delete()
+        self.assertEqual(self.client.get('/api/v1/list_book/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail_etag(self):
+        url = f'/api/v1/list_book/{self.books[0].pk}/'
+        etag = self.client.get(url)['ETag']
+        self.assertNotEqual(self.client.get(f'/api/v1/list_book/{self.books[1].pk}/')['ETag'], etag)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        BookRating.objects.create(book=self.books[0], user=self.owner, rating='3')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/list_book/not-a-uuid/').status_code, 404)
+
+    def test_patch_changes_etag(self):
+        url = f'/api/v1/list_book/{self.books[0].pk}/'
+        etag, list_etag = self.client.get(url)['ETag'], self.client.get('/api/v1/list_book/')['ETag']
+        response = self.client.patch(url, {'title': 'Новое название'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertEqual(self.client.get('/api/v1/list_book/', HTTP_IF_NONE_MATCH=list_etag).status_code, 200)
+
+
+class SimilarBooksLockTest(TransactionTestCase):
+    # TransactionTestCase: внутри транзакции TestCase не видно, открыта ли транзакция расчета
+    def setUp(self):
+        get_cache().clear()
+        owner = User.objects.create_user('owner', password='pass')
+        self.books = make_books(3, owner)
+        for book in self.books:
+            Favorite.objects.create(book=book, user=owner)
+
+    def test_neighbours_computed_outside_transaction(self):
+        in_transaction = []
+
+        def neighbours(*args, **kwargs):
+            for item in compute_neighbours(*args, **kwargs):
+                in_transaction.append(connection.in_atomic_block)
+                yield item
+
+        with mock.patch('bookcross.recommendations.compute_neighbours', neighbours):
+            build_similar_books(batch_size=1)
+        self.assertEqual(in_transaction, [False] * 3)
+        self.assertEqual(SimilarBook.objects.count(), 6)
+
+
+class FavoriteCountTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.readers = [User.objects.create_user(f'reader{i}', password='pass') for i in range(3)]
+        self.books = make_books(3, self.owner)
+
+    def test_counter_follows_favorites(self):
+        favorites = [Favorite.objects.create(book=self.books[0], user=u) for u in self.readers]
+        Favorite.objects.create(book=self.books[1], user=self.readers[0])
+        favorites[0].delete()
+        counts = dict(BookInstance.objects.values_list('pk', 'favorite_count'))
+        self.assertEqual([counts[b.pk] for b in self.books], [2, 1, 0])
+        url = f'/api/v1/list_book/{self.books[0].pk}/'
+        self.assertEqual(self.client.get(url).json()['favorite_count'], 2)
+
+    def test_rebuild_favorite_counts(self):
+        Favorite.objects.create(book=self.books[2], user=self.readers[0])
+        BookInstance.objects.update(favorite_count=7)
+        call_command('rebuild_favorite_counts', stdout=StringIO())
+        counts = dict(BookInstance.objects.values_list('pk', 'favorite_count'))
+        self.assertEqual([counts[b.pk] for b in self.books], [0, 0, 1])
+
+    def test_rankings(self):
+        for book, users in ((self.books[0], self.readers[:1]), (self.books[1], self.readers)):
+            for user in users:
+                Favorite.objects.create(book=book, user=user)
+        # старое избранное попадает только в рейтинг за месяц
+        old = Favorite.objects.create(book=self.books[2], user=self.readers[0])
+        Favorite.objects.filter(pk=old.pk).update(create_date=timezone.now().date() - datetime.timedelta(days=10))
+        call_command('compute_favorite_rankings', stdout=StringIO())
+
+        with self.assertNumQueries(2):
+            week = self.client.get('/api/v1/favorites/top/', {'period': 'week'}).json()['results']
+        self.assertEqual([(r['position'], r['book']['title'], r['count']) for r in week],
+                         [(1, 'Книга 00001', 3), (2, 'Книга 00000', 1)])
+        month = self.client.get('/api/v1/favorites/top/', {'period': 'month'}).json()['results']
+        self.assertEqual(len(month), 3)
+        self.assertEqual(self.client.get('/api/v1/favorites/top/', {'period': 'year'}).status_code, 400)
+
+
+class SimilarBooksTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.readers = [User.objects.create_user(f'reader{i}', password='pass') for i in range(3)]
+        self.books = make_books(4, self.owner)
+        # книги 0 и 1 нравятся одним и тем же читателям, книгу 2 читает только reader2
+        for reader in self.readers[:2]:
+            Favorite.objects.create(book=self.books[0], user=reader)
+            BookRating.objects.create(book=self.books[1], user=reader, rating='5')
+        Favorite.objects.create(book=self.books[1], user=self.readers[2])
+        Favorite.objects.create(book=self.books[2], user=self.readers[2])
+
+    def neighbours(self, book):
+        return list(SimilarBook.objects.filter(book=book).order_by('rank').values_list('similar_id', flat=True))
+
+    def test_build_and_api(self):
+        stats = build_similar_books(top_k=5)
+        self.assertEqual((stats.books, stats.users, stats.interactions, stats.refreshed), (3, 3, 6, 3))
+        self.assertEqual(self.neighbours(self.books[0]), [self.books[1].pk])
+        self.assertEqual(self.neighbours(self.books[1]), [self.books[0].pk, self.books[2].pk])
+        self.assertEqual(self.neighbours(self.books[3]), [])
+
+        with self.assertNumQueries(2):
+            results = self.client.get(f'/api/v1/list_book/{self.books[1].pk}/similar/').json()['results']
+        self.assertEqual([r['book']['title'] for r in results], ['Книга 00000', 'Книга 00002'])
+        self.assertGreater(results[0]['score'], results[1]['score'])
+
+    def test_incremental(self):
+        build_similar_books()
+        computed_at = SimilarBook.objects.filter(book=self.books[0]).values_list('computed_at', flat=True).get()
+        Favorite.objects.create(book=self.books[3], user=self.readers[2])
+        stats = build_similar_books(incremental=True)
+        self.assertEqual(stats.refreshed, 1)
+        self.assertEqual(self.neighbours(self.books[3]), [self.books[2].pk, self.books[1].pk])
+        # соседи неизмененных книг не пересчитывались
+        self.assertEqual(SimilarBook.objects.filter(book=self.books[0]).values_list('computed_at', flat=True).get(),
+                         computed_at)
+
+    def test_full_build_drops_books_without_interactions(self):
+        build_similar_books()
+        Favorite.objects.filter(book=self.books[2]).delete()
+        build_similar_books()
+        self.assertEqual(self.neighbours(self.books[2]), [])
+        self.assertEqual(self.neighbours(self.books[0]), [self.books[1].pk])
+
+    def test_command(self):
+        out = StringIO()
+        call_command('build_similar_books', '--top-k', '1', stdout=out)
+        self.assertIn('Пересчитано книг: 3', out.getvalue())
+        self.assertEqual(SimilarBook.objects.filter(book=self.books[1]).count(), 1)
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_100k_books(self):
+        import numpy as np
+
+        n_users, n_items, per_user = 50000, 100000, 20
+        rng = np.random.default_rng(0)
+        rows = np.repeat(np.arange(n_users, dtype=np.int32), per_user)
+        cols = rng.integers(0, n_items, size=len(rows), dtype=np.int32)
+        values = np.ones(len(rows), dtype=np.float32)
+        started = time.monotonic()
+        total = sum(len(neighbours) for _, neighbours, _ in compute_neighbours(rows, cols, values, n_users, n_items))
+        duration = time.monotonic() - started
+        print(f'\n{n_items} книг, {len(rows)} взаимодействий: {duration:.1f} с, {total} соседей')
+        self.assertGreater(total, 0)
+
+
+class BookImportTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.tmp = tempfile.mkdtemp()
+        Author.objects.create(last_name='Толстой', first_name='Лев')
+        Genre.objects.create(name='Роман')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def csv_file(self, count=30):
+        rows = ['title,author,genres,summary,isbn,status']
+        rows += [f'Книга {i},"{("Толстой, Лев", "Чехов, Антон", "Гоголь, Николай")[i % 3]}",Роман;Повесть,'
+                 f'Описание,978{i:010},a' for i in range(count)]
+        return self.write('books.csv', '\n'.join(rows) + '\n')
+
+    def test_csv(self):
+        path = self.csv_file(30)
+        # запросы не зависят от числа строк: авторы и жанры ищутся и создаются пачкой
+        with self.assertNumQueries(13):
+            result = import_books(path, self.owner, chunk_size=100, progress=None)
+        self.assertEqual((result.rows, result.created, result.authors_created, result.genres_created), (30, 30, 2, 1))
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(BookInstance.genre.through.objects.count(), 60)
+        book = BookInstance.objects.get(title='Книга 4')
+        self.assertEqual(str(book.author), 'Чехов, Антон')
+        self.assertEqual(sorted(book.genre.values_list('name', flat=True)), ['Повесть', 'Роман'])
+        # bulk_create не шлет сигналов - импорт сам добавляет книги в поисковый индекс
+        self.assertEqual(len(self.client.get('/api/v1/search/', {'q': 'гоголь'}).json()['results']), 10)
+
+    def test_jsonl_errors_and_dry_run(self):
+        path = self.write('books.jsonl', '\n'.join([
+            '{"title": "Вий", "author": "Гоголь, Николай", "genres": ["Повесть"], "isbn": 9785170000000}',
+            '{"title": ""}',
+            '{"title": "Нос", "status": "o"}',
+            'не json',
+            '{"title": "Чужая", "owner": "nobody"}',
+        ]))
+        result = import_books(path, self.owner, dry_run=True)
+        self.assertEqual((result.rows, result.created, result.authors_created), (5, 1, 1))
+        self.assertEqual([line for line, _ in result.errors], [2, 3, 4, 5])
+        self.assertFalse(BookInstance.objects.exists())
+
+        result = import_books(path, self.owner)
+        self.assertEqual(result.created, 1)
+        self.assertEqual(BookInstance.objects.get().isbn, '9785170000000')
+
+    def test_resume(self):
+        path = self.csv_file(10)
+        progress = os.path.join(self.tmp, 'progress.json')
+        import_books(path, self.owner, chunk_size=4, progress=progress)
+        self.assertEqual(BookInstance.objects.count(), 10)
+        # повторный запуск после завершенного импорта ничего не дублирует
+        result = import_books(path, self.owner, chunk_size=4, progress=progress)
+        self.assertEqual((result.rows, BookInstance.objects.count()), (0, 10))
+
+        with open(progress, 'w') as f:
+            json.dump({'source': os.path.abspath(path), 'line': 5}, f)
+        BookInstance.objects.exclude(title__in=[f'Книга {i}' for i in range(4)]).delete()
+        result = import_books(path, self.owner, chunk_size=4, progress=progress)
+        self.assertEqual((result.rows, BookInstance.objects.count()), (6, 10))
+
+    def test_command_and_admin(self):
+        out = StringIO()
+        call_command('import_books', self.csv_file(3), '--owner', 'owner', '--dry-run', stdout=out)
+        self.assertIn('книг: 3', out.getvalue())
+        self.assertFalse(BookInstance.objects.exists())
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        upload = SimpleUploadedFile('books.csv', 'title,author\nВий,"Гоголь, Николай"\n'.encode())
+        response = self.client.post('/admin/bookcross/bookinstance/import/', {'file': upload, 'owner': self.owner.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(BookInstance.objects.get().title, 'Вий')
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_100k_rows(self):
+        path = os.path.join(self.tmp, 'big.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('title,author,genres,summary\n')
+            for i in range(100000):
+                f.write(f'Книга {i},"Автор{i % 5000}, Имя",Жанр{i % 50};Жанр{(i + 1) % 50},Описание книги {i}\n')
+        result = import_books(path, self.owner)
+        print(f'\n{result.created} книг за {result.duration:.1f} с')
+        self.assertEqual(result.created, 100000)
+
+
+class AdminChangelistQueryTest(BookcrossTestCase):
+    """
+    Число запросов страницы списка в админке не должно зависеть от числа строк
+    """
+    urls = ['/admin/bookcross/bookinstance/', '/admin/bookcross/crosshistory/', '/admin/bookcross/place/']
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        self.root = Place.objects.create(title='Город', owner=self.admin)
+
+    def add_rows(self, count):
+        place = Place.objects.create(title=f'Полка {Place.objects.count()}', parent_place=self.root, owner=self.admin)
+        books = make_books(count, self.admin)
+        BookInstance.objects.filter(pk__in=[b.pk for b in books]).update(place=place)
+        change_status(BookInstance.objects.filter(pk__in=[b.pk for b in books]), 'm')
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow(self):
+        self.add_rows(3)
+        before = {url: self.count_queries(url) for url in self.urls}
+        self.add_rows(20)
+        after = {url: self.count_queries(url) for url in self.urls}
+        self.assertEqual(after, before)
+
+    def test_history_book_filter(self):
+        self.add_rows(2)
+        book = CrossHistory.objects.first().book
+        response = self.client.get('/admin/bookcross/crosshistory/', {'book': str(book.pk)})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        response = self.client.get('/admin/bookcross/crosshistory/', {'book': 'not-a-uuid'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_10k_rows(self):
+        self.add_rows(10000)
+        User.objects.bulk_create([User(username=f'user{i}') for i in range(10000)])
+        for url in self.urls + ['/admin/auth/user/']:
+            started = time.monotonic()
+            queries = self.count_queries(url)
+            print(f'\n{url}: {queries} запросов, {time.monotonic() - started:.2f} с')
+
+
+class DatasetBenchmarkTest(BookcrossTestCase):
+    def test_generate_and_benchmark(self):
+        result = generate_dataset(books=200, seed=1)
+        self.assertEqual((result.users, result.authors, BookInstance.objects.count()), (20, 40, 200))
+        self.assertEqual(set(BookInstance.objects.values_list('status', flat=True)), {'a', 'o', 'r', 'm', 'x'})
+        self.assertFalse(BookInstance.objects.filter(status__in=['o', 'r'], loaner=None).exists())
+        self.assertFalse(BookInstance.objects.filter(place__end=False).exists())
+        self.assertFalse(Place.objects.filter(path='').exists())
+        self.assertEqual(BookRating.objects.count(), 200)
+        self.assertEqual(sum(BookInstance.objects.values_list('favorite_count', flat=True)), 60)
+        self.assertEqual(CrossHistory.objects.count(), BookInstance.objects.exclude(status='a').count())
+        # второй набор добавляется к первому
+        self.assertEqual(generate_dataset(books=10).users, 10)
+        self.assertEqual(User.objects.count(), 30)
+
+        report = run_benchmarks(repeat=3, warmup=1)
+        self.assertEqual(set(report['endpoints']), set(ENDPOINTS))
+        for name, stats in report['endpoints'].items():
+            self.assertEqual(stats['status'], 200, name)
+            self.assertLessEqual(stats['p50_ms'], stats['p95_ms'])
+            self.assertGreater(stats['queries'], 0)
+        # временный администратор не остается в базе
+        self.assertFalse(User.objects.filter(username=BENCH_ADMIN).exists())
+        self.assertEqual(report['users'], 30)
+
+    def test_commands(self):
+        call_command('generate_data', '--books', '20', stdout=StringIO())
+        out = StringIO()
+        call_command('run_benchmarks', '--repeat', '1', '--warmup', '0', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['books'], 20)
+
+
+@override_settings(REQUEST_METRICS_SAMPLE_RATE=1.0)
+class RequestMetricsTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        reset_metrics()
+        self.owner = User.objects.create_user('owner', password='pass')
+        make_books(3, self.owner)
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/v1/list_book/')
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 'tpl', 'view', 'total'})
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+
+        self.client.login(username='owner', password='pass')
+        response = self.client.get('/')
+        tpl = float(response['Server-Timing'].split('tpl;dur=')[1].split(',')[0])
+        self.assertGreater(tpl, 0)
+
+    def test_template_hook_only_during_sampled_requests(self):
+        render = Template._render
+        self.client.login(username='owner', password='pass')
+        with mock.patch.object(template_timer, 'timed_render', wraps=template_timer.timed_render) as timed:
+            self.client.get('/')
+            with override_settings(REQUEST_METRICS_SAMPLE_RATE=0):
+                # цепочка middleware собирается при первом запросе клиента - нужен новый
+                Client().get('/api/v1/list_book/')
+        self.assertEqual(timed.call_count, 1)
+        self.assertIs(Template._render, render)
+
+    @override_settings(REQUEST_METRICS_SLOW_MS=0)
+    def test_slow_request_log(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        with self.assertLogs('pbl.requests', 'WARNING') as logs:
+            self.client.get('/admin/bookcross/bookinstance/')
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((record['event'], record['view'], record['status']),
+                         ('slow_request', 'admin:bookcross_bookinstance_changelist', 200))
+        self.assertEqual(len(record['slowest_sql']), 5)
+        self.assertIn('duplicated_sql', record)
+
+    @override_settings(REQUEST_METRICS_SLOW_MS=0, REQUEST_METRICS_SAMPLE_RATE=0)
+    def test_slow_request_log_without_sampling(self):
+        with self.assertLogs('pbl.requests', 'WARNING') as logs:
+            self.client.get('/api/v1/list_book/')
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((record['view'], record['status'], record['sampled']), ('bookinstance-list', 200, False))
+        self.assertIn('total_ms', record)
+        self.assertNotIn('slowest_sql', record)
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=0)
+    def test_sampling_and_prometheus_endpoint(self):
+        response = self.client.get('/api/v1/list_book/')
+        self.assertNotIn('Server-Timing', response)
+        self.client.get('/api/v1/list_book/')
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('pbl_request_duration_seconds_count{view="bookinstance-list"} 2', text)
+        self.assertIn('pbl_request_duration_seconds_bucket{view="bookinstance-list",le="+Inf"} 2', text)
+        # подробные замеры только у сэмплированных запросов
+        self.assertNotIn('pbl_request_queries_count{view="bookinstance-list"}', text)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 403)
+        self.assertEqual(render_metrics().count('_count{'), 2)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class PrimaryReplicaRouterTest(TransactionTestCase):
+    # replica в тестах - зеркало default, но запросы к ней идут через отдельное соединение.
+    # TransactionTestCase: внутри транзакции TestCase все чтение и так идет в default
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        get_cache().clear()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.books = make_books(3, self.owner)
+        self.token = pin_primary(False)
+
+    def tearDown(self):
+        reset_pin(self.token)
+
+    def queries(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = getattr(self.client, method)(*args, **kwargs)
+        return response, len(primary), len(replica)
+
+    def test_router(self):
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_read(BookInstance), 'replica')
+        self.assertEqual(router.db_for_write(BookInstance), 'default')
+        # после записи свое читаем с основной базы
+        self.assertTrue(is_pinned())
+        self.assertEqual(router.db_for_read(BookInstance), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'bookcross'))
+        self.assertTrue(router.allow_migrate('default', 'bookcross'))
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(PrimaryReplicaRouter().db_for_read(BookInstance), 'default')
+
+    def test_requests(self):
+        response, primary, replica = self.queries('get', '/api/v1/list_book/')
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'pass')
+        self.client.login(username='admin', password='pass')
+        pin_primary(False)  # create_superuser и login писали в базу вне запроса
+        response, primary, replica = self.queries(
+            'post', '/api/v1/list_book/bulk_status/', {'ids': [str(self.books[0].pk)], 'status': 'm'},
+            content_type='application/json')
+        self.assertEqual(response.json(), {'changed': 1})
+        self.assertEqual(replica, 0)
+        # прилипание заканчивается вместе с запросом
+        self.assertFalse(is_pinned())
+        self.assertEqual(len(self.client.get('/api/v1/list_book/').json()['results']), 2)
+
+    def test_sqlite_pragmas(self):
+        path = os.path.join(tempfile.mkdtemp(), 'wal.sqlite3')
+        wrapper = SQLiteDatabaseWrapper({**connections['default'].settings_dict, 'NAME': path}, alias='wal_check')
+        try:
+            with wrapper.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                self.assertEqual(cursor.fetchone()[0], 'wal')
+                cursor.execute('PRAGMA busy_timeout')
+                self.assertEqual(cursor.fetchone()[0], 5000)
+                cursor.execute('PRAGMA synchronous')
+                self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+        finally:
+            wrapper.close()
+            shutil.rmtree(os.path.dirname(path))
+
+
+class RecordingBroker:
+    def __init__(self):
+        self.events = []
+
+    def publish(self, event):
+        self.events.append(event)
+
+
+@override_settings(BOOKCROSS_EVENT_BROKER='bookcross.tests.RecordingBroker')
+class StatusEventsTest(TransactionTestCase):
+    # TransactionTestCase: события уходят в on_commit
+    def setUp(self):
+        get_cache().clear()
+        get_broker().events.clear()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.books = make_books(3, self.owner)
+
+    def published(self):
+        return [(e['book'], e['old_status'], e['status']) for e in get_broker().events]
+
+    def test_status_changes_are_published(self):
+        book = BookInstance.objects.get(pk=self.books[0].pk)
+        book.status = 'm'
+        book.save()
+        book.save()  # повторное сохранение без смены статуса - ни истории, ни события
+        self.assertEqual(self.published(), [(str(book.pk), 'a', 'm')])
+        self.assertEqual(CrossHistory.objects.filter(book=book).count(), 1)
+
+        get_broker().events.clear()
+        change_status(BookInstance.objects.all(), 'x')
+        self.assertEqual(sorted(self.published()), sorted((str(b.pk), 'a' if b != self.books[0] else 'm', 'x')
+                                                          for b in self.books))
+        self.assertEqual(get_broker().events[0]['status_display'], 'Изьята из обращения')
+
+    def test_rolled_back_change_is_not_published(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            change_status(BookInstance.objects.all(), 'm')
+            raise RuntimeError
+        self.assertEqual(self.published(), [])
+
+
+class ServerSentEventsTest(TestCase):
+    def test_stream(self):
+        from pbl.asgi import application
+
+        async def scenario():
+            sent, disconnect = [], asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'path': EVENTS_PATH, 'method': 'GET', 'headers': []}
+            task = asyncio.ensure_future(application(scope, receive, send))
+            while len(sent) < 2:
+                await asyncio.sleep(0.01)
+            get_broker().publish({'type': 'status', 'book': 'b1', 'status': 'o'})
+            while len(sent) < 3:
+                await asyncio.sleep(0.01)
+            disconnect.set()
+            await asyncio.wait_for(task, 1)
+            return sent
+
+        sent = asyncio.run(scenario())
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream; charset=utf-8'), sent[0]['headers'])
+        body = sent[2]['body'].decode()
+        self.assertTrue(body.startswith('id: '))
+        self.assertIn('event: status\n', body)
+        self.assertEqual(json.loads(body.split('data: ')[1])['book'], 'b1')
+        # после отключения клиента подписка снята
+        self.assertFalse(get_broker().subscribers)
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_idle_connections(self):
+        from bookcross.events import sse_app
+        clients = 5000
+
+        async def scenario():
+            disconnect = asyncio.Event()
+            delivered = []
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message.get('body', b'').startswith(b'id: '):
+                    delivered.append(1)
+
+            tasks = [asyncio.ensure_future(sse_app({'type': 'http'}, receive, send)) for _ in range(clients)]
+            while len(get_broker().subscribers) < clients:
+                await asyncio.sleep(0.01)
+            started = time.monotonic()
+            get_broker().publish({'type': 'status', 'book': 'b1', 'status': 'o'})
+            while len(delivered) < clients:
+                await asyncio.sleep(0.001)
+            duration = time.monotonic() - started
+            disconnect.set()
+            await asyncio.gather(*tasks)
+            return duration
+
+        print(f'\n{clients} соединений, событие доставлено всем за {asyncio.run(scenario()) * 1000:.0f} мс')
+        self.assertFalse(get_broker().subscribers)
+
+
+class BookFieldsTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.books = make_books(5, self.owner)
+        BookInstance.objects.filter(pk=self.books[0].pk).update(author=None, summary='Очень длинное описание ' * 30)
+        BookInstance.objects.filter(pk=self.books[1].pk).update(loaner=self.owner, reserved_time=timezone.now())
+
+    def test_status_and_counters_not_writable(self):
+        book = self.books[2]
+        response = self.client.patch(f'/api/v1/list_book/{book.pk}/?fields=id,status',
+                                     {'status': 'o', 'favorite_count': 100, 'rating_count': 7},
+                                     content_type='application/json')
+        self.assertEqual(response.json()['status'], 'a')
+        book.refresh_from_db()
+        self.assertEqual((book.status, book.loaner_id, book.favorite_count, book.rating_count), ('a', None, 0, 0))
+        self.assertFalse(CrossHistory.objects.filter(book=book).exists())
+
+    def test_default_fields_unchanged(self):
+        results = self.client.get('/api/v1/list_book/').json()['results']
+        self.assertEqual(list(results[0]), BOOK_FIELD_PROFILES['detail'])
+
+    def test_card_profile_narrows_select(self):
+        with CaptureQueriesContext(connection) as captured:
+            results = self.client.get('/api/v1/list_book/', {'profile': 'card'}).json()['results']
+        self.assertEqual(list(results[0]), BOOK_FIELD_PROFILES['card'])
+        short = {item['id']: item['short_summary'] for item in results}[str(self.books[0].pk)]
+        self.assertEqual(len(short), SHORT_SUMMARY_LENGTH)
+        page_sql = captured[1]['sql']
+        self.assertNotIn('"bookcross_bookinstance"."summary" FROM', page_sql)
+        self.assertNotIn('"rating_count"', page_sql)
+        # жанров в карточке нет - и запроса за ними нет
+        self.assertEqual(len(captured), 2)
+
+    def test_fields_param(self):
+        results = self.client.get('/api/v1/list_book/', {'fields': 'id,title,id'}).json()['results']
+        self.assertEqual(list(results[0]), ['id', 'title'])
+        response = self.client.get(f'/api/v1/list_book/{self.books[2].pk}/', {'fields': 'title,author'})
+        self.assertEqual(response.json(), {'title': 'Книга 00002', 'author': 'Фамилия2, Имя2'})
+
+    def test_unknown_fields(self):
+        self.assertEqual(self.client.get('/api/v1/list_book/', {'fields': 'title,password'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/list_book/', {'profile': 'full'}).status_code, 400)
+
+    def test_fast_path_matches_serializer(self):
+        fields = BOOK_FIELD_PROFILES['admin'] + ['short_summary']
+        queryset = BookInstance.objects.order_by('title')
+        expected = BookInstanceSerializer(narrow_books(queryset, fields), many=True, fields=fields).data
+        rows = serialize_book_rows(list(book_values(queryset, fields)), fields)
+        self.assertEqual(json.loads(json.dumps(rows)), json.loads(json.dumps(expected)))
+        self.assertIsNone(rows[0]['author'])
+        self.assertEqual(rows[1]['loaner'], 'owner')
+
+    def test_fast_path_pagination(self):
+        ids = []
+        url = '/api/v1/list_book/?profile=card&page_size=2'
+        while url:
+            data = self.client.get(url).json()
+            ids += [item['id'] for item in data['results']]
+            url = data['next']
+        self.assertEqual(sorted(ids), sorted(str(book.pk) for book in self.books))
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_10k_rows(self):
+        make_books(10000, self.owner)
+        fields = BOOK_FIELD_PROFILES['detail']
+        queryset = BookInstance.objects.all()
+        for name, build, renderer in [
+            ('ModelSerializer + json', lambda: BookInstanceSerializer(
+                queryset.select_related('author', 'owner').prefetch_related('genre'), many=True).data,
+             JSONRenderer()),
+            ('values() + orjson', lambda: serialize_book_rows(list(book_values(queryset, fields)), fields),
+             FastJSONRenderer()),
+        ]:
+            started = time.monotonic()
+            body = renderer.render(build())
+            print(f'\n{name}: {time.monotonic() - started:.2f} с, {len(body) // 1024} КБ')
+
+
+class BulkBooksTest(BookcrossTestCase):
+    url = '/api/v1/list_book/bulk/'
+
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.reader = User.objects.create_user('reader', password='pass')
+        self.author = Author.objects.create(last_name='Толстой', first_name='Лев')
+        self.genres = Genre.objects.bulk_create([Genre(name='Роман'), Genre(name='Повесть')])
+        self.genres = list(Genre.objects.order_by('pk'))
+        self.client.force_login(self.owner)
+
+    def book(self, i, **fields):
+        return {'title': f'Книга {i}', 'author': self.author.pk, 'summary': 'Описание',
+                'genre': [genre.pk for genre in self.genres], **fields}
+
+    def send(self, method, data):
+        return getattr(self.client, method)(self.url, json.dumps(data), content_type='application/json')
+
+    def create(self, count):
+        response = self.send('post', {'books': [self.book(i) for i in range(count)]})
+        self.assertEqual(response.status_code, 201)
+        return [item['id'] for item in response.json()['results']]
+
+    def test_create(self):
+        response = self.send('post', {'books': [
+            self.book(0),
+            self.book(1, status='o'),
+            self.book(2, author=999),
+            {'title': 'Без описания'},
+            self.book(4, status='o', loaner=self.reader.pk, isbn='9785170'),
+        ]})
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual((data['created'], data['failed']), (2, 3))
+        self.assertEqual([item['index'] for item in data['results']], [0, 1, 2, 3, 4])
+        self.assertEqual(data['results'][0]['result'], 'created')
+        self.assertIn('non_field_errors', data['results'][1]['errors'])
+        self.assertIn('author', data['results'][2]['errors'])
+        self.assertIn('summary', data['results'][3]['errors'])
+        book = BookInstance.objects.get(pk=data['results'][4]['id'])
+        self.assertEqual((book.owner, book.loaner, book.status), (self.owner, self.reader, 'o'))
+        self.assertEqual(book.genre.count(), 2)
+        self.assertEqual(len(self.client.get('/api/v1/search/', {'q': 'книга'}).json()['results']), 1)
+
+    def test_create_queries_do_not_depend_on_batch_size(self):
+        counts = []
+        # до 50 книг bulk_create укладывается в лимит параметров одного запроса SQLite
+        for size in (10, 50):
+            with CaptureQueriesContext(connection) as captured:
+                self.create(size)
+            counts.append(len(captured))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(BookInstance.genre.through.objects.count(), 120)
+
+    def test_all_invalid(self):
+        response = self.send('post', {'books': [self.book(0, genre=[])]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.send('post', {'books': []}).status_code, 400)
+
+    def test_update(self):
+        ids = self.create(3)
+        foreign = make_books(1, self.reader)[0]
+        response = self.send('patch', {'books': [
+            {'id': ids[0], 'status': 'r', 'loaner': self.reader.pk},
+            {'id': ids[1], 'title': 'Новое название', 'genre': [self.genres[0].pk]},
+            {'id': ids[2], 'status': 'o'},
+            {'id': str(foreign.pk), 'title': 'Чужая'},
+            {'title': 'Без id'},
+        ]})
+        data = response.json()
+        self.assertEqual((data['updated'], data['failed']), (2, 3))
+        reserved = BookInstance.objects.get(pk=ids[0])
+        self.assertEqual((reserved.status, reserved.loaner), ('r', self.reader))
+        self.assertIsNotNone(reserved.reserved_time)
+        self.assertEqual(CrossHistory.objects.filter(book=reserved).count(), 1)
+        renamed = BookInstance.objects.get(pk=ids[1])
+        self.assertEqual(renamed.title, 'Новое название')
+        self.assertEqual(list(renamed.genre.all()), [self.genres[0]])
+        self.assertEqual(BookInstance.objects.get(pk=ids[2]).status, 'a')
+        self.assertEqual(BookInstance.objects.get(pk=foreign.pk).title, 'Книга 00000')
+        # возврат книги сбрасывает заемщика и резерв, как форма
+        self.send('patch', {'books': [{'id': ids[0], 'status': 'a'}]})
+        returned = BookInstance.objects.get(pk=ids[0])
+        self.assertEqual((returned.loaner, returned.reserved_time), (None, None))
+
+    def test_delete(self):
+        ids = self.create(3)
+        foreign = make_books(1, self.reader)[0]
+        response = self.send('delete', {'ids': ids[:2] + [str(foreign.pk)]})
+        self.assertEqual(response.json(), {'deleted': 2, 'not_found': [str(foreign.pk)]})
+        self.assertEqual(BookInstance.objects.filter(owner=self.owner).count(), 1)
+        self.assertEqual(len(self.client.get('/api/v1/list_book/').json()['results']), 2)
+
+    def test_anonymous(self):
+        self.client.logout()
+        self.assertEqual(self.send('post', {'books': [self.book(0)]}).status_code, 403)
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_batch_sizes(self):
+        total = 2000
+        for size in (1, 10, 100, 1000):
+            started = time.monotonic()
+            for _ in range(total // size):
+                self.create(size)
+            duration = time.monotonic() - started
+            print(f'\nпачки по {size}: {total / duration:.0f} книг/с')
+
+
+class BookCardCacheTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.client.force_login(self.owner)
+
+    def render_grid(self, books=None):
+        view = BookInstanceListView()
+        if books is None:
+            books = BookInstance.objects.filter(status='a').select_related('author', 'owner')
+        return render_to_string(view.grid_template, view.grid_context(books))
+
+    def test_only_changed_card_rerendered(self):
+        books = make_books(3, self.owner)
+        self.assertIn('Книга 00000', self.render_grid())
+        # без смены modified карточка берется из кэша
+        BookInstance.objects.filter(pk=books[0].pk).update(title='Тихо переименована')
+        self.assertNotIn('Тихо переименована', self.render_grid())
+        # изменение книги - новый ключ ее карточки
+        book = BookInstance.objects.get(pk=books[1].pk)
+        book.title = 'Новое название'
+        book.save()
+        html = self.render_grid()
+        self.assertIn('Новое название', html)
+        self.assertIn('Книга 00002', html)
+        self.assertNotIn('Тихо переименована', html)
+
+    def test_owner_rename_rerenders_cards(self):
+        make_books(2, self.owner)
+        self.assertIn('<p class="card-text">owner</p>', self.render_grid())
+        self.owner.username = 'renamed'
+        self.owner.save()
+        html = self.render_grid()
+        self.assertIn('<p class="card-text">renamed</p>', html)
+        self.assertNotIn('<p class="card-text">owner</p>', html)
+        # вход пользователя книги не трогает
+        modified = list(BookInstance.objects.values_list('modified', flat=True))
+        self.client.login(username='renamed', password='pass')
+        self.assertEqual(list(BookInstance.objects.values_list('modified', flat=True)), modified)
+
+    def test_warm_render_does_not_touch_storage(self):
+        books = make_books(2, self.owner)
+        BookInstance.objects.filter(pk=books[0].pk).update(cover='books/missing.jpg', cover_thumbnails=True)
+        html = self.render_grid()
+        # srcset по флагу книги, файлов копий нет - storage не проверялся
+        self.assertIn('missing_150.webp 150w', html)
+        self.assertEqual(self.render_grid(), html)
+
+    def test_list_page(self):
+        make_books(2, self.owner)
+        self.assertContains(self.client.get('/'), 'Книга 00001')
+        BookInstance.objects.filter(title='Книга 00001').update(title='Книга 1', modified=timezone.now())
+        bump_catalog_version()
+        self.assertContains(self.client.get('/'), 'Книга 1<')
+
+    def test_list_page_key_ignores_junk_params(self):
+        make_books(2, self.owner)
+        self.client.get('/')
+        self.client.get('/', {'utm_source': 'mail', 'min_rating': 'abc', 'ordering': 'title'})
+        self.assertEqual((cache_stats()['hits'], cache_stats()['misses']), (1, 1))
+        self.client.get('/', {'ordering': '-rating'})
+        self.assertEqual(cache_stats()['misses'], 2)
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_cold_warm(self):
+        make_books(3000, self.owner)
+        # только рендер, без запроса книг
+        books = list(BookInstance.objects.filter(status='a').select_related('author', 'owner'))
+        for name in ('холодный', 'теплый', 'теплый'):
+            started = time.monotonic()
+            self.render_grid(books)
+            print(f'\n3000 карточек, {name} кэш: {time.monotonic() - started:.2f} с')
+
+
+class ReservationTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.reader = User.objects.create_user('reader', password='pass')
+        self.other = User.objects.create_user('other', password='pass')
+        self.book = make_books(1, self.owner)[0]
+        self.url = f'/api/v1/list_book/{self.book.pk}/'
+
+    def post(self, user, action, data=None):
+        self.client.force_login(user)
+        return self.client.post(f'{self.url}{action}/', data or {})
+
+    def test_reserve_lend_return(self):
+        response = self.post(self.reader, 'reserve')
+        self.assertEqual(response.json(), {'id': str(self.book.pk), 'old_status': 'a', 'status': 'r'})
+        book = BookInstance.objects.get(pk=self.book.pk)
+        self.assertEqual((book.status, book.loaner), ('r', self.reader))
+        self.assertIsNotNone(book.reserved_time)
+
+        response = self.post(self.other, 'reserve')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['status'], 'r')
+        # выдать зарезервированную книгу можно только тому, кто ее зарезервировал
+        self.assertEqual(self.post(self.owner, 'lend', {'loaner': self.other.pk}).status_code, 409)
+        self.assertEqual(self.post(self.other, 'lend', {'loaner': self.reader.pk}).status_code, 404)
+        self.assertEqual(self.post(self.owner, 'lend', {'loaner': self.reader.pk}).json()['old_status'], 'r')
+        self.assertEqual(self.post(self.owner, 'return').json()['old_status'], 'o')
+        book = BookInstance.objects.get(pk=self.book.pk)
+        self.assertEqual((book.status, book.loaner, book.reserved_time), ('a', None, None))
+        self.assertEqual(CrossHistory.objects.filter(book=book).count(), 3)
+
+    def test_missing_book(self):
+        self.client.force_login(self.reader)
+        self.assertEqual(self.client.post('/api/v1/list_book/not-a-uuid/reserve/').status_code, 404)
+        self.assertEqual(self.client.post(f'/api/v1/list_book/{self.reader.pk}0/reserve/').status_code, 404)
+
+    def test_conflict_in_service(self):
+        reserve_book(self.book.pk, self.reader)
+        # UPDATE без результата, статус для текста ошибки и savepoint вокруг них
+        with self.assertNumQueries(5):
+            with self.assertRaises(StatusConflict):
+                reserve_book(self.book.pk, self.other)
+
+
+def run_threads_on_file_copy(test, target, args):
+    """
+    target(arg) для каждого arg в своем потоке. Потоки пишут в копию тестовой базы в файле (WAL, busy_timeout):
+    общая база в памяти при конкурентной записи отвечает "table is locked" без ожидания.
+    Возвращает (секунды, путь к копии)
+    """
+    path = os.path.join(tempfile.mkdtemp(), 'stress.sqlite3')
+    test.addCleanup(shutil.rmtree, os.path.dirname(path))
+    connection.ensure_connection()
+    with closing(sqlite3.connect(path)) as copy:
+        connection.connection.backup(copy)
+
+    def run(arg):
+        try:
+            target(arg)
+        finally:
+            connection.close()
+
+    # настройки соединения общие: новые соединения потоков откроют файл, соединение теста не трогаем
+    name = connection.settings_dict['NAME']
+    connection.settings_dict['NAME'] = path
+    try:
+        threads = [threading.Thread(target=run, args=(arg,)) for arg in args]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - started
+    finally:
+        connection.settings_dict['NAME'] = name
+    return duration, path
+
+
+class ReservationStressTest(TransactionTestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.readers = [User.objects.create_user(f'reader{i}', password='pass') for i in range(8)]
+
+    def contend(self, books, readers):
+        """
+        Каждый читатель в своем потоке пытается зарезервировать каждую книгу.
+        Возвращает (резервы, конфликты, секунды, путь к копии базы)
+        """
+        wins, conflicts = [], []
+
+        def run(reader):
+            for book in books:
+                try:
+                    reserve_book(book.pk, reader)
+                    wins.append((book.pk.hex, reader.pk))
+                except StatusConflict:
+                    conflicts.append(book.pk)
+
+        duration, path = run_threads_on_file_copy(self, run, readers)
+        return wins, conflicts, duration, path
+
+    def test_no_double_reservation(self):
+        books = make_books(20, self.owner)
+        wins, conflicts, _, path = self.contend(books, self.readers)
+        self.assertEqual(len(wins), len(books))
+        self.assertEqual(len(conflicts), len(books) * (len(self.readers) - 1))
+        with closing(sqlite3.connect(path)) as db:
+            self.assertEqual(db.execute(f'SELECT COUNT(*) FROM {CrossHistory._meta.db_table}').fetchone()[0],
+                             len(books))
+            rows = db.execute(f'SELECT id, status, loaner_id FROM {BookInstance._meta.db_table}').fetchall()
+        self.assertEqual(sorted(rows), sorted((pk, 'r', loaner_id) for pk, loaner_id in wins))
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_contention(self):
+        books = make_books(500, self.owner)
+        wins, conflicts, duration, _ = self.contend(books, self.readers)
+        print(f'\n{len(self.readers)} потоков, {len(wins) + len(conflicts)} попыток за {duration:.2f} с: '
+              f'{(len(wins) + len(conflicts)) / duration:.0f} в секунду, резервов {len(wins)}')
+        self.assertEqual(len(wins), len(books))
+
+
+class RatingFavoriteTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.reader = User.objects.create_user('reader', password='pass')
+        self.book = make_books(1, self.owner)[0]
+        self.url = f'/api/v1/list_book/{self.book.pk}/'
+        self.client.force_login(self.reader)
+
+    def test_favorite_toggle(self):
+        self.assertEqual(self.client.post(f'{self.url}favorite/').json(),
+                         {'favorite': True, 'changed': True, 'favorite_count': 1})
+        self.assertFalse(self.client.post(f'{self.url}favorite/').json()['changed'])
+        self.assertEqual(Favorite.objects.count(), 1)
+        self.assertEqual(self.client.delete(f'{self.url}favorite/').json()['favorite_count'], 0)
+        self.assertFalse(self.client.delete(f'{self.url}favorite/').json()['changed'])
+        self.assertEqual(BookInstance.objects.get(pk=self.book.pk).favorite_count, 0)
+
+    def test_favorite_unique(self):
+        Favorite.objects.create(book=self.book, user=self.reader)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Favorite.objects.create(book=self.book, user=self.reader)
+
+    def test_favorite_queries(self):
+        # savepoint, INSERT ... ON CONFLICT, UPDATE счетчика, release - и ни одного SELECT перед записью
+        with CaptureQueriesContext(connection) as captured:
+            add_favorite(self.book.pk, self.reader)
+        self.assertEqual([query['sql'].split()[0] for query in captured], ['SAVEPOINT', 'INSERT', 'UPDATE', 'RELEASE'])
+
+    def test_rate(self):
+        other = User.objects.create_user('other', password='pass')
+        rate_book(self.book.pk, other, '2')
+        data = self.client.post(f'{self.url}rate/', {'rating': 5}).json()
+        self.assertEqual((data['old_rating'], data['rating_count'], data['rating_avg']), (None, 2, 3.5))
+        data = self.client.post(f'{self.url}rate/', {'rating': 3}).json()
+        self.assertEqual((data['old_rating'], data['rating_count'], data['rating_avg']), ('5', 2, 2.5))
+        self.assertEqual(self.client.post(f'{self.url}rate/', {'rating': 3}).json()['rating_avg'], 2.5)
+        # счетчики совпадают с полным пересчетом
+        update_book_ratings([self.book.pk])
+        book = BookInstance.objects.get(pk=self.book.pk)
+        self.assertEqual((book.rating_count, book.rating_avg), (2, 2.5))
+
+    def test_errors(self):
+        self.assertEqual(self.client.post(f'{self.url}rate/', {'rating': 7}).status_code, 400)
+        missing = f'/api/v1/list_book/{self.reader.pk:032}/'
+        self.assertEqual(self.client.post(f'{missing}rate/', {'rating': 5}).status_code, 404)
+        self.assertEqual(self.client.post(f'{missing}favorite/').status_code, 404)
+        self.assertFalse(BookRating.objects.exists() or Favorite.objects.exists())
+        self.client.logout()
+        self.assertEqual(self.client.post(f'{self.url}favorite/').status_code, 403)
+
+
+class RatingFavoriteLoadTest(TransactionTestCase):
+    def setUp(self):
+        get_cache().clear()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.readers = [User.objects.create_user(f'reader{i}', password='pass') for i in range(8)]
+        self.books = make_books(3, self.owner)
+
+    def click(self, clicks):
+        """
+        Читатели в потоках наперегонки ставят оценки и переключают избранное у одних и тех же книг.
+        Возвращает (запросов в секунду, путь к копии базы)
+        """
+        requests = []
+
+        def run(reader):
+            client = Client()
+            client.force_login(reader)
+            for i in range(clicks):
+                url = f'/api/v1/list_book/{self.books[i % len(self.books)].pk}/'
+                responses = [client.post(f'{url}rate/', {'rating': (reader.pk + i) % 5 + 1}),
+                             client.delete(f'{url}favorite/') if i % 3 == 2 else client.post(f'{url}favorite/')]
+                requests.extend(response.status_code for response in responses)
+
+        duration, path = run_threads_on_file_copy(self, run, self.readers)
+        self.assertEqual(set(requests), {200})
+        return len(requests) / duration, path
+
+    def assert_counters(self, path):
+        books, ratings, favorites = (BookInstance._meta.db_table, BookRating._meta.db_table,
+                                     Favorite._meta.db_table)
+        with closing(sqlite3.connect(path)) as db:
+            rows = db.execute(
+                f'SELECT b.favorite_count, b.rating_count, b.rating_avg, '
+                f'(SELECT COUNT(*) FROM {favorites} f WHERE f.book_id = b.id), '
+                f'(SELECT COUNT(*) FROM {ratings} r WHERE r.book_id = b.id), '
+                f'(SELECT AVG(CAST(r.rating AS INTEGER)) FROM {ratings} r WHERE r.book_id = b.id) '
+                f'FROM {books} b').fetchall()
+        for favorite_count, rating_count, rating_avg, real_favorites, real_ratings, real_avg in rows:
+            self.assertEqual((favorite_count, rating_count), (real_favorites, real_ratings))
+            self.assertAlmostEqual(rating_avg, real_avg)
+
+    def test_concurrent_clicks(self):
+        _, path = self.click(12)
+        self.assert_counters(path)
+
+    @skipUnless(os.environ.get('BOOKCROSS_BENCH'), 'бенчмарк: BOOKCROSS_BENCH=1')
+    def test_benchmark_requests_per_second(self):
+        rps, path = self.click(200)
+        print(f'\n{len(self.readers)} потоков, SQLite WAL: {rps:.0f} запросов в секунду')
+        self.assert_counters(path)
+
+
+class BookBrowseTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass', is_staff=True)
+        self.reader = User.objects.create_user('reader', password='pass')
+        self.client.force_login(self.owner)
+        # книга i в жанрах Жанр{i % 5} и Жанр{(i + 1) % 5}
+        self.books = make_books(10, self.owner)
+        self.genres = {genre.name: genre.pk for genre in Genre.objects.all()}
+        BookInstance.objects.filter(pk__in=[book.pk for book in self.books[:3]]).update(status='r')
+        bump_catalog_version()
+
+    def browse(self, **params):
+        return self.client.get('/api/v1/browse/', params)
+
+    def counts(self, facet, data):
+        return {item['label']: item['count'] for item in data['facets'][facet]}
+
+    def test_filters(self):
+        genre0, genre1 = self.genres['Жанр0'], self.genres['Жанр1']
+        data = self.browse(genre=[genre0], page_size=100).json()
+        self.assertEqual(sorted(b['title'] for b in data['results']),
+                         ['Книга 00000', 'Книга 00004', 'Книга 00005', 'Книга 00009'])
+        # ИЛИ внутри фасета без повторов (книга 0 в обоих жанрах), И между фасетами
+        data = self.browse(genre=[genre0, genre1], page_size=100).json()
+        self.assertEqual(len(data['results']), 6)
+        data = self.browse(genre=[genre0, genre1], status='a', page_size=100).json()
+        self.assertEqual(len(data['results']), 4)
+        data = self.browse(author=self.books[4].author_id, owner=self.owner.pk, profile='card').json()
+        self.assertEqual([b['title'] for b in data['results']], ['Книга 00004'])
+        self.assertEqual(list(data['results'][0]), BOOK_FIELD_PROFILES['card'])
+
+    def test_facet_counts(self):
+        data = self.browse(genre=[self.genres['Жанр0']]).json()
+        # свой фильтр фасет не сужает: видно, сколько книг в остальных жанрах
+        self.assertEqual(self.counts('genre', data), {f'Жанр{i}': 4 for i in range(5)})
+        self.assertEqual([item['selected'] for item in data['facets']['genre'] if item['label'] == 'Жанр0'], [True])
+        self.assertEqual(self.counts('status', data), {'Доступна': 3, 'Зарезервирована': 1})
+        self.assertEqual(self.counts('owner', data), {'owner': 4})
+        self.assertEqual(len(data['facets']['author']), 4)
+        self.assertEqual(self.counts('status', self.browse(status='a').json()), {'Доступна': 7, 'Зарезервирована': 3})
+
+    def test_facets_cached_until_catalog_changes(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.browse(status='a')
+        # сессия и пользователь, страница, жанры страницы и по запросу на каждый фасет
+        self.assertEqual(len(captured), 8)
+        with self.assertNumQueries(2):
+            self.browse(status='a')
+        # другая страница - новый запрос книг, но счетчики из кэша
+        with self.assertNumQueries(4):
+            self.browse(status='a', page_size=5)
+
+        change_status(BookInstance.objects.filter(pk=self.books[5].pk), 'm')
+        bump_catalog_version()  # on_commit внутри TestCase не выполняется
+        self.assertEqual(self.counts('status', self.browse(status='a').json()),
+                         {'Доступна': 6, 'Зарезервирована': 3, 'В ремонте': 1})
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.browse().status_code, 403)
+        self.client.force_login(self.reader)
+        data = self.browse(page_size=100).json()
+        # только доступные книги, и в выдаче, и в счетчиках статусов
+        self.assertEqual(len(data['results']), 7)
+        self.assertEqual(self.counts('status', data), {'Доступна': 7})
+        self.assertEqual(sum(self.counts('genre', data).values()), 14)
+        self.assertEqual(self.browse(status='r').status_code, 400)
+        self.assertEqual(self.browse(profile='admin').status_code, 403)
+        self.assertEqual(self.browse(fields='title,loaner').status_code, 403)
+        self.assertEqual(self.client.get('/api/v1/list_book/', {'profile': 'admin'}).status_code, 403)
+        # персоналу - все статусы и профиль admin, кэш у них отдельный
+        self.client.force_login(self.owner)
+        data = self.browse(page_size=100, profile='admin').json()
+        self.assertEqual(len(data['results']), 10)
+        self.assertIn('loaner', data['results'][0])
+
+    def test_invalid_values(self):
+        response = self.browse(genre='x', status='z')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()), {'genre', 'status'})
+
+    def test_genre_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT name FROM sqlite_master WHERE type = %s AND name = %s', ['index', GENRE_INDEX])
+            self.assertIsNotNone(cursor.fetchone())
+            queryset = filter_books(BookInstance.objects.all(), {'genre': (self.genres['Жанр0'],)})
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            self.assertIn(GENRE_INDEX, ' '.join(str(row) for row in cursor.fetchall()))
+
+
+class HistoryRetentionTest(BookcrossTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user('owner', password='pass')
+        self.book, self.other = make_books(2, self.owner)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def history(self, book, changes):
+        for day, old, new in changes:
+            entry = CrossHistory.status_change(book.pk, self.owner.pk, old, new)
+            entry.save()
+            CrossHistory.objects.filter(pk=entry.pk).update(create_date=day)
+
+    def rollups(self, book):
+        return {rollup.month: (rollup.changes, rollup.loans, rollup.reservations, rollup.loan_days)
+                for rollup in CrossHistoryMonth.objects.filter(book=book)}
+
+    def test_rollup_archive_and_delete(self):
+        self.history(self.book, [
+            (datetime.date(2024, 1, 10), 'a', 'r'),
+            (datetime.date(2024, 1, 20), 'r', 'o'),
+            (datetime.date(2024, 3, 5), 'o', 'a'),
+            (datetime.date(2024, 3, 6), 'a', 'o'),
+            (datetime.date(2024, 6, 1), 'o', 'a'),  # после границы - остается
+        ])
+        # старая запись без статусов - они берутся из комментария
+        CrossHistory.objects.filter(book=self.book, create_date=datetime.date(2024, 3, 5)).update(
+            old_status='', new_status='')
+        result = archive_history(datetime.date(2024, 5, 17), self.directory)
+        self.assertEqual((result.archived, result.batches), (4, 1))
+        self.assertEqual(list(CrossHistory.objects.values_list('create_date', flat=True)),
+                         [datetime.date(2024, 6, 1)])
+        # аренда с 6 марта не закончилась к границе: дни до 1 мая
+        self.assertEqual(self.rollups(self.book), {
+            datetime.date(2024, 1, 1): (2, 1, 1, 12),
+            datetime.date(2024, 2, 1): (0, 0, 0, 29),
+            datetime.date(2024, 3, 1): (2, 1, 0, 4 + 26),
+            datetime.date(2024, 4, 1): (0, 0, 0, 30),
+        })
+        with gzip.open(result.path, 'rt', encoding='utf-8') as archive:
+            rows = [json.loads(line) for line in archive]
+        self.assertEqual([(row['create_date'], row['new_status']) for row in rows],
+                         [('2024-01-10', 'r'), ('2024-01-20', 'o'), ('2024-03-05', ''), ('2024-03-06', 'o')])
+
+        # следующий запуск продолжает аренду с 1 мая и прибавляет к уже собранным итогам
+        result = archive_history(datetime.date(2024, 8, 1), self.directory)
+        self.assertEqual(result.archived, 1)
+        self.assertFalse(CrossHistory.objects.exists())
+        rollups = self.rollups(self.book)
+        self.assertEqual(rollups[datetime.date(2024, 5, 1)], (0, 0, 0, 31))
+        self.assertEqual(rollups[datetime.date(2024, 6, 1)], (1, 0, 0, 0))
+        self.assertEqual(sum(loan_days for _, _, _, loan_days in rollups.values()), 12 + 29 + 30 + 30 + 31)
+
+    def test_nothing_to_archive(self):
+        self.history(self.book, [(timezone.localdate(), 'a', 'r')])
+        result = archive_history(retention_cutoff(12), self.directory)
+        self.assertEqual((result.archived, result.path), (0, None))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_batches(self):
+        for book in (self.book, self.other):
+            self.history(book, [(datetime.date(2023, 5, 2), 'a', 'o'), (datetime.date(2023, 5, 9), 'o', 'a')])
+        with CaptureQueriesContext(connection) as captured:
+            result = archive_history(datetime.date(2024, 1, 1), self.directory, batch_size=1)
+        self.assertEqual((result.archived, result.batches), (4, 2))
+        self.assertEqual(len([query for query in captured if query['sql'].startswith('DELETE')]), 2)
+        for book in (self.book, self.other):
+            self.assertEqual(self.rollups(book), {datetime.date(2023, 5, 1): (2, 1, 0, 7)})
+
+    def test_interrupted_run_keeps_rows_and_readable_archive(self):
+        for book in (self.book, self.other):
+            self.history(book, [(datetime.date(2023, 5, 2), 'a', 'o'), (datetime.date(2023, 5, 9), 'o', 'a')])
+        written = []
+
+        def dumps(*args, **kwargs):
+            written.append(args[0])
+            if len(written) > 2:
+                raise RuntimeError
+            return json.dumps(*args, **kwargs)
+
+        # обрыв при записи архива (после первой пачки): ни архива, ни временного файла, записи на месте
+        with mock.patch('bookcross.history.json.dumps', dumps), self.assertRaises(RuntimeError):
+            archive_history(datetime.date(2024, 1, 1), self.directory, batch_size=1)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(CrossHistory.objects.count(), 4)
+        # обрыв после архива, на удалении: архив уже закрыт и читается целиком
+        with mock.patch('bookcross.history.save_rollups', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            archive_history(datetime.date(2024, 1, 1), self.directory, batch_size=1)
+        [name] = os.listdir(self.directory)
+        with gzip.open(os.path.join(self.directory, name), 'rt', encoding='utf-8') as archive:
+            self.assertEqual(len(archive.readlines()), 4)
+        self.assertEqual(CrossHistory.objects.count(), 4)
+
+    def test_command(self):
+        self.history(self.book, [(add_months(timezone.localdate(), -14), 'a', 'x')])
+        out = StringIO()
+        call_command('archive_history', months=12, dir=self.directory, stdout=out)
+        self.assertIn('Записей в архиве: 1', out.getvalue())
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual(CrossHistoryMonth.objects.get(book=self.book).changes, 1)
+
+    def test_retention_cutoff(self):
+        self.assertEqual(retention_cutoff(12, datetime.date(2024, 3, 15)), datetime.date(2023, 3, 1))
+        self.assertEqual(retention_cutoff(3, datetime.date(2024, 1, 31)), datetime.date(2023, 10, 1))
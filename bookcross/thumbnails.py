@@ -0,0 +1,135 @@
+"""
+Уменьшенные копии обложек книг и аватаров пользователей.
+
+Для каждой картинки создаются копии шириной THUMBNAIL_WIDTHS в форматах WebP и JPEG:
+    books/2020/02/21/cover.jpg -> thumbs/books/2020/02/21/cover_300.webp
+Ресайз идет в пуле процессов (THUMBNAIL_WORKERS, 0 - прямо в запросе).
+Самая маленькая JPEG копия пишется последней и служит признаком готовности всего набора на диске.
+Готовность копий обложки хранится в BookInstance.cover_thumbnails: его ставит on_ready после ресайза,
+поэтому список и API не проверяют storage для каждой книги.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections
+
+logger = logging.getLogger('bookcross.thumbnails')
+
+THUMBNAIL_DIR = 'thumbs'
+FORMATS = {'webp': ('WEBP', {'quality': 80, 'method': 4}),
+           'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})}
+
+_executor = None
+
+
+def get_widths():
+    return tuple(getattr(settings, 'THUMBNAIL_WIDTHS', (150, 300, 600)))
+
+
+def thumbnail_name(name, width, fmt):
+    ext = 'jpg' if fmt == 'jpeg' else fmt
+    return f'{THUMBNAIL_DIR}/{os.path.splitext(name)[0]}_{width}.{ext}'
+
+
+def render_thumbnails(source, targets):
+    """
+    Выполняется в отдельном процессе: только Pillow и файлы, без ORM.
+    targets - список (путь, ширина, формат), маркер готовности - последний.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    for path, width, fmt in targets:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        copy = image.copy()
+        # меньшие, чем width, картинки не увеличиваем, но копию все равно пишем
+        copy.thumbnail((width, width * 4), Image.LANCZOS)
+        pil_format, options = FORMATS[fmt]
+        copy.save(path, pil_format, **options)
+    return len(targets)
+
+
+def build_targets(name):
+    widths = sorted(get_widths(), reverse=True)
+    targets = [(default_storage.path(thumbnail_name(name, width, fmt)), width, fmt)
+               for fmt in ('webp', 'jpeg') for width in widths]
+    return targets  # последней идет самая маленькая JPEG копия
+
+
+def has_thumbnails(name):
+    return bool(name) and default_storage.exists(thumbnail_name(name, min(get_widths()), 'jpeg'))
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: дочерний процесс не наследует соединения с БД и потоки сервера
+        _executor = ProcessPoolExecutor(max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2) or 1,
+                                        mp_context=get_context('spawn'))
+    return _executor
+
+
+def generation_done(name, on_ready, caller=None):
+    """
+    Колбэк Future: обычно вызывается в служебном потоке пула, а если ресайз уже закончился - сразу в потоке caller
+    """
+    def done(future):
+        if future.exception() is not None:
+            logger.error('thumbnail generation failed: %s', future.exception())
+        elif on_ready is not None:
+            try:
+                on_ready([name])
+            finally:
+                # соединения с БД служебного потока никто, кроме нас, не закроет
+                if threading.get_ident() != caller:
+                    connections.close_all()
+    return done
+
+
+def generate_thumbnails(name, executor=None, on_ready=None):
+    """
+    Ставит в очередь ресайз картинки name из default_storage, после него вызывает on_ready([name]).
+    Возвращает Future, либо None, если THUMBNAIL_WORKERS = 0 и работа уже сделана
+    """
+    source = default_storage.path(name)
+    if executor is None and not getattr(settings, 'THUMBNAIL_WORKERS', 2):
+        render_thumbnails(source, build_targets(name))
+        if on_ready is not None:
+            on_ready([name])
+        return None
+    future = (executor or get_executor()).submit(render_thumbnails, source, build_targets(name))
+    future.add_done_callback(generation_done(name, on_ready, threading.get_ident()))
+    return future
+
+
+def ensure_thumbnails(name, on_ready=None):
+    if not name:
+        return
+    if not has_thumbnails(name):
+        generate_thumbnails(name, on_ready=on_ready)
+    elif on_ready is not None:
+        on_ready([name])
+
+
+def get_srcset(name):
+    """
+    {'webp': 'url 150w, url 300w, ...', 'jpeg': ...}. Готовность копий проверяет вызывающий
+    (has_thumbnails или поле модели)
+    """
+    if not name:
+        return None
+    return {fmt: ', '.join(f'{default_storage.url(thumbnail_name(name, width, fmt))} {width}w'
+                           for width in sorted(get_widths()))
+            for fmt in FORMATS}
+
+
+def get_thumbnail_url(name, width):
+    if not has_thumbnails(name):
+        return None
+    return default_storage.url(thumbnail_name(name, width, 'jpeg'))
@@ -29,6 +29,9 @@ urlpatterns = [
     path('detail/', book_detail, name='book_detail'),
     path('', BookInstanceListView.as_view(), name='home'),
     path('home/', book_instance_view, name='home2'),
+    path('api/v1/search/', BookSearchView.as_view(), name='book_search'),
+    path('api/v1/browse/', BookBrowseView.as_view(), name='book_browse'),
+    path('api/v1/favorites/top/', FavoriteRankingView.as_view(), name='favorite_ranking'),
 
 ]
 
@@ -1,12 +1,119 @@
+import hashlib
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db.models import Count, Max
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 from django.views.generic import View
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 
-from bookcross.models import BookInstance
+from bookcross.cache import get_cache_alias, get_or_build, get_timeout
+from bookcross.facets import filter_books, get_facet_counts, get_statuses, parse_filters, scope_key, visible_books
+from bookcross.models import BookInstance, FavoriteRanking, Place, SimilarBook
+from bookcross.pagination import KeysetPagination
+from bookcross.renderers import FastJSONRenderer
+from bookcross.search import search_books
+from bookcross.services import (StatusConflict, add_favorite, bulk_create_books, bulk_delete_books, bulk_update_books,
+                                change_status, lend_book, rate_book, remove_favorite, reserve_book, return_book)
 
 
 # Create your views here.
-from bookcross.serializers import BookInstanceSerializer
+from bookcross.serializers import (BookBulkDeleteSerializer, BookBulkSerializer, BookInstanceSerializer,
+                                   BookLoanSerializer, BookRateSerializer, BookStatusChangeSerializer,
+                                   BookWriteSerializer,
+                                   FavoriteRankingSerializer, SimilarBookSerializer, book_values, get_book_fields,
+                                   narrow_books, serialize_book_rows)
+
+RATING_ORDERING = {
+    'rating': ('rating_avg', 'rating_count'),
+    '-rating': ('-rating_avg', '-rating_count'),
+}
+
+
+def filter_by_rating(queryset, params):
+    """
+    Фильтр ?min_rating= и сортировка ?ordering=rating|-rating по сохраненному рейтингу книги
+    """
+    min_rating = params.get('min_rating')
+    if min_rating:
+        try:
+            queryset = queryset.filter(rating_avg__gte=float(min_rating))
+        except ValueError:
+            pass
+    ordering = RATING_ORDERING.get(params.get('ordering'))
+    if ordering:
+        queryset = queryset.order_by(*ordering)
+    return queryset
+
+
+def list_filters(params):
+    """
+    Разобранные фильтры filter_by_rating и filter_by_place - для ключа кэша: лишние и неверные
+    параметры запроса не плодят новых записей
+    """
+    try:
+        min_rating = float(params.get('min_rating') or 0) or None
+    except ValueError:
+        min_rating = None
+    ordering = params.get('ordering') if params.get('ordering') in RATING_ORDERING else None
+    place = params.get('place') or None
+    if place is not None:
+        place = int(place) if place.isdigit() else 'none'
+    return min_rating, ordering, place
+
+
+def filter_by_place(queryset, params):
+    """
+    ?place=<id> - книги, стоящие в этом месте или где угодно внутри него (по материализованному пути)
+    """
+    place_id = params.get('place')
+    if not place_id:
+        return queryset
+    path = None
+    if place_id.isdigit():
+        path = Place.objects.filter(pk=place_id).values_list('path', flat=True).first()
+    if not path:
+        return queryset.none()
+    return queryset.filter(**Place.subtree_lookup(path, 'place__path'))
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5('|'.join(str(p) for p in parts).encode()).hexdigest())
+
+
+def conditional_response(request, etag, last_modified):
+    """
+    304 Not Modified, если у клиента актуальная версия (If-None-Match / If-Modified-Since), иначе None
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    # браузер хранит ответ, но каждый раз сверяется с сервером
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+class Conflict(APIException):
+    status_code = 409
+    default_detail = 'Статус книги уже изменился'
+    default_code = 'conflict'
 
 
 def book_detail(request):
@@ -16,19 +123,31 @@ def book_detail(request):
 class BookInstanceListView(View):
     model = BookInstance
     template = 'bookcross/list_book.html'
+    grid_template = 'bookcross/_book_grid.html'
 
     def get(self, request):
         books = None
+        books_html = ''
         if request.user.is_authenticated:
             if request.user.is_active:
                 books = BookInstance.objects.filter(status__exact='a')  # Статус available доступна
+                books = books.select_related('author', 'owner')
+                books = filter_by_place(filter_by_rating(books, request.GET), request.GET)
+                # сетка карточек одинакова для всех пользователей - кэшируем до изменения каталога,
+                # после изменения заново рисуются только карточки измененных книг
+                books_html = get_or_build('list_page', list_filters(request.GET),
+                                          lambda: render_to_string(self.grid_template, self.grid_context(books)))
         con = dict(
             books=books,
+            books_html=books_html,
             active_page='list_book',
         )
 
         return render(request, self.template, context=con)
 
+    def grid_context(self, books):
+        return {'books': books, 'card_cache': get_cache_alias(), 'card_timeout': get_timeout()}
+
 
 def book_instance_view(request):
     return render(request, 'bookcross/main_app.html')
@@ -37,3 +156,256 @@ def book_instance_view(request):
 class BookInstanceView(ModelViewSet):
     queryset = BookInstance.objects.filter(status__exact='a')
     serializer_class = BookInstanceSerializer
+    pagination_class = KeysetPagination
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+
+    @property
+    def book_fields(self):
+        # ?fields= / ?profile=, неверное значение - ответ 400
+        if not hasattr(self, '_book_fields'):
+            self._book_fields = get_book_fields(self.request.query_params, staff=self.request.user.is_staff)
+        return self._book_fields
+
+    def get_filtered_queryset(self):
+        queryset = filter_by_place(super().get_queryset(), self.request.query_params)
+        return filter_by_rating(queryset, self.request.query_params)
+
+    def get_queryset(self):
+        queryset = self.get_filtered_queryset()
+        if self.action not in ('list', 'retrieve'):
+            # изменение сохраняет только загруженные столбцы: без modified не сработал бы auto_now
+            return queryset
+        # только столбцы запрошенных полей, author, owner и genre - пачкой, а не на каждую книгу
+        return narrow_books(queryset, self.book_fields, self.paginator.get_ordering(queryset))
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.book_fields)
+        return super().get_serializer(*args, **kwargs)
+
+    def list_rows(self):
+        """
+        Страница списка из values() без моделей и ModelSerializer
+        """
+        queryset = self.get_filtered_queryset()
+        page = self.paginate_queryset(book_values(queryset, self.book_fields, self.paginator.get_ordering(queryset)))
+        return self.get_paginated_response(serialize_book_rows(page, self.book_fields)).data
+
+    def list(self, request, *args, **kwargs):
+        # до кэша: запрет полей персонала проверяется на каждый запрос
+        fields = self.book_fields
+        url = request.build_absolute_uri()
+        # один агрегат вместо сериализации: удаление меняет count, любое изменение - max(modified)
+        state = self.get_filtered_queryset().order_by().aggregate(last_modified=Max('modified'), count=Count('pk'))
+        etag, last_modified = make_etag(url, state['last_modified'], state['count']), state['last_modified']
+        not_modified = conditional_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        # в ключе полный URL: от него зависят фильтры, поля, курсор и ссылка next
+        data = get_or_build('api_list', [url, ','.join(fields)], self.list_rows)
+        return set_validators(Response(data), etag, last_modified)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            last_modified = (self.get_filtered_queryset().filter(pk=kwargs['pk'])
+                             .values_list('modified', flat=True).first())
+        except ValidationError:
+            last_modified = None  # неверный id - ответит 404 обычный retrieve
+        if last_modified is None:
+            return super().retrieve(request, *args, **kwargs)
+        fields = ','.join(self.book_fields)
+        etag = make_etag(kwargs['pk'], fields, last_modified)
+        not_modified = conditional_response(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+        data = get_or_build('api_detail', [kwargs['pk'], fields],
+                            lambda: super(BookInstanceView, self).retrieve(request, *args, **kwargs).data)
+        return set_validators(Response(data), etag, last_modified)
+
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        """
+        Похожие книги, заранее рассчитанные командой build_similar_books
+        """
+        similar = (SimilarBook.objects.filter(book_id=pk).order_by('rank')
+                   .select_related('similar__author', 'similar__owner').prefetch_related('similar__genre'))
+        try:
+            return Response({'results': SimilarBookSerializer(similar, many=True).data})
+        except ValidationError:
+            return Response({'results': []})
+
+    @action(detail=False, methods=['post'], permission_classes=[IsAdminUser])
+    def bulk_status(self, request):
+        """
+        Смена статуса сразу у многих книг (любых, не только доступных)
+        """
+        serializer = BookStatusChangeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        changed = change_status(BookInstance.objects.filter(pk__in=data['ids']), data['status'], data.get('loaner'))
+        return Response({'changed': changed})
+
+    def move(self, pk, status, transition, *args, **kwargs):
+        """
+        Переход в status через services: 409, если книгу успел изменить другой запрос
+        """
+        try:
+            old_status = transition(pk, *args, **kwargs)
+        except (BookInstance.DoesNotExist, ValidationError):
+            raise NotFound()  # нет книги, чужая книга или неверный id
+        except StatusConflict as e:
+            raise Conflict({'detail': str(e), 'status': e.status})
+        return Response({'id': pk, 'old_status': old_status, 'status': status})
+
+    def owner_filter(self, request):
+        # персонал распоряжается любыми книгами, остальные - своими
+        return None if request.user.is_staff else request.user
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def reserve(self, request, pk=None):
+        return self.move(pk, 'r', reserve_book, request.user)
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def lend(self, request, pk=None):
+        """
+        Выдача книги заемщику {"loaner": id} - владельцем книги
+        """
+        serializer = BookLoanSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return self.move(pk, 'o', lend_book, serializer.validated_data['loaner'], owner=self.owner_filter(request))
+
+    @action(detail=True, methods=['post'], url_path='return', permission_classes=[IsAuthenticated])
+    def return_book(self, request, pk=None):
+        return self.move(pk, 'a', return_book, owner=self.owner_filter(request))
+
+    def counters(self, pk, *fields):
+        values = BookInstance.objects.filter(pk=pk).values_list(*fields).first()
+        if values is None:
+            raise NotFound()
+        return dict(zip(fields, values))
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def rate(self, request, pk=None):
+        """
+        Оценка книги {"rating": 1..5}, повторная оценка заменяет прежнюю
+        """
+        serializer = BookRateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        rating = serializer.validated_data['rating']
+        try:
+            old = rate_book(pk, request.user, rating)
+        except (BookInstance.DoesNotExist, IntegrityError, ValidationError):
+            raise NotFound()
+        return Response({'rating': rating, 'old_rating': old, **self.counters(pk, 'rating_avg', 'rating_count')})
+
+    @action(detail=True, methods=['post', 'delete'], permission_classes=[IsAuthenticated])
+    def favorite(self, request, pk=None):
+        """
+        POST - добавить в избранное, DELETE - убрать. Повтор запроса ничего не меняет
+        """
+        transition = remove_favorite if request.method == 'DELETE' else add_favorite
+        try:
+            changed = transition(pk, request.user)
+        except (BookInstance.DoesNotExist, IntegrityError, ValidationError):
+            raise NotFound()
+        return Response({'favorite': request.method != 'DELETE', 'changed': changed,
+                         **self.counters(pk, 'favorite_count')})
+
+    @action(detail=False, methods=['post', 'patch', 'delete'], permission_classes=[IsAuthenticated])
+    def bulk(self, request):
+        """
+        Пакетные операции одной транзакцией:
+        POST {"books": [...]} - создать книги текущего пользователя,
+        PATCH {"books": [{"id": ..., поля}, ...]} - изменить,
+        DELETE {"ids": [...]} - удалить
+        """
+        if request.method == 'DELETE':
+            serializer = BookBulkDeleteSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            found, missing = bulk_delete_books(request.user, serializer.validated_data['ids'])
+            return Response({'deleted': len(found), 'not_found': [str(pk) for pk in missing]})
+
+        serializer = BookBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        partial = request.method == 'PATCH'
+        items, errors = [], {}
+        for index, item in enumerate(serializer.validated_data['books']):
+            book = BookWriteSerializer(data=item, partial=partial)
+            if book.is_valid():
+                items.append((index, dict(book.validated_data)))
+            else:
+                errors[index] = book.errors
+        if partial:
+            done, item_errors = bulk_update_books(request.user, items)
+            return bulk_response(done, {**errors, **item_errors}, 'updated')
+        done, item_errors = bulk_create_books(request.user, items)
+        return bulk_response(done, {**errors, **item_errors}, 'created', success_status=201)
+
+
+def bulk_response(done, errors, result, success_status=200):
+    """
+    Ответ пакетной операции: результат по каждой книге в порядке запроса.
+    400 - если не прошла ни одна книга
+    """
+    results = [{'index': index, 'id': str(pk), 'result': result} for index, pk in done.items()]
+    results += [{'index': index, 'errors': item_errors} for index, item_errors in errors.items()]
+    results.sort(key=lambda item: item['index'])
+    status = 400 if errors and not done else success_status
+    return Response({result: len(done), 'failed': len(errors), 'results': results}, status=status)
+
+
+class BookSearchView(APIView):
+    """
+    Полнотекстовый поиск доступных книг: /api/v1/search/?q=толст&limit=20
+    """
+    max_limit = 100
+
+    def get(self, request):
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), self.max_limit))
+        except ValueError:
+            limit = 20
+        queryset = BookInstance.objects.filter(status__exact='a').select_related('author', 'owner')
+        books = search_books(request.query_params.get('q', ''), queryset.prefetch_related('genre'), limit)
+        return Response({'results': BookInstanceSerializer(books, many=True).data})
+
+
+class BookBrowseView(APIView):
+    """
+    Фасетный просмотр каталога: /api/v1/browse/?genre=1&genre=2&author=3&owner=4&status=a&profile=card
+    Страница книг по ключу, как в list_book, и счетчики по жанрам, авторам, владельцам и статусам.
+    Книги не в статусе "доступна" и профиль admin - только для персонала
+    """
+    renderer_classes = [FastJSONRenderer, BrowsableAPIRenderer]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        statuses = get_statuses(request.user)
+        filters = parse_filters(request.query_params, statuses)
+        fields = get_book_fields(request.query_params, staff=request.user.is_staff)
+
+        def build_page():
+            queryset = filter_books(visible_books(statuses), filters)
+            paginator = KeysetPagination()
+            page = paginator.paginate_queryset(book_values(queryset, fields, paginator.get_ordering(queryset)), request)
+            return paginator.get_paginated_response(serialize_book_rows(page, fields)).data
+
+        # страница зависит от полного URL, счетчики - только от фильтров и общие для всех страниц
+        data = dict(get_or_build('browse_page', [scope_key(statuses), request.build_absolute_uri()], build_page))
+        data['facets'] = get_facet_counts(filters, statuses)
+        return Response(data)
+
+
+class FavoriteRankingView(APIView):
+    """
+    Самые популярные в избранном книги: /api/v1/favorites/top/?period=week|month
+    Рейтинг заранее рассчитан командой compute_favorite_rankings
+    """
+
+    def get(self, request):
+        period = request.query_params.get('period', 'week')
+        if period not in FavoriteRanking.PERIOD_DAYS:
+            return Response({'period': [f'Допустимые значения: {", ".join(FavoriteRanking.PERIOD_DAYS)}']},
+                            status=400)
+        rankings = (FavoriteRanking.objects.filter(period=period)
+                    .select_related('book__author', 'book__owner').prefetch_related('book__genre'))
+        return Response({'results': FavoriteRankingSerializer(rankings, many=True).data})
@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pbl.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from bookcross.events import EVENTS_PATH, sse_app  # noqa: E402 - после настройки Django
+
+
+async def application(scope, receive, send):
+    # поток событий о статусах книг обслуживается без Django: соединение живет, пока открыта страница
+    if scope['type'] == 'http' and scope['path'] == EVENTS_PATH:
+        return await sse_app(scope, receive, send)
+    return await django_application(scope, receive, send)
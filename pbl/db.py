@@ -0,0 +1,80 @@
+"""
+Настройка соединений с БД и маршрутизация запросов между основной базой и репликами.
+
+SQLite: при каждом новом соединении выполняются PRAGMA из SQLITE_PRAGMAS (WAL, чтобы запись
+истории не блокировала чтение списка книг, busy_timeout вместо мгновенной ошибки "database is locked").
+
+PrimaryReplicaRouter: чтение идет на реплики из DATABASE_REPLICAS, запись - на default.
+После первой записи (или в POST/PUT/... запросе) до конца запроса все читается с default,
+чтобы пользователь видел свои изменения, даже если реплика отстает.
+"""
+import contextvars
+import random
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+PRIMARY = 'default'
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,  # мс
+    'synchronous': 'NORMAL',  # в WAL режиме безопасно и намного быстрее FULL
+}
+
+_pinned = contextvars.ContextVar('db_pinned_to_primary', default=False)
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            # база в памяти (тесты) не поддерживает WAL и просто оставит режим memory
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def pin_primary(pinned=True):
+    """
+    Дальше в этом запросе (контексте) читаем с основной базы (pinned=False - снова с реплик).
+    Возвращает токен для reset_pin
+    """
+    return _pinned.set(pinned)
+
+
+def reset_pin(token):
+    _pinned.reset(token)
+
+
+def is_pinned():
+    return _pinned.get()
+
+
+def get_replicas():
+    return [alias for alias in getattr(settings, 'DATABASE_REPLICAS', []) if alias in settings.DATABASES]
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = get_replicas()
+        if not replicas or _pinned.get() or connections[PRIMARY].in_atomic_block:
+            # внутри транзакции читаем то же, что и пишем
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        _pinned.set(True)
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # схему реплики обновляет репликация
+        return db not in get_replicas()
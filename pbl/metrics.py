@@ -0,0 +1,72 @@
+"""
+Гистограммы времени ответа по view в памяти процесса и их выдача в текстовом формате Prometheus.
+
+Каждый worker считает свои гистограммы - Prometheus собирает их с каждого процесса отдельно.
+"""
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+# границы корзин, секунд
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label, value):
+        with self.lock:
+            counts = self.series.get(label)
+            if counts is None:
+                # счетчики корзин, +Inf, сумма
+                counts = self.series[label] = [0] * (len(self.buckets) + 1) + [0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = {label: list(counts) for label, counts in self.series.items()}
+        for label, counts in sorted(series.items()):
+            view = label.replace('\\', '\\\\').replace('"', '\\"')
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{{view="{view}",le="{bound}"}} {total}')
+            lines.append(f'{self.name}_sum{{view="{view}"}} {counts[-1]:.6f}')
+            lines.append(f'{self.name}_count{{view="{view}"}} {total}')
+        return '\n'.join(lines)
+
+
+request_duration = Histogram('pbl_request_duration_seconds', 'Время ответа по view', DURATION_BUCKETS)
+request_queries = Histogram('pbl_request_queries', 'SQL запросов на запрос (только сэмплированные запросы)',
+                            QUERY_BUCKETS)
+HISTOGRAMS = [request_duration, request_queries]
+
+
+def render_metrics():
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
+
+
+def reset_metrics():
+    for histogram in HISTOGRAMS:
+        histogram.reset()
+
+
+def metrics_view(request):
+    allowed = getattr(settings, 'REQUEST_METRICS_ALLOWED_IPS', ['127.0.0.1'])
+    if request.META.get('REMOTE_ADDR') not in allowed and not request.user.is_superuser:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,215 @@
+"""
+RequestMetricsMiddleware - замеры каждого запроса: SQL (число и время), рендер шаблонов, view и общее время.
+
+Время ответа попадает в гистограммы pbl.metrics для всех запросов. Подробные замеры включаются
+для доли запросов REQUEST_METRICS_SAMPLE_RATE (по умолчанию 1%): для них отдается заголовок Server-Timing,
+а запросы дольше REQUEST_METRICS_SLOW_MS пишутся в лог pbl.requests с самыми долгими
+и повторяющимися SQL (несэмплированные - только с временем, view и статусом).
+Замер шаблонов (Template._render) подключается только на время сэмплированных запросов.
+
+PrimaryPinMiddleware - границы "прилипания" к основной базе для pbl.db.PrimaryReplicaRouter.
+"""
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.template.base import Template
+
+from pbl.db import pin_primary, reset_pin
+from pbl.metrics import request_duration, request_queries
+
+logger = logging.getLogger('pbl.requests')
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+DEFAULT_SAMPLE_RATE = 0.01
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = []  # (sql, секунды)
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.view_started = None
+        self.view_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - started))
+
+    @property
+    def db_time(self):
+        return sum(duration for _, duration in self.queries)
+
+    def slowest(self, limit=5):
+        return [{'sql': sql, 'ms': round(duration * 1000, 2)}
+                for sql, duration in sorted(self.queries, key=lambda q: q[1], reverse=True)[:limit]]
+
+    def duplicates(self, limit=5):
+        # одинаковый текст с разными параметрами - обычно запрос в цикле (N + 1)
+        counts = Counter(sql for sql, _ in self.queries)
+        return [{'sql': sql, 'count': count} for sql, count in counts.most_common(limit) if count > 1]
+
+
+class TemplateTimer:
+    """
+    Подменяет Template._render, пока идет хотя бы один сэмплированный запрос, и возвращает прежний
+    (например, инструментированный тестовым окружением) после последнего. Несэмплированные запросы,
+    попавшие в это время, проходят насквозь: метрик в _current у них нет
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.original = None
+
+    def __enter__(self):
+        with self.lock:
+            if not self.active:
+                self.original = Template._render
+                Template._render = self.timed_render(self.original)
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.active -= 1
+            if not self.active:
+                Template._render = self.original
+                self.original = None
+
+    @staticmethod
+    def timed_render(render):
+        def timed(template, context):
+            metrics = _current.get()
+            if metrics is None:
+                return render(template, context)
+            # include и extends рендерят вложенные шаблоны - считаем только внешний
+            metrics.template_depth += 1
+            started = time.perf_counter()
+            try:
+                return render(template, context)
+            finally:
+                metrics.template_depth -= 1
+                if not metrics.template_depth:
+                    metrics.template_time += time.perf_counter() - started
+        return timed
+
+
+template_timer = TemplateTimer()
+
+
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    if match.view_name:
+        return match.view_name
+    # у URL без name остается только путь к функции view: _func_path - приватный атрибут ResolverMatch
+    # (из него собирается его repr), поэтому читаем его осторожно
+    return getattr(match, '_func_path', None) or '<unnamed>'
+
+
+def server_timing(metrics, total):
+    return ', '.join([
+        f'db;dur={metrics.db_time * 1000:.1f};desc="{len(metrics.queries)} queries"',
+        f'tpl;dur={metrics.template_time * 1000:.1f}',
+        f'view;dur={metrics.view_time * 1000:.1f}',
+        f'total;dur={total * 1000:.1f}',
+    ])
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'REQUEST_METRICS_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)
+        self.slow_ms = getattr(settings, 'REQUEST_METRICS_SLOW_MS', 500)
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            response = self.get_response(request)
+            total = time.perf_counter() - started
+            label = view_label(request)
+            request_duration.observe(label, total)
+            # медленный запрос попадает в лог и без сэмплирования, только без SQL и шаблонов
+            if total * 1000 >= self.slow_ms:
+                self.log_slow(request, response, None, label, total)
+            return response
+
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(template_timer)
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        finished = time.perf_counter()
+        total = finished - started
+        if metrics.view_started is not None:
+            metrics.view_time = finished - metrics.view_started
+
+        label = view_label(request)
+        request_duration.observe(label, total)
+        request_queries.observe(label, len(metrics.queries))
+        response['Server-Timing'] = server_timing(metrics, total)
+        if total * 1000 >= self.slow_ms:
+            self.log_slow(request, response, metrics, label, total)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.view_started = time.perf_counter()
+
+    def log_slow(self, request, response, metrics, label, total):
+        """
+        metrics - замеры сэмплированного запроса, None - известны только время, view и статус
+        """
+        record = {
+            'event': 'slow_request',
+            'method': request.method,
+            'path': request.path,
+            'view': label,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'sampled': metrics is not None,
+        }
+        if metrics is not None:
+            record.update({
+                'view_ms': round(metrics.view_time * 1000, 1),
+                'db_ms': round(metrics.db_time * 1000, 1),
+                'queries': len(metrics.queries),
+                'template_ms': round(metrics.template_time * 1000, 1),
+                'slowest_sql': metrics.slowest(),
+                'duplicated_sql': metrics.duplicates(),
+            })
+        logger.warning(json.dumps(record, ensure_ascii=False))
+
+
+class PrimaryPinMiddleware:
+    """
+    Изменяющие запросы сразу читают с основной базы, остальные - пока не запишут что-нибудь сами.
+    После ответа прилипание сбрасывается
+    """
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = pin_primary(request.method not in self.SAFE_METHODS)
+        try:
+            return self.get_response(request)
+        finally:
+            reset_pin(token)
@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'pbl.middleware.RequestMetricsMiddleware',
+    'pbl.middleware.PrimaryPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,9 +81,42 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+    # реплика только для чтения; локально - тот же файл через отдельное соединение (в WAL чтение не ждет запись)
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['pbl.db.PrimaryReplicaRouter']
+# алиасы, с которых читать (pbl.db); пустой список - все запросы идут в default
+DATABASE_REPLICAS = []
+# PRAGMA для каждого нового соединения с SQLite
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+}
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# Для нескольких процессов подойдет файловый кэш:
+# 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': os.path.join(BASE_DIR, 'tmp/cache')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        # по умолчанию 300 записей - меньше, чем карточек книг в кэше фрагментов списка
+        'OPTIONS': {'MAX_ENTRIES': 20000},
     }
 }
 
+# Алиас кэша для списка книг и ответов API (bookcross.cache) и время жизни записей, секунд
+BOOKCROSS_CACHE = 'default'
+BOOKCROSS_CACHE_TIMEOUT = 60 * 60
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -145,3 +180,23 @@ LOGIN_REDIRECT_URL = '/'
 LOGIN_URL = 'login'
 LOGOUT_URL = 'logout'
 TEMP_ROOT = os.path.join(BASE_DIR, 'tmp/')
+
+# Уменьшенные копии обложек и аватаров (bookcross.thumbnails): ширины в px и число процессов ресайза,
+# 0 - ресайз прямо в запросе
+THUMBNAIL_WIDTHS = (150, 300, 600)
+THUMBNAIL_WORKERS = 2
+
+# Замеры запросов (pbl.middleware): доля запросов с подробными замерами SQL и шаблонов (0 - только время ответа),
+# порог медленного запроса для лога pbl.requests, адреса, с которых доступен /metrics
+REQUEST_METRICS_SAMPLE_RATE = 0.01
+REQUEST_METRICS_SLOW_MS = 500
+REQUEST_METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+# Брокер событий о статусах книг для /api/v1/events/ (bookcross.events). InProcessBroker работает
+# в пределах одного ASGI процесса
+BOOKCROSS_EVENT_BROKER = 'bookcross.events.InProcessBroker'
+
+# Подробная история перемещений хранится столько месяцев, старшие записи команда archive_history
+# сворачивает в итоги по месяцам и выгружает в архив (bookcross.history)
+BOOKCROSS_HISTORY_RETENTION_MONTHS = 12
+BOOKCROSS_HISTORY_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive', 'history')
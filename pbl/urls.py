@@ -18,10 +18,13 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from pbl.metrics import metrics_view
+
 urlpatterns = [
     path('', include('bookcross.urls')),
     path('admin/', admin.site.urls),
     path('account/', include('account.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)